@@ -0,0 +1,48 @@
+import numpy as np
+
+SCORING_FEATURES = ('year', 'mileage', 'engine_power', 'engine_capacity')
+COHORT_FIELDS = ('make', 'model')
+MIN_COHORT_SIZE = 8
+
+
+def _design_matrix(features: np.ndarray) -> np.ndarray:
+    """Intercept, age, log mileage, power and capacity. Missing values are filled with the cohort median"""
+    features = features.copy()
+    medians = np.nanmedian(features, axis=0)
+    missing = np.isnan(features)
+    features[missing] = np.take(np.where(np.isnan(medians), 0, medians), np.nonzero(missing)[1])
+    year, mileage, power, capacity = features.T
+    return np.column_stack([np.ones(len(features)), year - 2000, np.log1p(mileage), power / 100, capacity / 1000])
+
+
+def score_cohort(price: np.ndarray, features: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Fits log(price) on the features of a whole cohort at once and returns (expected price, deal score).
+
+    Deal score is (expected - price) / expected, positive for cars priced below the cohort model.
+    """
+    design = _design_matrix(features)
+    known = price > 0
+    coefficients, *_ = np.linalg.lstsq(design[known], np.log(price[known]), rcond=None)
+    expected = np.exp(design @ coefficients)
+    score = np.where(known, (expected - price) / expected, np.nan)
+    return expected, score
+
+
+def score_cars(columns: dict[str, list]) -> tuple[np.ndarray, np.ndarray]:
+    """Expected price and deal score of every car, aligned with `columns`. NaN where a cohort is too small"""
+    size = len(columns['price'])
+    expected, score = np.full(size, np.nan), np.full(size, np.nan)
+    if not size:
+        return expected, score
+    price = np.array([value or 0 for value in columns['price']], dtype=np.float64)
+    features = np.array([[np.nan if value is None else value for value in columns[field]]
+                         for field in SCORING_FEATURES], dtype=np.float64).T
+    cohorts = np.array(['|'.join(str(value) for value in key) for key in
+                        zip(*(columns[field] for field in COHORT_FIELDS))])
+    _, inverse, counts = np.unique(cohorts, return_inverse=True, return_counts=True)
+    order = np.argsort(inverse, kind='stable')
+    for indices in np.split(order, np.cumsum(counts)[:-1]):
+        if np.count_nonzero(price[indices] > 0) < MIN_COHORT_SIZE:
+            continue
+        expected[indices], score[indices] = score_cohort(price[indices], features[indices])
+    return expected, score
@@ -0,0 +1,100 @@
+import math
+
+import numpy as np
+
+BUCKET_WIDTHS = {
+    'price': 500,
+    'price_per_km': 0.001,
+    'year': 1,
+    'mileage': 10000,
+    'engine_power': 10,
+}
+STATISTICS_FIELDS = ('price', 'year', 'mileage', 'engine_power')
+DISTRIBUTION_FIELDS = ('year', 'mileage', 'engine_power')
+PERCENTILES = (10, 25, 50, 75, 90)
+
+
+def car_buckets(car: dict) -> dict[str, int]:
+    """Histogram bucket of every statistics field of one car. Missing or unusable values are left out"""
+    values = {field: car.get(field) for field in STATISTICS_FIELDS}
+    if values['price'] and values['mileage']:
+        values['price_per_km'] = values['price'] / values['mileage']
+    return {field: math.floor(value / BUCKET_WIDTHS[field]) for field, value in values.items()
+            if isinstance(value, (int, float)) and value > 0}
+
+
+def _distribution(buckets: dict[int, int], field: str) -> dict[str, int]:
+    width = BUCKET_WIDTHS[field]
+    return {str(bucket * width): count for bucket, count in sorted(buckets.items()) if count > 0}
+
+
+def _histogram_percentiles(buckets: dict[int, int], field: str, percentiles=PERCENTILES) -> list[float | None]:
+    """Percentiles interpolated linearly inside the histogram buckets"""
+    width = BUCKET_WIDTHS[field]
+    bucket_ids = sorted(bucket for bucket, count in buckets.items() if count > 0)
+    if not bucket_ids:
+        return [None] * len(percentiles)
+    counts = np.array([buckets[bucket] for bucket in bucket_ids], dtype=np.float64)
+    cumulative = np.cumsum(counts)
+    targets = np.array(percentiles, dtype=np.float64) / 100 * cumulative[-1]
+    positions = np.minimum(np.searchsorted(cumulative, targets, side='left'), len(bucket_ids) - 1)
+    below = cumulative[positions] - counts[positions]
+    fraction = np.clip((targets - below) / counts[positions], 0, 1)
+    return [float((bucket_ids[p] + f) * width) for p, f in zip(positions, fraction)]
+
+
+def stats_from_histograms(count: int, price_sum: float, histograms: dict[str, dict[int, int]]) -> dict:
+    """Statistics of a rollup. Percentiles are approximate, with the resolution of BUCKET_WIDTHS"""
+    price_percentiles = _histogram_percentiles(histograms.get('price', {}), 'price')
+    median_price_per_km = _histogram_percentiles(histograms.get('price_per_km', {}), 'price_per_km', (50,))[0]
+    # cars without a price have no price bucket and add nothing to price_sum, like `stats_from_arrays`
+    priced_count = sum(histograms.get('price', {}).values())
+    return {
+        'count': count,
+        'price': {'mean': price_sum / priced_count if priced_count else None,
+                  **{f'p{p}': value for p, value in zip(PERCENTILES, price_percentiles)}},
+        'median_price_per_km': median_price_per_km,
+        'distributions': {field: _distribution(histograms.get(field, {}), field) for field in DISTRIBUTION_FIELDS},
+    }
+
+
+def _array_distribution(values: np.ndarray, field: str) -> dict[str, int]:
+    values = values[values > 0]
+    buckets, counts = np.unique(np.floor(values / BUCKET_WIDTHS[field]).astype(np.int64), return_counts=True)
+    return _distribution(dict(zip(buckets.tolist(), counts.tolist())), field)
+
+
+def stats_from_arrays(price: np.ndarray, year: np.ndarray, mileage: np.ndarray, engine_power: np.ndarray) -> dict:
+    """Exact statistics of one group of cars, given as aligned float arrays (NaN for missing values)"""
+    known_price = price[price > 0]
+    price_per_km = price / np.where(mileage > 0, mileage, np.nan)
+    price_per_km = price_per_km[np.isfinite(price_per_km) & (price_per_km > 0)]
+    if known_price.size:
+        price_percentiles = np.percentile(known_price, PERCENTILES).tolist()
+        mean_price = float(known_price.mean())
+    else:
+        price_percentiles, mean_price = [None] * len(PERCENTILES), None
+    return {
+        'count': int(price.size),
+        'price': {'mean': mean_price, **{f'p{p}': value for p, value in zip(PERCENTILES, price_percentiles)}},
+        'median_price_per_km': float(np.median(price_per_km)) if price_per_km.size else None,
+        'distributions': {field: _array_distribution(values, field) for field, values in
+                          (('year', year), ('mileage', mileage), ('engine_power', engine_power))},
+    }
+
+
+def grouped_stats_from_columns(columns: dict[str, list], group_by: list[str]) -> list[dict]:
+    """Statistics per group, computed with vectorized operations over the columns of all matching cars"""
+    if not columns.get('price'):
+        return []
+    numeric = {field: np.array([np.nan if value is None else value for value in columns[field]], dtype=np.float64)
+               for field in STATISTICS_FIELDS}
+    keys = list(zip(*(columns[field] for field in group_by))) if group_by else [()] * len(columns['price'])
+    unique_keys, inverse = np.unique(np.array([repr(key) for key in keys]), return_inverse=True)
+    order = np.argsort(inverse, kind='stable')
+    boundaries = np.cumsum(np.bincount(inverse, minlength=len(unique_keys)))[:-1]
+    results = []
+    for indices in np.split(order, boundaries):
+        group_key = dict(zip(group_by, keys[indices[0]]))
+        results.append({**group_key, **stats_from_arrays(*(numeric[field][indices] for field in STATISTICS_FIELDS))})
+    return results
@@ -0,0 +1,201 @@
+import asyncio
+import datetime
+import itertools
+import os
+from collections import defaultdict
+
+from mongo.database import DataBase, db_logger, CAR_TTL_SECONDS
+from mongo.rollups import ROLLUP_SOURCE_FIELDS
+from mongo.search_query import specs_from_search, active_specs
+from mongo.specifications import Specification, MakeParameter, OneOfParameter, DecimalRangeParameter, \
+    TextSearchParameter
+
+# cars and saved searches written by any process are picked up this often
+SEARCH_MATCH_POLL_SECONDS = float(os.getenv("SEARCH_MATCH_POLL_SECONDS", 5))
+PRICE_BUCKET_WIDTH = 1000
+MAX_PRICE_BUCKETS = 100
+SUBSCRIBER_QUEUE_SIZE = 100
+MATCH_FIELDS = ('ad_number', 'link', 'img_src', 'thumbnail', 'make', 'model', 'year', 'price', 'mileage',
+                'engine_power', 'engine_capacity', 'fuel_type', 'deal_score', 'expected_price')
+
+ANY = None
+# a stored car is matched again only when one of these changed
+TRACKED_FIELDS = ROLLUP_SOURCE_FIELDS
+# always read, on top of the fields the saved searches filter on
+POLL_FIELDS = (*MATCH_FIELDS, *TRACKED_FIELDS, 'updatedAt', 'search_text', 'safety', 'options', 'details')
+
+
+def spec_fields(spec: Specification) -> tuple[str, ...]:
+    """Car fields `spec.matches` reads"""
+    if isinstance(spec, MakeParameter):
+        return 'make', 'model'
+    if isinstance(spec, TextSearchParameter):
+        return 'search_text',
+    return (spec.param_name,) if hasattr(spec, 'param_name') else ()
+
+
+def _price_bucket(price) -> int | None:
+    return int(price) // PRICE_BUCKET_WIDTH if price is not None else None
+
+
+class SearchIndex:
+    """Saved searches partitioned by make, fuel type and price bucket.
+
+    A search is registered under every (make, fuel, bucket) combination it can match, with ANY for
+    dimensions it does not restrict. A car then only has to be checked against the searches of the
+    eight partitions its own make/fuel/bucket (or ANY) fall into.
+    """
+
+    def __init__(self):
+        self._searches: dict[str, list[Specification]] = {}
+        self._keys: dict[str, list[tuple]] = {}
+        self._index: defaultdict[tuple, set[str]] = defaultdict(set)
+
+    def __len__(self):
+        return len(self._searches)
+
+    @property
+    def fields(self) -> set[str]:
+        """Car fields the registered searches filter on"""
+        return {field for specifications in self._searches.values() for spec in specifications
+                for field in spec_fields(spec)}
+
+    def add(self, search_id: str, specifications: list[Specification]):
+        """Registers a search, `specifications` must only contain active specifications"""
+        self.remove(search_id)
+        keys = self._partition_keys(specifications)
+        self._searches[search_id] = specifications
+        self._keys[search_id] = keys
+        for key in keys:
+            self._index[key].add(search_id)
+
+    def remove(self, search_id: str):
+        for key in self._keys.pop(search_id, []):
+            self._index[key].discard(search_id)
+            if not self._index[key]:
+                del self._index[key]
+        self._searches.pop(search_id, None)
+
+    @staticmethod
+    def _partition_keys(specifications: list[Specification]) -> list[tuple]:
+        makes, fuels, buckets = [ANY], [ANY], [ANY]
+        for spec in specifications:
+            if isinstance(spec, MakeParameter):
+                included = [MakeParameter.normalize_string(make) for make in spec.makes_to_include if make]
+                makes = included or makes
+            elif isinstance(spec, OneOfParameter) and spec.param_name == 'fuel_type':
+                fuels = [fuel for fuel in spec.values if fuel is not None] or fuels
+            elif isinstance(spec, DecimalRangeParameter) and spec.param_name == 'price' and spec.val_to:
+                low, high = _price_bucket(spec.val_from or 0), _price_bucket(spec.val_to)
+                if high - low < MAX_PRICE_BUCKETS:
+                    buckets = list(range(low, high + 1))
+        return list(itertools.product(makes, fuels, buckets))
+
+    def candidates(self, car: dict) -> set[str]:
+        search_ids = set()
+        for key in itertools.product((car.get('make'), ANY), (car.get('fuel_type'), ANY),
+                                     (_price_bucket(car.get('price')), ANY)):
+            search_ids.update(self._index.get(key, ()))
+        return search_ids
+
+    def match(self, car: dict) -> list[str]:
+        return [search_id for search_id in self.candidates(car)
+                if all(spec.matches(car) for spec in self._searches[search_id])]
+
+
+def _timestamp(value) -> float:
+    if not isinstance(value, datetime.datetime):
+        return 0.0
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=datetime.timezone.utc)
+    return value.timestamp()
+
+
+def saved_search_specs(search: dict) -> list[Specification]:
+    return active_specs(specs_from_search(search.get('search_url'), search.get('makes_to_include'),
+                                          search.get('makes_to_exclude'), search.get('text')))
+
+
+class SearchMatcher:
+    """Matches stored cars against saved searches and pushes matches to the subscribers of a search.
+
+    Cars are read back from MongoDB by `updatedAt`, so cars saved by the CLI, the scheduler or another
+    API worker are matched as well. The first poll only records what is already stored.
+    """
+
+    def __init__(self):
+        self.index = SearchIndex()
+        self.watermark: datetime.datetime | None = None
+        self._subscribers: defaultdict[str, set[asyncio.Queue]] = defaultdict(set)
+        # ad number -> (tracked field values, updatedAt timestamp) of every car seen
+        self._seen: dict[int, tuple[tuple, float]] = {}
+        self._primed = False
+
+    def subscribe(self, search_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self._subscribers[search_id].add(queue)
+        return queue
+
+    def unsubscribe(self, search_id: str, queue: asyncio.Queue):
+        self._subscribers[search_id].discard(queue)
+        if not self._subscribers[search_id]:
+            del self._subscribers[search_id]
+
+    def publish(self, search_id: str, event: dict):
+        for queue in tuple(self._subscribers.get(search_id, ())):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:  # slow client, drop rather than fall behind
+                pass
+
+    def match(self, car: dict) -> int:
+        """Publishes `car` to every search it matches, returns the number of matches"""
+        search_ids = self.index.match(car)
+        event = {field: car.get(field) for field in MATCH_FIELDS}
+        for search_id in search_ids:
+            self.publish(search_id, {**event, 'search_id': search_id})
+        return len(search_ids)
+
+    async def reload_searches(self, db: DataBase):
+        """Replaces the index with the saved searches stored in MongoDB"""
+        index = SearchIndex()
+        async for search in db.saved_search_collection.find():
+            index.add(str(search['_id']), saved_search_specs(search))
+        self.index = index
+
+    async def poll(self, db: DataBase) -> int:
+        """Matches the cars that are new or changed since the last poll, returns the number of matches"""
+        data_filter = {'updatedAt': {'$gte': self.watermark}} if self.watermark else {}
+        matches = 0
+        projection = {'_id': 0, **{field: 1 for field in (*POLL_FIELDS, *self.index.fields)}}
+        async for car in db.car_collection.find(data_filter, projection, batch_size=5000):
+            updated_at = car.get('updatedAt')
+            if isinstance(updated_at, datetime.datetime) and (self.watermark is None or updated_at > self.watermark):
+                self.watermark = updated_at
+            tracked = tuple(str(car.get(field)) for field in TRACKED_FIELDS)
+            previous = self._seen.get(car['ad_number'])
+            self._seen[car['ad_number']] = tracked, _timestamp(updated_at)
+            if self._primed and (previous is None or previous[0] != tracked):
+                matches += self.match(car)
+        self._primed = True
+        # expired cars are never read again, forget them so a returning ad counts as new
+        deadline = datetime.datetime.now(datetime.timezone.utc).timestamp() - CAR_TTL_SECONDS
+        for ad_number in [ad_number for ad_number, (_, seen_at) in self._seen.items() if seen_at < deadline]:
+            del self._seen[ad_number]
+        return matches
+
+    async def run(self, db: DataBase):
+        """Keeps searches and matches up to date, meant to run as a background task of the API"""
+        while True:
+            try:
+                await self.reload_searches(db)
+                if matches := await self.poll(db):
+                    db_logger.debug('Matched %s saved searches', matches)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                db_logger.exception('Saved search matching failed. %s', e)
+            await asyncio.sleep(SEARCH_MATCH_POLL_SECONDS)
+
+
+search_matcher = SearchMatcher()
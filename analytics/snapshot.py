@@ -0,0 +1,300 @@
+import asyncio
+import datetime
+import os
+import time
+
+import numpy as np
+
+from mongo.database import DataBase, db_logger, CAR_TTL_SECONDS
+from mongo.specifications import Specification, DecimalRangeParameter, SimpleParameter, OneOfParameter, \
+    SubSetParameter, MakeParameter
+from scraping.translation import safety_features_translation, additional_options_translation, condition_translation
+
+SNAPSHOT_ENABLED = os.getenv("CAR_SNAPSHOT", "").lower() in ("1", "true", "yes")
+SNAPSHOT_REFRESH_SECONDS = float(os.getenv("CAR_SNAPSHOT_REFRESH_SECONDS", 10))
+# writes that do not touch updatedAt (deal scores, thumbnails, clusters) are picked up by the periodic full reload
+SNAPSHOT_FULL_RELOAD_SECONDS = float(os.getenv("CAR_SNAPSHOT_FULL_RELOAD_SECONDS", 600))
+
+NUMERIC_COLUMNS = ('ad_number', 'year', 'price', 'mileage', 'engine_power', 'engine_capacity', 'deal_score',
+                   'expected_price', 'cluster_id', 'updatedAt')
+CATEGORICAL_COLUMNS = ('make', 'model', 'fuel_type', 'transmission', 'body_type', 'steering_side', 'climate_control',
+                       'damage', 'emission_class', 'interior_material')
+FLAG_COLUMNS = {
+    'safety': sorted(set(safety_features_translation.values())),
+    'options': sorted(set(additional_options_translation.values())),
+    'details': sorted(set(condition_translation.values())),
+}
+OBJECT_COLUMNS = ('id', 'link', 'img_src', 'thumbnail')
+GROUP_CAR_FIELDS = ('id', 'link', 'img_src', 'thumbnail', 'make', 'model', 'year', 'price', 'engine_power',
+                    'engine_capacity', 'deal_score', 'expected_price')
+_INT_OUTPUT_FIELDS = {'year', 'price', 'engine_power', 'engine_capacity', 'expected_price'}
+_SORT_DIRECTIONS = {'deal_score': -1, 'price': 1, 'year': 1}
+_PROJECTION = {field: 1 for field in (*NUMERIC_COLUMNS, *CATEGORICAL_COLUMNS, *FLAG_COLUMNS, *OBJECT_COLUMNS[1:])}
+
+
+class UnsupportedQuery(Exception):
+    """The snapshot cannot answer the query, MongoDB has to"""
+
+
+def _timestamp(value) -> float:
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=datetime.timezone.utc)
+        return value.timestamp()
+    return np.nan
+
+
+class CarSnapshot:
+    """Columnar in-memory copy of the car collection for filtering and grouping without MongoDB.
+
+    Numeric fields are float64 arrays (NaN when missing), categorical fields int32 codes into a
+    per-column vocabulary (-1 when missing) and options/safety/details one bitset row per car. Rows
+    are updated in place by ad number; rows past the TTL deadline are dropped the same way MongoDB
+    drops the documents.
+    """
+
+    def __init__(self):
+        self.size = 0
+        self.capacity = 0
+        self.numeric: dict[str, np.ndarray] = {}
+        self.codes: dict[str, np.ndarray] = {}
+        self.vocabularies: dict[str, list] = {column: [] for column in CATEGORICAL_COLUMNS}
+        self._code_of: dict[str, dict] = {column: {} for column in CATEGORICAL_COLUMNS}
+        self.flags: dict[str, np.ndarray] = {}
+        self._flag_bit = {column: {flag: bit for bit, flag in enumerate(flags)} for column, flags in FLAG_COLUMNS.items()}
+        self.objects: dict[str, np.ndarray] = {}
+        self.alive = np.zeros(0, dtype=bool)
+        self._row_of: dict[int, int] = {}
+        self.watermark: datetime.datetime | None = None
+        self.loaded_at = 0.0
+        # bumped on every change of the rows, responses served from the snapshot are tagged with it
+        self.version = 0
+        self.ready = False
+        self._allocate(1024)
+
+    def _allocate(self, capacity: int):
+        def grow(array: np.ndarray | None, fill, dtype, width: int = None):
+            shape = (capacity,) if width is None else (capacity, width)
+            grown = np.full(shape, fill, dtype=dtype)
+            if array is not None:
+                grown[:self.size] = array[:self.size]
+            return grown
+
+        self.numeric = {column: grow(self.numeric.get(column), np.nan, np.float64) for column in NUMERIC_COLUMNS}
+        self.codes = {column: grow(self.codes.get(column), -1, np.int32) for column in CATEGORICAL_COLUMNS}
+        self.flags = {column: grow(self.flags.get(column), 0, np.uint64, (len(flags) + 63) // 64)
+                      for column, flags in FLAG_COLUMNS.items()}
+        self.objects = {column: grow(self.objects.get(column), None, object) for column in OBJECT_COLUMNS}
+        self.alive = grow(self.alive if self.capacity else None, False, bool)
+        self.capacity = capacity
+
+    def _code(self, column: str, value) -> int:
+        if value is None:
+            return -1
+        codes = self._code_of[column]
+        if value not in codes:
+            codes[value] = len(self.vocabularies[column])
+            self.vocabularies[column].append(value)
+        return codes[value]
+
+    def upsert(self, car: dict) -> bool:
+        """Stores `car`, returns False when the row already holds this version (same `updatedAt`)"""
+        row = self._row_of.get(car['ad_number'])
+        updated_at = _timestamp(car.get('updatedAt'))
+        if row is not None and self.alive[row] and self.numeric['updatedAt'][row] == updated_at:
+            return False  # incremental refreshes read the newest car again every time
+        self.version += 1
+        if row is None:
+            if self.size == self.capacity:
+                self._allocate(self.capacity * 2)
+            row = self.size
+            self.size += 1
+            self._row_of[car['ad_number']] = row
+        for column in NUMERIC_COLUMNS:
+            value = car.get(column)
+            if column == 'updatedAt':
+                value = updated_at
+            self.numeric[column][row] = value if isinstance(value, (int, float)) else np.nan
+        for column in CATEGORICAL_COLUMNS:
+            self.codes[column][row] = self._code(column, car.get(column))
+        for column, bits in self._flag_bit.items():
+            words = self.flags[column][row]
+            words[:] = 0
+            for flag in car.get(column) or ():
+                if (bit := bits.get(flag)) is not None:
+                    words[bit // 64] |= np.uint64(1 << (bit % 64))
+        self.objects['id'][row] = str(car['_id'])
+        for column in OBJECT_COLUMNS[1:]:
+            self.objects[column][row] = car.get(column)
+        self.alive[row] = True
+        return True
+
+    def expire(self, now: float = None) -> int:
+        """Drops rows MongoDB's TTL index has deleted (or is about to)"""
+        now = time.time() if now is None else now
+        expired = self.alive[:self.size] & (self.numeric['updatedAt'][:self.size] < now - CAR_TTL_SECONDS)
+        for row in np.flatnonzero(expired).tolist():
+            self._row_of.pop(int(self.numeric['ad_number'][row]), None)
+        self.alive[:self.size][expired] = False
+        if expired.any():
+            self.version += 1
+        return int(expired.sum())
+
+    async def refresh(self, db: DataBase, full: bool = False) -> int:
+        """Loads cars updated since the last refresh, or everything when `full`. Returns the rows changed"""
+        if full:
+            fresh = CarSnapshot()
+            loaded = await fresh.refresh(db)
+            fresh.version += self.version + 1
+            self.__dict__.update(fresh.__dict__)
+            self.loaded_at = time.time()
+            return loaded
+        data_filter = {'updatedAt': {'$gte': self.watermark}} if self.watermark else {}
+        loaded = 0
+        async for car in db.analytics_collection.find(data_filter, _PROJECTION, batch_size=5000):
+            loaded += self.upsert(car)
+            if isinstance(car.get('updatedAt'), datetime.datetime) and (
+                    self.watermark is None or car['updatedAt'] > self.watermark):
+                self.watermark = car['updatedAt']
+        self.expire()
+        self.ready = True
+        return loaded
+
+    async def run(self, db: DataBase):
+        """Keeps the snapshot fresh, meant to run as a background task of the API"""
+        while True:
+            try:
+                full = time.time() - self.loaded_at >= SNAPSHOT_FULL_RELOAD_SECONDS
+                loaded = await self.refresh(db, full=full)
+                if loaded:
+                    db_logger.debug('Snapshot refreshed, %s cars loaded (full: %s)', loaded, full)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                db_logger.exception('Snapshot refresh failed. %s', e)
+            await asyncio.sleep(SNAPSHOT_REFRESH_SECONDS)
+
+    def _codes_for(self, column: str, values) -> np.ndarray:
+        return np.array([self._code_of[column][value] for value in values if value in self._code_of[column]],
+                        dtype=np.int32)
+
+    @property
+    def data_version(self) -> tuple:
+        """Identifies the rows served by this process' snapshot, for response ETags"""
+        return 'snapshot', self.loaded_at, self.version
+
+    @staticmethod
+    def supports(spec: Specification) -> bool:
+        return (isinstance(spec, DecimalRangeParameter) and spec.param_name in NUMERIC_COLUMNS
+                or isinstance(spec, (SimpleParameter, OneOfParameter)) and spec.param_name in CATEGORICAL_COLUMNS
+                or isinstance(spec, SubSetParameter) and spec.param_name in FLAG_COLUMNS
+                or isinstance(spec, MakeParameter))
+
+    def can_answer(self, specifications: list[Specification]) -> bool:
+        return self.ready and all(self.supports(spec) for spec in specifications)
+
+    def _spec_mask(self, spec: Specification) -> np.ndarray:
+        size = self.size
+        if isinstance(spec, DecimalRangeParameter) and spec.param_name in self.numeric:
+            values = self.numeric[spec.param_name][:size]
+            mask = ~np.isnan(values)
+            if spec.val_from is not None:
+                mask &= values >= int(spec.val_from)
+            if spec.val_to is not None:
+                mask &= values <= int(spec.val_to)
+            return mask
+        if isinstance(spec, (SimpleParameter, OneOfParameter)) and spec.param_name in self.codes:
+            values = [spec.value] if isinstance(spec, SimpleParameter) else spec.values
+            return np.isin(self.codes[spec.param_name][:size], self._codes_for(spec.param_name, values))
+        if isinstance(spec, SubSetParameter) and spec.param_name in self.flags:
+            required = np.zeros(self.flags[spec.param_name].shape[1], dtype=np.uint64)
+            for flag in spec.values:
+                if (bit := self._flag_bit[spec.param_name].get(flag)) is None:
+                    return np.zeros(size, dtype=bool)
+                required[bit // 64] |= np.uint64(1 << (bit % 64))
+            return np.all((self.flags[spec.param_name][:size] & required) == required, axis=1)
+        if isinstance(spec, MakeParameter):
+            return self._make_mask(spec)
+        raise UnsupportedQuery(type(spec).__name__)
+
+    def _make_mask(self, spec: MakeParameter) -> np.ndarray:
+        makes, models = self.codes['make'][:self.size], self.codes['model'][:self.size]
+        normalize = MakeParameter.normalize_string
+        included = [(make, included_models) for make, included_models in spec.makes_to_include.items() if make]
+        mask = np.zeros(self.size, dtype=bool) if included else np.ones(self.size, dtype=bool)
+        for make, included_models in included:
+            make_mask = makes == self._code_of['make'].get(normalize(make), -2)
+            if included_models:
+                make_mask &= np.isin(models, self._codes_for('model', [normalize(m) for m in included_models]))
+            mask |= make_mask
+        for make, excluded_models in spec.makes_to_exclude.items():
+            mask &= makes != self._code_of['make'].get(normalize(make), -2)
+            if excluded_models:
+                mask &= ~np.isin(models, self._codes_for('model', [normalize(m) for m in excluded_models]))
+        return mask
+
+    def filter(self, specifications: list[Specification], min_deal_score: float = None) -> np.ndarray:
+        """Rows matching all active `specifications`. Raises UnsupportedQuery for specs it cannot evaluate"""
+        mask = self.alive[:self.size].copy()
+        for spec in specifications:
+            mask &= self._spec_mask(spec)
+        if min_deal_score is not None:
+            mask &= self.numeric['deal_score'][:self.size] >= min_deal_score
+        return np.flatnonzero(mask)
+
+    def _collapse_duplicates(self, rows: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        clusters = self.numeric['cluster_id'][rows]
+        clusters = np.where(np.isnan(clusters), self.numeric['ad_number'][rows], clusters)
+        newest_first = np.argsort(-np.nan_to_num(self.numeric['updatedAt'][rows]), kind='stable')
+        _, first, counts = np.unique(clusters[newest_first], return_index=True, return_counts=True)
+        return rows[newest_first[first]], counts
+
+    def _value(self, field: str, row: int):
+        if field in self.codes:
+            code = self.codes[field][row]
+            return self.vocabularies[field][code] if code >= 0 else None
+        if field in self.numeric:
+            value = self.numeric[field][row]
+            if np.isnan(value):
+                return None
+            return int(value) if field in _INT_OUTPUT_FIELDS else float(value)
+        return self.objects[field][row]
+
+    def group(self, group_by: list[str], specifications: list[Specification], min_count: int = 1,
+              sort_by: str = None, min_deal_score: float = None, collapse_duplicates: bool = False) -> list[dict]:
+        """Same result as CarRepository.get_grouped_data, computed on the snapshot columns"""
+        rows = self.filter(specifications, min_deal_score)
+        duplicate_counts = None
+        if collapse_duplicates and rows.size:
+            rows, duplicate_counts = self._collapse_duplicates(rows)
+        if sort_by and rows.size:
+            values = self.numeric[sort_by][rows] * _SORT_DIRECTIONS[sort_by]
+            order = np.argsort(np.where(np.isnan(values), np.inf, values), kind='stable')
+            rows = rows[order]
+            if duplicate_counts is not None:
+                duplicate_counts = duplicate_counts[order]
+        if not rows.size:
+            return []
+        keys = np.column_stack([self.codes[field][rows] if field in self.codes
+                                else np.nan_to_num(self.numeric[field][rows], nan=-1).astype(np.int64)
+                                for field in group_by]) if group_by else np.zeros((rows.size, 1), dtype=np.int64)
+        _, inverse, counts = np.unique(keys, axis=0, return_inverse=True, return_counts=True)
+        inverse = inverse.reshape(-1)
+        order = np.argsort(inverse, kind='stable')
+        groups = []
+        for group_rows in np.split(order, np.cumsum(counts)[:-1]):
+            if group_rows.size < min_count:
+                continue
+            cars = []
+            for position in group_rows.tolist():
+                car = {field: self._value(field, rows[position]) for field in GROUP_CAR_FIELDS}
+                if duplicate_counts is not None:
+                    car['duplicate_count'] = int(duplicate_counts[position])
+                cars.append(car)
+            first = rows[group_rows[0]]
+            groups.append({**{field: self._value(field, first) for field in group_by},
+                           'count': int(group_rows.size), 'cars': cars})
+        return groups
+
+
+car_snapshot = CarSnapshot()
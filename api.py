@@ -1,23 +1,61 @@
 import asyncio
+import datetime
 import json
+import os
 import re
-from typing import List, Optional, Dict, Any, Iterable
-from urllib.parse import urlparse, parse_qs
+import uuid
+from contextlib import asynccontextmanager, nullcontext
+from typing import List, Optional, Dict, Any
 
-from fastapi import FastAPI, Query, HTTPException, Depends
+from fastapi import FastAPI, APIRouter, Query, HTTPException, Depends, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import FileResponse, StreamingResponse, PlainTextResponse
+from pydantic import BaseModel, Field
 
-from main import scrape_all_pages
+from analytics.market_stats import grouped_stats_from_columns, STATISTICS_FIELDS
+from analytics.search_matcher import search_matcher, saved_search_specs
+from analytics.snapshot import car_snapshot, SNAPSHOT_ENABLED
+import metrics
 from mongo.car_repo import CarRepository
-from mongo.database import get_database, DataBase
-from mongo.specifications import DecimalRangeParameter, SubSetParameter, OneOfParameter, SimpleParameter, MakeParameter, \
-    Specification
-from scraping.translation import safety_features_translation, additional_options_translation, condition_translation, \
-    body_type_codes, fuel_type_codes, gearbox_codes, wheel_side_codes, ac_type_codes, condition_codes, \
-    emission_class_codes, interior_material_codes
-
-app = FastAPI()
+from mongo.crawl_targets import CrawlTargetRepository
+from mongo.database import get_database, DataBase, db as database
+from mongo.migrations import migrate
+from mongo.rollups import RollupRepository
+from mongo.saved_searches import SavedSearchRepository
+from mongo.search_query import specs_from_search, mongo_query_from_specs, active_specs
+from responses import to_compact_groups, compressed_response, json_bytes, etag_for, etag_matches, cache_headers, \
+    not_modified_response
+from scraping.thumbnails import thumbnail_cache, THUMBNAIL_MEDIA_TYPE
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    await database.connect()
+    await database.warm_up()
+    background_tasks = [asyncio.create_task(search_matcher.run(database))]
+    if SNAPSHOT_ENABLED:
+        background_tasks.append(asyncio.create_task(car_snapshot.run(database)))
+    # read-only replicas leave every write (migrations, rollup rebuilds, crawls) to the writers
+    if not API_READ_ONLY:
+        from scheduler import CrawlScheduler, CRAWL_SCHEDULER_ENABLED
+
+        await migrate(database)
+        background_tasks.append(asyncio.create_task(RollupRepository(database).run()))
+        if CRAWL_SCHEDULER_ENABLED:
+            background_tasks.append(asyncio.create_task(CrawlScheduler(database).run()))
+    yield
+    for task in background_tasks:
+        task.cancel()
+    await database.disconnect()
+
+
+# read-only replicas serve data but never write, scrape or crawl, so they never load the scraping stack
+API_READ_ONLY = os.getenv("API_READ_ONLY", "").lower() in ("1", "true", "yes")
+
+app = FastAPI(lifespan=lifespan)
+scrape_router = APIRouter()
+
+SSE_KEEPALIVE_SECONDS = 15
 
 origins = [
     "http://localhost:63342",
@@ -31,25 +69,50 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag"],
 )
 
 
-async def group_cars(group_by: List[str], db: DataBase, min_count: int = 1, data_filter: dict = None, ):
+async def group_cars(group_by: List[str], db: DataBase, min_count: int = 1, specifications: list = None,
+                     sort_by: str = None, min_deal_score: float = None, collapse_duplicates: bool = False,
+                     session=None):
     # Validate group_by fields
     valid_fields = {"make", "model", "year"}
     if not all(field in valid_fields for field in group_by):
         raise HTTPException(status_code=400, detail=f"Invalid group_by fields. Valid fields are: {valid_fields}")
 
+    specifications = active_specs(specifications or [])
+    if car_snapshot.can_answer(specifications):
+        return car_snapshot.group(group_by, specifications, min_count, sort_by, min_deal_score, collapse_duplicates)
+
     # Build the _id object for grouping
+    data_filter = mongo_query_from_specs(specifications)
     car_repo = CarRepository(db)
-    results = await car_repo.get_grouped_data(group_by, data_filter, min_count)
+    results = await car_repo.get_grouped_data(group_by, data_filter, min_count, sort_by, min_deal_score,
+                                              collapse_duplicates, session)
     return results
 
 
+async def _response_etag(request: Request, db: DataBase, data_version=None, session=None) -> str:
+    """ETag of the data a response is built from: `data_version` when given, otherwise the write generation.
+
+    Analytics reads pass their `analytics_session`: the generation is then read from the same members
+    before the data, so a lagging secondary never serves older cars under the tag of newer ones.
+    """
+    if data_version is None:
+        data_version = await CarRepository(db).get_generation(session)
+    return etag_for((request.url.path, data_version), request.query_params.multi_items())
+
+
 @app.get('/cars/makes', response_model=dict[str, list[str]])
-async def get_car_makes(db: DataBase = Depends(get_database)):
-    repo = CarRepository(db)
-    data = await repo.get_makes_and_models()
+async def get_car_makes(request: Request, response: Response, db: DataBase = Depends(get_database)):
+    async with db.analytics_session() as session:
+        etag = await _response_etag(request, db, session=session)
+        if etag_matches(request.headers.get('if-none-match'), etag):
+            return not_modified_response(etag)
+        repo = CarRepository(db)
+        data = await repo.get_makes_and_models(session)
+    response.headers.update(cache_headers(etag))
     return data
 
 
@@ -60,119 +123,231 @@ async def get_grouped_cars(
         search_url: Optional[str] = Query(None, description="Search bar field from polovni automobili"),
         makes_to_include: Any = '{}',
         makes_to_exclude: Any = '{}',
+        text: Optional[str] = Query(None, description="Words that must occur in the ad description, "
+                                                      "quoted parts are matched as phrases"),
+        sort_by: Optional[str] = Query(None, pattern="^(deal_score|price|year)$",
+                                       description="Order of cars inside a group, deal_score puts best deals first"),
+        min_deal_score: Optional[float] = Query(None, description="Only cars priced at least this fraction below "
+                                                                  "their expected price"),
+        collapse_duplicates: bool = Query(False, description="Count re-posted and near-identical ads once"),
+        response_format: str = Query("full", alias="format", pattern="^(full|compact)$",
+                                     description="compact: one array per car field, dictionary encoded strings"),
+        request: Request = None,
         db: DataBase = Depends(get_database)):
-    parsed_url = urlparse(search_url)
-    if parsed_url.query:
-        query_params = dict((k, v if len(v) > 1 or k.endswith('[]') else v[0])
-                            for k, v in parse_qs(parsed_url.query).items())
-    else:
-        query_params = {}
-    query_params.update(
-        {'makes_to_include': json.loads(makes_to_include),
-         'makes_to_exclude': json.loads(makes_to_exclude)})
-    specifications = _uri_params_to_specs(query_params)
-    query = _mongo_query_from_specs(specifications)
-    grouped_data = await group_cars(db=db, group_by=group_by, min_count=min_count, data_filter=query)
-    return grouped_data
+    specifications = specs_from_search(search_url, json.loads(makes_to_include), json.loads(makes_to_exclude), text)
+    # the snapshot trails the primary, its responses are tagged with the snapshot's own version
+    served_by_snapshot = car_snapshot.can_answer(active_specs(specifications))
+    async with (nullcontext() if served_by_snapshot else db.analytics_session()) as session:
+        etag = await _response_etag(request, db, car_snapshot.data_version if served_by_snapshot else None, session)
+        if etag_matches(request.headers.get('if-none-match'), etag):
+            return not_modified_response(etag)
+        grouped_data = await group_cars(db=db, group_by=group_by, min_count=min_count,
+                                        specifications=specifications, sort_by=sort_by,
+                                        min_deal_score=min_deal_score, collapse_duplicates=collapse_duplicates,
+                                        session=session)
+    # cars are validated by the repository, the response model only documents the shape
+    content = to_compact_groups(grouped_data) if response_format == "compact" else grouped_data
+    return compressed_response(json_bytes(content), request.headers.get('accept-encoding'),
+                               headers=cache_headers(etag))
+
+
+@app.get("/cars/statistics", response_model=List[Dict[str, Any]])
+async def get_car_statistics(
+        request: Request,
+        response: Response,
+        group_by: List[str] = Query(["make", "model", "year"], description="Fields to group by: make, model, year"),
+        min_count: Optional[int] = Query(1),
+        search_url: Optional[str] = Query(None, description="Search bar field from polovni automobili"),
+        makes_to_include: Any = '{}',
+        makes_to_exclude: Any = '{}',
+        text: Optional[str] = Query(None, description="Words that must occur in the ad description, "
+                                                      "quoted parts are matched as phrases"),
+        db: DataBase = Depends(get_database)):
+    """Price percentiles, median price per km and year/mileage/power distributions per group.
+
+    Filters on make, model and year only are served from the precomputed rollups, any other filter
+    is computed from the matching cars.
+    """
+    if not set(group_by) <= {"make", "model", "year"}:
+        raise HTTPException(status_code=400, detail="Invalid group_by fields. Valid fields are: make, model, year")
+    query = mongo_query_from_specs(specs_from_search(search_url, json.loads(makes_to_include),
+                                                      json.loads(makes_to_exclude), text))
+    rollups = RollupRepository(db)
+    # rollups are read from the primary, other queries from the analytics read preference
+    from_rollups = rollups.can_answer(query)
+    async with (nullcontext() if from_rollups else db.analytics_session()) as session:
+        etag = await _response_etag(request, db, session=session)
+        if etag_matches(request.headers.get('if-none-match'), etag):
+            return not_modified_response(etag)
+        if from_rollups:
+            statistics = await rollups.get_statistics(group_by, query, min_count)
+        else:
+            columns = await CarRepository(db).get_columns(tuple(dict.fromkeys((*group_by, *STATISTICS_FIELDS))),
+                                                          query, session=session)
+            statistics = [group for group in grouped_stats_from_columns(columns, group_by)
+                          if group['count'] >= min_count]
+    response.headers.update(cache_headers(etag))
+    return statistics
+
+
+@app.get("/cars/export", response_class=StreamingResponse)
+async def export_cars(
+        export_format: str = Query("parquet", alias="format", pattern="^(parquet|arrow)$"),
+        search_url: Optional[str] = Query(None, description="Search bar field from polovni automobili"),
+        makes_to_include: Any = '{}',
+        makes_to_exclude: Any = '{}',
+        db: DataBase = Depends(get_database)):
+    """Cars as a Parquet file or Arrow IPC stream, written and sent batch by batch"""
+    from mongo.export import stream_export, EXPORT_FORMATS  # pyarrow is only loaded by the first export
 
+    query = mongo_query_from_specs(specs_from_search(search_url, json.loads(makes_to_include),
+                                                      json.loads(makes_to_exclude)))
+    media_type, extension = EXPORT_FORMATS[export_format]
+    return StreamingResponse(stream_export(db, export_format, query), media_type=media_type,
+                             headers={"Content-Disposition": f'attachment; filename="cars.{extension}"'})
 
-class ScrapeBody(BaseModel):
-    search_url: str
-    start_page: int = 1
-    max_pages: int = 1
 
+@app.get("/thumbnails/{digest}", response_class=FileResponse)
+async def get_thumbnail(digest: str):
+    if not re.fullmatch(r'[0-9a-f]{64}', digest) or not (path := await asyncio.to_thread(thumbnail_cache.get, digest)):
+        raise HTTPException(status_code=404, detail="Thumbnail not found")
+    # content-addressed: the file behind a digest never changes
+    return FileResponse(path, media_type=THUMBNAIL_MEDIA_TYPE,
+                        headers={"Cache-Control": "public, max-age=31536000, immutable"})
 
-def _to_snake_case(param: str) -> str:
-    if '_' not in param:
-        return re.sub(r'(?<!^)(?=[A-Z])', '_', param).lower()
-    return param
 
+class SavedSearchBody(BaseModel):
+    name: Optional[str] = None
+    search_url: Optional[str] = Field(None, description="Search bar field from polovni automobili")
+    makes_to_include: Dict[str, Optional[List[str]]] = {}
+    makes_to_exclude: Dict[str, Optional[List[str]]] = {}
+    text: Optional[str] = None
 
-@app.post("/ads", response_model=str, )
-async def scrape_ads_from_url(
-        body: ScrapeBody,
-        db: DataBase = Depends(get_database)):
-    await asyncio.create_task(scrape_all_pages(body.search_url, db, body.start_page))
-    # todo: feature request - create task id with possibility to track scrape completion
-    return "Scrape search started with id {}"
 
+def _saved_search_out(search: dict) -> dict:
+    return {**{key: value for key, value in search.items() if key != '_id'}, 'id': str(search['_id'])}
 
-def _uri_params_to_specs(query_params: dict) -> set[Specification] | None:
-    query_params = {_to_snake_case(param): value for param, value in query_params.items()}
 
-    price = DecimalRangeParameter('price', query_params.get('price_from'), query_params.get('price_to'))
-    year = DecimalRangeParameter('year', query_params.get('year_from'), query_params.get('year_to'))
+@app.post("/searches", response_model=Dict[str, Any])
+async def create_saved_search(body: SavedSearchBody, db: DataBase = Depends(get_database)):
+    specifications = saved_search_specs(body.model_dump())
+    search = await SavedSearchRepository(db).save_search(body.model_dump())
+    search_matcher.index.add(str(search['_id']), specifications)
+    return _saved_search_out(search)
 
-    power_kw = DecimalRangeParameter('engine_power', query_params.get('power_from'), query_params.get('power_to'))
 
-    engine_capacity = DecimalRangeParameter('engine_capacity', query_params.get('engine_volume_from'),
-                                            query_params.get('engine_volume_to'))
-    mileage = DecimalRangeParameter('mileage', query_params.get('mileage_from'), query_params.get('mileage_to'))
+@app.get("/searches", response_model=List[Dict[str, Any]])
+async def get_saved_searches(db: DataBase = Depends(get_database)):
+    return [_saved_search_out(search) for search in await SavedSearchRepository(db).get_searches()]
 
-    safety = [param for param in query_params if
-              param in safety_features_translation.values()]
-    safety = SubSetParameter('safety', safety)
 
-    options = [param for param in query_params if
-               param in additional_options_translation.values()]
-    options = SubSetParameter('options', options)
+@app.delete("/searches/{search_id}", response_model=str)
+async def delete_saved_search(search_id: str, db: DataBase = Depends(get_database)):
+    if not await SavedSearchRepository(db).delete_search(search_id):
+        raise HTTPException(status_code=404, detail="Saved search not found")
+    search_matcher.index.remove(search_id)
+    return search_id
 
-    condition = [param for param in query_params if
-                 param in condition_translation.values()]
-    condition = SubSetParameter('details', condition)
 
-    body_types = [body_type_codes.get(int(chassis)) for chassis in query_params.get('chassis[]', [])]
-    body_types = OneOfParameter("body_type", body_types)
+@app.get("/searches/{search_id}/events")
+async def saved_search_events(search_id: str, db: DataBase = Depends(get_database)):
+    """Server-Sent Events stream with a `match` event for every new or changed car matching the search"""
+    if not await SavedSearchRepository(db).get_search(search_id):
+        raise HTTPException(status_code=404, detail="Saved search not found")
 
-    fuel_type = [fuel_type_codes.get(int(fuel)) for fuel in query_params.get('fuel[]', [])]
-    fuel_type = OneOfParameter("fuel_type", fuel_type)
+    async def events():
+        queue = search_matcher.subscribe(search_id)
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), SSE_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: match\ndata: {json.dumps(event, default=str)}\n\n"
+        finally:
+            search_matcher.unsubscribe(search_id, queue)
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+class CrawlTargetBody(BaseModel):
+    search_url: str
+    priority: int = Field(1, description="Crawled first among targets due at the same time")
+    estimated_ads: Optional[int] = Field(None, description="Result size until the first crawl measures it")
 
-    gearbox = [gearbox_codes.get(int(gearbox)) for gearbox in query_params.get('gearbox[]', [])]
-    gearbox = OneOfParameter("transmission", gearbox)
 
-    wheel_side = (wheel_side_codes.get(int(query_params.get('wheel_side')))
-                  if query_params.get('wheel_side') else None)
-    wheel_side = SimpleParameter('steering_side', wheel_side)
-    car_1_make, car_1_models = query_params.get('brand'), query_params.get('model[]')
-    car_2_make, car_2_models = query_params.get('brand2'), query_params.get('model2[]')
-    query_params.get('makes_to_include').update({car_1_make: car_1_models, car_2_make: car_2_models})
-    make = MakeParameter(query_params.get('makes_to_include'), query_params.get('makes_to_exclude'))
+def _crawl_target_out(target: dict) -> dict:
+    return {**{key: value for key, value in target.items() if key != '_id'}, 'id': str(target['_id'])}
 
-    ac_type = [ac_type_codes.get(int(ac_code)) for ac_code in query_params.get('air_condition[]', [])]
-    ac_type = OneOfParameter('climate_control', ac_type)
 
-    damage = [condition_codes.get(int(condition_code)) for condition_code in query_params.get('damaged[]', [])]
-    damage = OneOfParameter('damage', damage)
+@scrape_router.post("/crawl/targets", response_model=Dict[str, Any])
+async def create_crawl_target(body: CrawlTargetBody, db: DataBase = Depends(get_database)):
+    target = await CrawlTargetRepository(db).save_target(body.search_url, body.priority, body.estimated_ads)
+    return _crawl_target_out(target)
 
-    emission_class = (emission_class_codes.get(int(query_params.get('emission_class')))
-                      if query_params.get('emission_class') else None)
-    emission_class = SimpleParameter('emission_class', emission_class)
 
-    interior_material = [interior_material_codes.get(int(int_m_code)) for int_m_code in
-                         query_params.get('interior_material[]', [])]
-    interior_material = OneOfParameter('interior_material', interior_material)
-    # todo: implement additional parameters for door count
-    model_filter = {price, year, power_kw, engine_capacity, mileage, safety, options, condition, body_types, fuel_type,
-                    gearbox, wheel_side, make, ac_type, damage, emission_class, interior_material}
-    return model_filter
+@scrape_router.get("/crawl/targets", response_model=List[Dict[str, Any]])
+async def get_crawl_targets(db: DataBase = Depends(get_database)):
+    return [_crawl_target_out(target) for target in await CrawlTargetRepository(db).get_targets()]
 
 
-def _mongo_query_from_specs(specifications: Iterable[Specification]):
-    query = {}
-    for spec in specifications:
-        try:
-            spec_query = spec.to_query()
-        except ValueError:
-            continue
-        for key, value in spec_query.items():
-            if key in query:
-                if isinstance(query[key], dict) and isinstance(value, dict):
-                    query[key].update(value)
-                elif isinstance(query[key], list) and isinstance(value, list):
-                    query[key].extend(value)
-            else:
-                query[key] = value
-    return query
+@scrape_router.delete("/crawl/targets/{target_id}", response_model=str)
+async def delete_crawl_target(target_id: str, db: DataBase = Depends(get_database)):
+    if not await CrawlTargetRepository(db).delete_target(target_id):
+        raise HTTPException(status_code=404, detail="Crawl target not found")
+    return target_id
+
+
+@scrape_router.get("/crawl/plan", response_model=List[Dict[str, Any]])
+async def get_crawl_plan(db: DataBase = Depends(get_database)):
+    """Registered targets in crawl order, with request estimates, TTL deadlines and latest start times"""
+    from scheduler import CrawlScheduler
+
+    return [{'search_url': crawl.search_url, 'requests': crawl.requests,
+             'deadline': datetime.datetime.fromtimestamp(crawl.deadline, datetime.timezone.utc),
+             'latest_start': datetime.datetime.fromtimestamp(crawl.latest_start, datetime.timezone.utc)}
+            for crawl in await CrawlScheduler(db).plan()]
+
+
+class ScrapeBody(BaseModel):
+    search_url: str
+    start_page: int = 1
+    max_pages: int = 1
+    profile: Optional[str] = Field(None, pattern="^(sampling|cprofile|off)$",
+                                   description="Profiler for this job: sampling, cprofile or off. "
+                                               "Defaults to SCRAPE_PROFILE")
+
+
+@scrape_router.post("/ads", response_model=str, )
+async def scrape_ads_from_url(
+        body: ScrapeBody,
+        db: DataBase = Depends(get_database)):
+    from main import run_scrape_job, run_scrape_job_in_thread
+    from scraping.profiling import profiling_enabled
+
+    job_id = uuid.uuid4().hex
+    if profiling_enabled(body.profile):
+        # a profiler on the event loop thread would also record every request served meanwhile
+        await asyncio.to_thread(run_scrape_job_in_thread, body.search_url, body.start_page, job_id, body.profile,
+                                body.max_pages)
+    else:
+        await asyncio.create_task(run_scrape_job(body.search_url, db, body.start_page, job_id, body.profile,
+                                                 body.max_pages))
+    # todo: feature request - possibility to track scrape completion by job id
+    return f"Scrape search started with id {job_id}"
+
+
+if not API_READ_ONLY:
+    app.include_router(scrape_router)
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Process counters in the Prometheus text format"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
 
 if __name__ == "__main__":
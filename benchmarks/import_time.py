@@ -0,0 +1,61 @@
+"""Cold import time of the entry points, measured in fresh interpreters with `python -X importtime`.
+
+    python benchmarks/import_time.py [--runs 5] [--top 10]
+
+Exits with status 1 when the read-only API imports any module of the scraping stack.
+"""
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+ENTRY_POINTS = {
+    'api (read-only)': ('api', {'API_READ_ONLY': '1'}),
+    'api': ('api', {}),
+    'scheduler': ('scheduler', {}),
+    'main (scraper)': ('main', {}),
+}
+SCRAPING_STACK = ('main', 'scheduler', 'requests', 'bs4', 'PIL', 'pyarrow', 'scraping.car_parser', 'scraping.sinks')
+_IMPORT_LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+
+def measure(module: str, env: dict[str, str]) -> dict[str, tuple[int, int]]:
+    """Self and cumulative import time in microseconds of every module imported by `import module`"""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], cwd=REPO_ROOT,
+                            env={**os.environ, **env}, capture_output=True, text=True)
+    if result.returncode:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr}")
+    timings = {}
+    for line in result.stderr.splitlines():
+        if match := _IMPORT_LINE.match(line):
+            self_us, cumulative_us, _, name = match.groups()
+            timings[name] = (int(self_us), int(cumulative_us))
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import time of the API and scraper entry points")
+    parser.add_argument('--runs', type=int, default=5, help="Fresh interpreters per entry point, the median is shown")
+    parser.add_argument('--top', type=int, default=10, help="Slowest modules listed per entry point")
+    args = parser.parse_args()
+
+    failed = False
+    for label, (module, env) in ENTRY_POINTS.items():
+        runs = [measure(module, env) for _ in range(args.runs)]
+        total_ms = statistics.median(timings[module][1] for timings in runs) / 1000
+        last = runs[-1]
+        print(f"{label}: {total_ms:.1f} ms, {len(last)} modules")
+        for name, (self_us, _) in sorted(last.items(), key=lambda item: -item[1][0])[:args.top]:
+            print(f"    {self_us / 1000:8.1f} ms  {name}")
+        if env.get('API_READ_ONLY') and (loaded := [name for name in SCRAPING_STACK if name in last]):
+            print(f"    read-only API imports the scraping stack: {', '.join(loaded)}")
+            failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
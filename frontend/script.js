@@ -14,6 +14,7 @@ async function fetchData() {
     const includeFilters = getFilters('include-filters');
     const excludeFilters = getFilters('exclude-filters');
     const searchUrl = document.getElementById('search-url').value;
+    const descriptionText = document.getElementById('description-text').value.trim();
 
     const url = new URL(`${baseUrl}/cars/grouped`);
     url.searchParams.append('min_count', minCount);
@@ -21,6 +22,7 @@ async function fetchData() {
         url.searchParams.append('group_by', groupBy[gb_param]);
     }
     url.searchParams.append('search_url', searchUrl);
+    url.searchParams.append('format', 'compact');
 
     if (includeFilters) {
         url.searchParams.append('makes_to_include', JSON.stringify(includeFilters));
@@ -31,6 +33,9 @@ async function fetchData() {
     if (searchUrl) {
         url.searchParams.append('search_url', searchUrl);
     }
+    if (descriptionText) {
+        url.searchParams.append('text', descriptionText);
+    }
 
     try {
         const response = await fetch(url);
@@ -38,12 +43,30 @@ async function fetchData() {
             throw new Error(`HTTP error! status: ${response.status}`);
         }
         const data = await response.json();
-        displayResults(data);
+        displayResults(decodeCompactGroups(data));
     } catch (error) {
         console.error('Failed to fetch data:', error);
     }
 }
 
+// Rebuilds car objects from the columnar `format=compact` response
+function decodeCompactGroups(data) {
+    const { columns, dictionaries, groups } = data;
+    return groups.map(group => {
+        const carCount = group.cars[columns[0]].length;
+        const cars = new Array(carCount);
+        for (let i = 0; i < carCount; i++) {
+            const car = {};
+            columns.forEach(column => {
+                const value = group.cars[column][i];
+                car[column] = dictionaries[column] ? dictionaries[column][value] : value;
+            });
+            cars[i] = car;
+        }
+        return { ...group, cars };
+    });
+}
+
 async function scrapeAndFetchData() {
     const searchUrl = document.getElementById('search-url').value;
 
@@ -196,7 +219,7 @@ function displayResults(groups) {
         groupDiv.appendChild(groupHeader);
 
         const img = document.createElement('img');
-        img.src = group.cars[0].img_src;
+        setCarImage(img, group.cars[0]);
         groupDiv.appendChild(img);
 
         const toggleButton = document.createElement('button');
@@ -206,7 +229,8 @@ function displayResults(groups) {
         const sortSelect = document.createElement('select');
         const sortOptions = [
             { value: 'year', text: 'Year' },
-            { value: 'price', text: 'Price' }
+            { value: 'price', text: 'Price' },
+            { value: 'deal_score', text: 'Deal score' }
         ];
         sortOptions.forEach(option => {
             const opt = document.createElement('option');
@@ -225,7 +249,10 @@ function displayResults(groups) {
 
         sortSelect.addEventListener('change', () => {
             const sortBy = sortSelect.value;
-            const sortedCars = [...group.cars].sort((a, b) => sortBy === 'price' ? a.price - b.price : a.year - b.year);
+            const sortedCars = [...group.cars].sort((a, b) => {
+                if (sortBy === 'deal_score') return (b.deal_score ?? -Infinity) - (a.deal_score ?? -Infinity);
+                return sortBy === 'price' ? a.price - b.price : a.year - b.year;
+            });
             updateCarList(carList, sortedCars);
         });
 
@@ -239,6 +266,20 @@ function displayResults(groups) {
     });
 }
 
+function setCarImage(img, car) {
+    const remoteSrc = car.img_src ? car.img_src.split(',')[0].trim().split(' ')[0] : '';
+    if (car.thumbnail) {
+        img.src = `${baseUrl}/thumbnails/${car.thumbnail}`;
+        // thumbnail may have been evicted from the cache
+        img.onerror = () => {
+            img.onerror = null;
+            img.src = remoteSrc;
+        };
+    } else {
+        img.src = remoteSrc;
+    }
+}
+
 function validateMakeSelections(containerId) {
     const makeSelects = document.querySelectorAll(`#${containerId} .make-select`);
     const selectedMakes = Array.from(makeSelects).map(select => select.value);
@@ -261,7 +302,8 @@ function updateCarList(carList, cars) {
         const carLink = document.createElement('a');
         carLink.href = "https://www.polovniautomobili.com" + car.link;
         carLink.target = "_blank";
-        carLink.innerText = `${car.make} ${car.model} - ${car.year} (${car.engine_capacity}cm3) - EUR ${car.price}`;
+        const deal = car.deal_score != null ? ` - ${Math.round(car.deal_score * 100)}% vs EUR ${car.expected_price}` : '';
+        carLink.innerText = `${car.make} ${car.model} - ${car.year} (${car.engine_capacity}cm3) - EUR ${car.price}${deal}`;
         carItem.appendChild(carLink);
         carList.appendChild(carItem);
     });
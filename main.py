@@ -1,52 +1,120 @@
+import argparse
 import asyncio
+import contextlib
+import json
+import os
 import random
 import re
 import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
 from urllib.parse import urlparse, parse_qs, urlencode
 
 import requests
 from bs4 import BeautifulSoup, Tag
 from requests import Response
 
-from mongo.car_repo import CarRepository
-from mongo.database import DataBase, get_database
+from mongo.database import DataBase, MONGODB_URL, get_database
 from scraping.car_parser import CarParser, CarAdvShortInfo
-from scraping.utilities import default_request_headers, strip_query_parameters, get_soup_from_response, logger
+from scraping.profiling import profile_job, profile_mode
+from scraping.sinks import CarSink, MongoSink, create_sink, SINKS, SINK_BATCH_SIZE
+from scraping.thumbnails import fetch_thumbnails, image_url_from_srcset
+from scraping.utilities import default_request_headers, strip_query_parameters, get_soup_from_response, \
+    get_html_from_response, logger
+
+SCRAPE_CONCURRENCY = int(os.getenv("SCRAPE_CONCURRENCY", 1))
+SCRAPE_RETRIES = int(os.getenv("SCRAPE_RETRIES", 5))
+AD_BASE_URL = 'https://www.polovniautomobili.com'
+STORED_ADS_MANIFEST = 'ads.jsonl'
 
 
 def get_with_retry(url, params=None, **kwargs):
+    """GET retried up to SCRAPE_RETRIES times on rate limiting and server errors, other responses are final"""
     result: Response = requests.get(url, params, **kwargs)
     time.sleep(random.uniform(0, 1))
-    retries = 5
-    while result.status_code != 200:
+    retries = SCRAPE_RETRIES
+    while retries > 0 and (result.status_code == 429 or result.status_code >= 500):
         result: Response = requests.get(url, params, **kwargs)
         time.sleep(random.uniform(1, 2))
         retries -= 1
     if result.status_code != 200:
-        logger.warning(f"Failed to retrieve the page. Page url: %s", url)
+        logger.warning("Failed to retrieve the page, status %s. Page url: %s", result.status_code, url)
     return result
 
 
-async def scrape_all_pages(car_list_url: str, db_connection: DataBase, start_page: int = 1):
+async def scrape_all_pages(car_list_url: str, db_connection: DataBase = None, start_page: int = 1,
+                           stats: dict = None, sink: CarSink = None, max_pages: int = None,
+                           concurrency: int = SCRAPE_CONCURRENCY, save_html: str = None):
+    """Scrapes every result page of a search into `sink` (MongoDB through `db_connection` by default).
+
+    `stats`, when given, receives pages, new_ads and total_ads. Raises requests.HTTPError when a
+    listing page cannot be fetched.
+    """
     page, cars_saved = start_page, 0
-    while True:
-        updated_url = update_page_number(car_list_url, page)
-        response = get_with_retry(updated_url, headers=default_request_headers())
-        if response.status_code != 200:
-            return
-        soup = get_soup_from_response(response)
-        prev_cars = cars_saved
-        cars_saved += await scrape_one_search_page(response.text, db_connection)
-
-        from_ad, to_ad, total_ads = await _get_ad_counter(soup)
-        if to_ad == total_ads:
-            break
-        logger.info("Scraped page #%s, added %s ads", page, cars_saved - prev_cars)
-        page += 1
-    logger.info("Scrape completed. Page scraped: %s, new ads: %s, total ads: %s", page, cars_saved, total_ads)
+    stats = {} if stats is None else stats
+    owns_sink = sink is None
+    sink = MongoSink(db_connection) if owns_sink else sink
+    started = time.perf_counter()
+    try:
+        while True:
+            updated_url = update_page_number(car_list_url, page)
+            response = get_with_retry(updated_url, headers=default_request_headers())
+            if response.status_code != 200:
+                # a crawl that could not read its listing must not count as done
+                raise requests.HTTPError(f"Listing page {updated_url} returned {response.status_code}",
+                                         response=response)
+            soup = get_soup_from_response(response)
+            prev_cars = cars_saved
+            cars_saved += await scrape_one_search_page(response.text, sink, concurrency, save_html)
+
+            from_ad, to_ad, total_ads = await _get_ad_counter(soup)
+            stats.update(pages=page - start_page + 1, new_ads=cars_saved, total_ads=total_ads)
+            if to_ad == total_ads or (max_pages and stats['pages'] >= max_pages):
+                break
+            logger.info("Scraped page #%s, added %s ads", page, cars_saved - prev_cars)
+            page += 1
+    finally:
+        await (sink.close() if owns_sink else sink.flush())
+    elapsed = time.perf_counter() - started
+    logger.info("Scrape completed. Page scraped: %s, new ads: %s, total ads: %s, %.2f new ads/s", page, cars_saved,
+                total_ads, cars_saved / elapsed if elapsed else 0)
     return cars_saved
 
 
+async def run_scrape_job(car_list_url: str, db_connection: DataBase, start_page: int = 1, job_id: str = None,
+                         profile: str = None, max_pages: int = None):
+    """Runs `scrape_all_pages` as a job, profiled when `profile` (or SCRAPE_PROFILE) asks for it"""
+    job_id = job_id or uuid.uuid4().hex
+    with profile_job(job_id, profile):
+        return await scrape_all_pages(car_list_url, db_connection, start_page, max_pages=max_pages,
+                                      concurrency=_profiled_concurrency(SCRAPE_CONCURRENCY, profile))
+
+
+def _profiled_concurrency(concurrency: int, profile: str | None) -> int:
+    """cProfile only sees the job thread, so profiled ad pages are then fetched and parsed on it"""
+    if concurrency > 1 and profile_mode(profile) == "cprofile":
+        logger.info("Profiling with cProfile, ad pages are scraped one at a time on the job thread")
+        return 1
+    return concurrency
+
+
+def run_scrape_job_in_thread(car_list_url: str, start_page: int = 1, job_id: str = None, profile: str = None,
+                             max_pages: int = None):
+    """Runs a scrape job with its own event loop and client, meant for `asyncio.to_thread`.
+
+    The profiler of the job then sees only the job, not the API requests served next to it.
+    """
+    async def job():
+        db_connection = DataBase(MONGODB_URL)
+        await db_connection.connect()
+        try:
+            return await run_scrape_job(car_list_url, db_connection, start_page, job_id, profile, max_pages)
+        finally:
+            await db_connection.disconnect()
+
+    return asyncio.run(job())
+
+
 async def _get_ad_counter(soup: Tag) -> tuple[int, int, int]:
     text = soup.find(class_='js-hide-on-filter').find_next('small').text
     pattern = r'\d+'
@@ -57,41 +125,103 @@ async def _get_ad_counter(soup: Tag) -> tuple[int, int, int]:
     return from_ad, to_ad, total_ads
 
 
-async def scrape_one_search_page(response_text, db_connection):
-    repo = CarRepository(db_connection)
+async def scrape_one_search_page(response_text, sink: CarSink, concurrency: int = SCRAPE_CONCURRENCY,
+                                 save_html: str = None):
     soup = BeautifulSoup(response_text, 'html.parser')
     ad_pattern = re.compile(r'classified ad-\d+.*')
     ad_number_pattern = r'/auto-oglasi/(\d+)/'
 
     ads = soup.find_all('article', class_=lambda x: x and ad_pattern.search(x) and 'uk-hidden' not in x)
-    cars_counter = 0
-    cars_to_update = []
+    car_ads = []
     for ad in ads:
         link_tag = ad.find('a', class_='firstImage')
         car_link = strip_query_parameters(link_tag['href'])
         img_tag = link_tag.find('img', class_='lazy lead')
         match = re.search(ad_number_pattern, car_link)
-        ad_number = int(match.group(1))
-        car_info = CarAdvShortInfo(
-            ad_number=ad_number,
+        car_ads.append(CarAdvShortInfo(
+            ad_number=int(match.group(1)),
             ad_link=car_link,
-            img_link=img_tag['data-srcset'] if img_tag else None)
+            img_link=img_tag['data-srcset'] if img_tag else None))
 
-        if car_link and not await repo.get_car(ad_number):
-            car_url = 'https://www.polovniautomobili.com' + car_link
-            response = get_with_retry(car_url, headers=default_request_headers())
+    existing_cars = await sink.known_cars([car_info.ad_number for car_info in car_ads])
+    new_ads = [car_info for car_info in car_ads if car_info.ad_link and car_info.ad_number not in existing_cars]
+    cars_to_update = [car_info for car_info in car_ads if car_info not in new_ads]
+    if concurrency > 1:
+        semaphore = asyncio.Semaphore(concurrency)
 
-            parser = CarParser(car_info, get_soup_from_response(response))
-            try:
-                await repo.save_car(parser.get_car_details())
-            except Exception as e:
-                logger.exception("Unhandled error parsing ad #%s. %s", ad_number, e)
-            cars_counter += 1
-        else:
-            cars_to_update.append(car_info)
+        async def fetch(car_info: CarAdvShortInfo):
+            async with semaphore:
+                return await asyncio.to_thread(fetch_car_details, car_info, save_html)
 
-    await repo.update_short_car_info(cars_to_update, db_connection)
-    return cars_counter
+        new_cars = await asyncio.gather(*map(fetch, new_ads))
+    else:
+        new_cars = [fetch_car_details(car_info, save_html) for car_info in new_ads]
+    for car in new_cars:
+        if car:
+            await sink.write(car)
+    if save_html:
+        with open(os.path.join(save_html, STORED_ADS_MANIFEST), 'a', encoding='utf-8') as manifest:
+            manifest.writelines(car_info.model_dump_json() + '\n' for car_info in new_ads)
+
+    thumbnails_to_fetch = {}
+    if sink.stores_thumbnails:
+        for car_info in car_ads:
+            existing_car = existing_cars.get(car_info.ad_number)
+            if (not existing_car or not existing_car.get('thumbnail')) and (
+                    image_url := image_url_from_srcset(car_info.img_link)):
+                thumbnails_to_fetch[car_info.ad_number] = image_url
+
+    await sink.update_short_info(cars_to_update)
+    if thumbnails_to_fetch:
+        await sink.set_thumbnails(await fetch_thumbnails(thumbnails_to_fetch))
+    return len(new_ads)
+
+
+def fetch_car_details(car_info: CarAdvShortInfo, save_html: str = None) -> dict | None:
+    """Fetches and parses one ad page, storing the page in the `save_html` directory when given"""
+    response = get_with_retry(AD_BASE_URL + car_info.ad_link, headers=default_request_headers())
+    html = get_html_from_response(response)
+    if save_html:
+        with open(os.path.join(save_html, f"{car_info.ad_number}.html"), 'wb') as file:
+            file.write(html if isinstance(html, bytes) else html.encode('utf-8'))
+    return parse_car_details(car_info, html)
+
+
+def parse_car_details(car_info: CarAdvShortInfo, html: bytes | str) -> dict | None:
+    try:
+        return CarParser(car_info, BeautifulSoup(html, 'html.parser')).get_car_details()
+    except Exception as e:
+        logger.exception("Unhandled error parsing ad #%s. %s", car_info.ad_number, e)
+
+
+def _parse_stored_ad(html_dir: str, stored_ad: dict) -> dict | None:
+    car_info = CarAdvShortInfo(**stored_ad)
+    with open(os.path.join(html_dir, f"{car_info.ad_number}.html"), 'rb') as file:
+        return parse_car_details(car_info, file.read())
+
+
+async def parse_stored_ads(html_dir: str, sink: CarSink, processes: int = 1) -> int:
+    """Parses the ad pages stored by `save_html` into `sink`, without any requests. Returns the cars parsed"""
+    with open(os.path.join(html_dir, STORED_ADS_MANIFEST), encoding='utf-8') as manifest:
+        stored_ads = list({ad['ad_number']: ad for ad in map(json.loads, filter(str.strip, manifest))}.values())
+    loop = asyncio.get_running_loop()
+    started, parsed = time.perf_counter(), 0
+    # a single process parses in this thread, where the profilers see it
+    with ProcessPoolExecutor(processes) if processes > 1 else contextlib.nullcontext() as pool:
+        for batch_start in range(0, len(stored_ads), sink.batch_size):
+            batch = stored_ads[batch_start:batch_start + sink.batch_size]
+            if pool:
+                cars = await asyncio.gather(*(loop.run_in_executor(pool, _parse_stored_ad, html_dir, ad)
+                                              for ad in batch))
+            else:
+                cars = [_parse_stored_ad(html_dir, ad) for ad in batch]
+            for car in filter(None, cars):
+                await sink.write(car)
+                parsed += 1
+            elapsed = time.perf_counter() - started
+            logger.info("Parsed %s/%s stored ads, %.1f ads/s", parsed, len(stored_ads), parsed / elapsed)
+    await sink.flush()
+    return parsed
 
 
 def update_page_number(url, new_page_number):
@@ -103,15 +233,44 @@ def update_page_number(url, new_page_number):
 
 
 async def main():
-    search_url = ("https://www.polovniautomobili.com/auto-oglasi/pretraga?brand=&brand2=&price_from=&price_to=8000"
-                  "&year_from=&year_to=&fuel%5B%5D=45&fuel%5B%5D=2309&flywheel=&atest=&door_num=&submit_1"
-                  "=&without_price=1&date_limit=&showOldNew=all&modeltxt=&engine_volume_from=1600&engine_volume_to"
-                  "=&power_from=&power_to=&mileage_from=&mileage_to=&emission_class=&gearbox%5B%5D=3212&gearbox%5B%5D"
-                  "=10795&seat_num=&wheel_side=&registration=&country=&country_origin=&city=&damaged%5B%5D=3799"
-                  "&registration_price=&appleCarPlay=1&page=&sort=")
-    db_connection = await get_database()
-
-    await scrape_all_pages(search_url, db_connection)
+    parser = argparse.ArgumentParser(description="Scrape polovni automobili search results into MongoDB, "
+                                                 "a JSON lines file or stdout")
+    parser.add_argument('search_url', nargs='?', help="Search results url")
+    parser.add_argument('--html-dir', help="Parse the ad pages stored by --save-html instead of fetching, "
+                                           "to measure parse throughput")
+    parser.add_argument('--sink', choices=SINKS, default='mongo')
+    parser.add_argument('--output', help="Output file of the jsonl sink")
+    parser.add_argument('--batch-size', type=int, default=SINK_BATCH_SIZE, help="Cars per sink write")
+    parser.add_argument('--start-page', type=int, default=1)
+    parser.add_argument('--max-pages', type=int, help="Stop after this many result pages")
+    parser.add_argument('--concurrency', type=int, default=SCRAPE_CONCURRENCY,
+                        help="Ad pages fetched and parsed at the same time")
+    parser.add_argument('--processes', type=int, default=os.cpu_count(), help="Parser processes with --html-dir")
+    parser.add_argument('--save-html', help="Directory to store the fetched ad pages in")
+    parser.add_argument('--profile', choices=('sampling', 'cprofile', 'off'),
+                        help="Profiler for this run, defaults to SCRAPE_PROFILE")
+    args = parser.parse_args()
+    if not args.search_url and not args.html_dir:
+        parser.error("a search url or --html-dir is required")
+    if args.sink == 'jsonl' and not args.output:
+        parser.error("--sink jsonl requires --output")
+    if args.save_html:
+        os.makedirs(args.save_html, exist_ok=True)
+
+    db_connection = await get_database() if args.sink == 'mongo' else None
+    started = time.perf_counter()
+    with profile_job(uuid.uuid4().hex, args.profile):
+        async with create_sink(args.sink, db_connection, args.output, args.batch_size) as sink:
+            if args.html_dir:
+                await parse_stored_ads(args.html_dir, sink, args.processes)
+            else:
+                await scrape_all_pages(args.search_url, db_connection, args.start_page, sink=sink,
+                                       max_pages=args.max_pages,
+                                       concurrency=_profiled_concurrency(args.concurrency, args.profile),
+                                       save_html=args.save_html)
+    elapsed = time.perf_counter() - started
+    logger.info("Wrote %s cars to the %s sink in %.1fs, %.1f cars/s", sink.written, args.sink, elapsed,
+                sink.written / elapsed if elapsed else 0)
 
 
 if __name__ == "__main__":
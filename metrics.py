@@ -0,0 +1,25 @@
+"""Process-wide counters, served by the API at /metrics in the Prometheus text format."""
+from collections import Counter
+
+counters: Counter[str] = Counter()
+
+COUNTER_HELP = {
+    'car_documents_invalid_total': "Car documents dropped from responses because they failed validation",
+    'car_documents_coerced_total': "Car documents that needed type coercion to be served",
+    'export_values_coerced_total': "Values converted to the type of the export schema",
+    'export_rows_skipped_total': "Cars left out of exports because a value did not fit the export schema",
+}
+
+
+def increment(name: str, amount: int = 1):
+    counters[name] += amount
+
+
+def render() -> str:
+    lines = []
+    for name in sorted(COUNTER_HELP.keys() | counters.keys()):
+        if name in COUNTER_HELP:
+            lines.append(f"# HELP {name} {COUNTER_HELP[name]}")
+        lines.append(f"# TYPE {name} counter")
+        lines.append(f"{name} {counters[name]}")
+    return '\n'.join(lines) + '\n'
@@ -1,12 +1,19 @@
 import datetime
-from typing import Optional
+import math
+from typing import Optional, TYPE_CHECKING
 
 from bson import ObjectId
-from pydantic import BaseModel
-from pymongo import UpdateOne
+from pydantic import BaseModel, ValidationError
+from pymongo import UpdateOne, ReplaceOne
 
+import metrics
+from analytics.deal_scoring import score_cars, SCORING_FEATURES, COHORT_FIELDS
 from mongo.database import DataBase, db_logger
-from scraping.car_parser import CarAdvShortInfo
+from mongo.rollups import RollupRepository, ROLLUP_SOURCE_FIELDS
+from scraping.minhash import estimated_similarity, can_join_cluster, DUPLICATE_THRESHOLD, DUPLICATE_SPEC_FIELDS
+
+if TYPE_CHECKING:
+    from scraping.car_parser import CarAdvShortInfo
 
 
 class CarForGroup(BaseModel):
@@ -19,6 +26,10 @@ class CarForGroup(BaseModel):
     price: int
     engine_power: int
     engine_capacity: int
+    thumbnail: Optional[str] = None
+    deal_score: Optional[float] = None
+    expected_price: Optional[int] = None
+    duplicate_count: Optional[int] = None
 
     class Config:
         arbitrary_types_allowed = True
@@ -27,37 +38,179 @@ class CarForGroup(BaseModel):
         }
 
 
+GROUP_SORT_FIELDS = {'deal_score': -1, 'price': 1, 'year': 1}
+# the only fields pushed into groups, so large groups do not carry whole ads through the pipeline
+GROUP_CAR_FIELDS = ('link', 'img_src', 'thumbnail', 'make', 'model', 'year', 'price', 'engine_power',
+                    'engine_capacity', 'deal_score', 'expected_price')
+_REQUIRED_GROUP_FIELDS = {'make': str, 'model': str, 'year': int, 'price': int, 'engine_power': int,
+                          'engine_capacity': int}
+
+
 class CarRepository:
 
     def __init__(self, db: DataBase):
         self.db = db
 
     async def save_car(self, car_details: dict):
-        await self.db.car_collection.replace_one(
-            filter={'ad_number': car_details['ad_number']},
-            replacement=car_details,
-            upsert=True
-        )
-        db_logger.debug('Saved new car, ad #%s', car_details['ad_number'])
+        await self.save_cars([car_details])
+
+    async def save_cars(self, cars: list[dict]):
+        """Saves a batch of cars in a fixed number of round trips, whatever the batch size.
+
+        Previous versions are read before the bulk replace, not atomically with it: a car saved by two
+        processes at once is off in the rollups until their next rebuild.
+        """
+        for car, cluster_id in zip(cars, await self.find_duplicate_clusters(cars)):
+            car['cluster_id'] = cluster_id
+        stored = self.db.car_collection.find({'ad_number': {'$in': [car['ad_number'] for car in cars]}},
+                                             {'ad_number': 1, **{field: 1 for field in ROLLUP_SOURCE_FIELDS}})
+        latest = {car['ad_number']: car async for car in stored}
+        changes = []
+        for car in cars:
+            changes.append((latest.get(car['ad_number']), car))
+            latest[car['ad_number']] = car
+        # ordered, an ad listed twice in a batch ends up as its last version
+        await self.db.car_collection.bulk_write(
+            [ReplaceOne({'ad_number': car['ad_number']}, car, upsert=True) for car in cars])
+        await RollupRepository(self.db).apply_many(changes)
+        await self.bump_generation()
+        db_logger.debug('Saved %s cars, ad #%s to #%s', len(cars), cars[0]['ad_number'], cars[-1]['ad_number'])
+
+    async def find_duplicate_cluster(self, car_details: dict, max_candidates: int = 50) -> int:
+        """Cluster of the most similar already stored car, or a new cluster named after the car's ad number.
+
+        Candidates come from the multikey index on `lsh_bands` and must have the same specs, only cars
+        with enough description text join an existing cluster.
+        """
+        if not car_details.get('lsh_bands') or not can_join_cluster(car_details.get('description')):
+            return car_details['ad_number']
+        cursor = self.db.car_collection.find(
+            {'lsh_bands': {'$in': car_details['lsh_bands']}, 'ad_number': {'$ne': car_details['ad_number']},
+             **{field: car_details.get(field) for field in DUPLICATE_SPEC_FIELDS}},
+            {'_id': 0, 'ad_number': 1, 'cluster_id': 1, 'minhash': 1}
+        ).limit(max_candidates)
+        return self._most_similar_cluster(car_details, await cursor.to_list(length=None))
+
+    async def find_duplicate_clusters(self, cars: list[dict], max_candidates: int = 50) -> list[int]:
+        """`find_duplicate_cluster` of every car of a batch, with the stored candidates read in one query.
+
+        Earlier cars of the batch are candidates of later ones, as if the cars were saved one by one.
+        """
+        joining = [car for car in cars if car.get('lsh_bands') and can_join_cluster(car.get('description'))]
+        candidates = {}  # ad number -> latest version
+        if joining:
+            cursor = self.db.car_collection.find(
+                {'lsh_bands': {'$in': list({band for car in joining for band in car['lsh_bands']})}},
+                {'_id': 0, 'ad_number': 1, 'cluster_id': 1, 'minhash': 1, 'lsh_bands': 1,
+                 **{field: 1 for field in DUPLICATE_SPEC_FIELDS}}
+            ).limit(max_candidates * len(joining))
+            candidates = {candidate['ad_number']: candidate async for candidate in cursor}
+        joining_ids = {id(car) for car in joining}
+        cluster_ids = []
+        for car in cars:
+            cluster_id = car['ad_number']
+            if id(car) in joining_ids:
+                bands = set(car['lsh_bands'])
+                similar = [candidate for candidate in candidates.values()
+                           if candidate['ad_number'] != car['ad_number']
+                           and not bands.isdisjoint(candidate.get('lsh_bands') or ())
+                           and all(candidate.get(field) == car.get(field) for field in DUPLICATE_SPEC_FIELDS)]
+                cluster_id = self._most_similar_cluster(car, similar[:max_candidates])
+            cluster_ids.append(cluster_id)
+            candidates[car['ad_number']] = {**car, 'cluster_id': cluster_id}
+        return cluster_ids
 
     @staticmethod
-    def car_from_mongo(document: dict) -> CarForGroup:
-        document["id"] = str(document.pop("_id"))
-        document['options'] = [option for option in document.get('options', []) if option is not None]
+    def _most_similar_cluster(car_details: dict, candidates: list[dict]) -> int:
+        cluster_id = car_details['ad_number']
+        for candidate in candidates:
+            if estimated_similarity(car_details['minhash'], candidate.get('minhash', [])) >= DUPLICATE_THRESHOLD:
+                cluster_id = min(cluster_id, candidate.get('cluster_id') or candidate['ad_number'])
+        return cluster_id
+
+    async def bump_generation(self):
+        """Marks the car collection as changed. Every write path calls it after writing"""
+        await self.db.meta_collection.update_one({'_id': 'cars'}, {'$inc': {'generation': 1}}, upsert=True)
+
+    async def get_generation(self, session=None) -> tuple[int, int]:
+        """Write generation of the car collection and its estimated size.
+
+        The size catches documents removed by the TTL index, which no write path sees. With the
+        `analytics_session` of an analytics read both are read like the cars, through the analytics
+        read preference in that session.
+        """
+        if session is None:
+            meta = await self.db.meta_collection.find_one({'_id': 'cars'})
+            count = await self.db.car_collection.estimated_document_count()
+            return (meta or {}).get('generation', 0), count
+        meta = await self.db.analytics_meta_collection.find_one({'_id': 'cars'}, session=session)
+        # estimated_document_count takes no session, a count without query reads the same collection metadata
+        result = await self.db.database.command({'count': self.db.analytics_collection.name}, session=session,
+                                                read_preference=self.db.analytics_collection.read_preference)
+        return (meta or {}).get('generation', 0), result['n']
+
+    @staticmethod
+    def car_from_mongo(document: dict) -> dict | None:
+        """JSON ready car of a group, validated once against CarForGroup.
+
+        Documents with exactly the expected types (everything the scraper writes) are passed through,
+        others are coerced by the model or counted as invalid and dropped.
+        """
+        car = {field: document.get(field) for field in GROUP_CAR_FIELDS}
+        car['id'] = str(document['_id'])
+        if document.get('duplicate_count') is not None:
+            car['duplicate_count'] = document['duplicate_count']
+        if all(type(car[field]) is field_type for field, field_type in _REQUIRED_GROUP_FIELDS.items()):
+            return car
         try:
-            return CarForGroup(**document)
-        except Exception as e:
-            print(e)
+            car = CarForGroup(**car).model_dump()
+        except ValidationError as e:
+            metrics.increment('car_documents_invalid_total')
+            db_logger.debug('Invalid car document %s. %s', car['id'], e)
+            return None
+        metrics.increment('car_documents_coerced_total')
+        return car
 
     async def get_car(self, ad_number: int) -> dict:
         return await self.db.car_collection.find_one({'ad_number': ad_number})
 
-    async def get_grouped_data(self, group_by: list, data_filter: dict, min_count: int = 1):
+    async def get_known_cars(self, ad_numbers: list[int]) -> dict[int, dict]:
+        """Ad number and thumbnail of the stored cars among `ad_numbers`, in one query"""
+        cursor = self.db.car_collection.find({'ad_number': {'$in': ad_numbers}}, {'ad_number': 1, 'thumbnail': 1})
+        return {car['ad_number']: car async for car in cursor}
+
+    async def get_grouped_data(self, group_by: list, data_filter: dict, min_count: int = 1, sort_by: str = None,
+                               min_deal_score: float = None, collapse_duplicates: bool = False, session=None):
+        """Cars grouped by `group_by`. Cars inside a group are ordered by `sort_by` (best deals first for
+        deal_score), `min_deal_score` keeps only cars scored at least that high. With `collapse_duplicates`
+        only the most recently updated ad of every duplicate cluster is kept"""
         group_id = {field: f"${field}" for field in group_by}
         pipeline = []
+        if min_deal_score is not None:
+            data_filter = {**(data_filter or {}), 'deal_score': {'$gte': min_deal_score}}
         if data_filter:
             pipeline.append({"$match": data_filter})
+        # only what the groups carry goes through the pipeline, large groups and collapsing sorts
+        # would otherwise move whole ads (description, minhash) and run into the stage memory limit
+        group_fields = dict.fromkeys((*GROUP_CAR_FIELDS, *group_by))
+        if collapse_duplicates:
+            pipeline.extend([
+                {"$project": {field: 1 for field in (*group_fields, 'ad_number', 'cluster_id', 'updatedAt')}},
+                {"$sort": {"updatedAt": -1}},
+                {
+                    "$group": {
+                        "_id": {"$ifNull": ["$cluster_id", "$ad_number"]},
+                        "car": {"$first": "$$ROOT"},
+                        "duplicate_count": {"$sum": 1}
+                    }
+                },
+                {"$addFields": {"car.duplicate_count": "$duplicate_count"}},
+                {"$replaceRoot": {"newRoot": "$car"}}
+            ])
+        if sort_by:
+            pipeline.append({"$sort": {sort_by: GROUP_SORT_FIELDS[sort_by]}})
         pipeline.extend([
+            {"$project": {field: 1 for field in (*group_fields, 'duplicate_count')}},
             {
                 "$group": {
                     "_id": group_id,
@@ -80,12 +233,27 @@ class CarRepository:
             }
         ])
         grouped_data = []
-        async for group in self.db.car_collection.aggregate(pipeline):
-            group["cars"] = [self.car_from_mongo(car) for car in group["cars"]]
+        async for group in self.db.analytics_collection.aggregate(pipeline, allowDiskUse=True, session=session):
+            group["cars"] = [car for car in map(self.car_from_mongo, group["cars"]) if car is not None]
             grouped_data.append(group)
         return grouped_data
 
-    async def get_makes_and_models(self) -> dict[str, list[str]]:
+    async def get_columns(self, fields: tuple[str, ...], data_filter: dict, primary: bool = False,
+                          session=None) -> dict[str, list]:
+        """Values of `fields` of all cars matching `data_filter`, one list per field.
+
+        Write paths pass `primary` to read their own writes instead of a possibly lagging secondary.
+        """
+        columns = {field: [] for field in fields}
+        collection = self.db.car_collection if primary else self.db.analytics_collection
+        cursor = collection.find(data_filter or {}, {'_id': 0, **{field: 1 for field in fields}}, batch_size=5000,
+                                 session=session)
+        async for car in cursor:
+            for field in fields:
+                columns[field].append(car.get(field))
+        return columns
+
+    async def get_makes_and_models(self, session=None) -> dict[str, list[str]]:
         pipeline = [
             {
                 "$group": {
@@ -102,12 +270,12 @@ class CarRepository:
             }
         ]
 
-        aggregation_result = await self.db.car_collection.aggregate(pipeline).to_list(length=None)
+        aggregation_result = await self.db.analytics_collection.aggregate(pipeline, session=session).to_list(length=None)
 
         result = {item['make']: item['models'] for item in aggregation_result}
         return result
 
-    async def update_short_car_info(self, old_car_ads: list[CarAdvShortInfo], db: DataBase):
+    async def update_short_car_info(self, old_car_ads: list['CarAdvShortInfo'], db: DataBase):
         operations = []
         for car_ad in old_car_ads:
             filter_query = {"ad_number": car_ad.ad_number}
@@ -121,5 +289,38 @@ class CarRepository:
 
         if operations:
             result = await self.db.car_collection.bulk_write(operations)
+            if result.modified_count:
+                await self.bump_generation()
             db_logger.debug('Updated %s records', len(operations))
             return result.bulk_api_result
+
+    async def set_thumbnails(self, thumbnails: dict[int, str]):
+        operations = [UpdateOne({"ad_number": ad_number}, {"$set": {"thumbnail": digest}})
+                      for ad_number, digest in thumbnails.items()]
+        if operations:
+            result = await self.db.car_collection.bulk_write(operations)
+            if result.modified_count:
+                await self.bump_generation()
+            db_logger.debug('Set thumbnails for %s records', len(operations))
+            return result.bulk_api_result
+
+    async def update_deal_scores(self) -> int:
+        """Refits the price model of every make/model cohort and stores expected price and deal score per car"""
+        fields = ('ad_number', 'price', 'deal_score', *COHORT_FIELDS, *SCORING_FEATURES)
+        columns = await self.get_columns(fields, {}, primary=True)
+        expected_prices, scores = score_cars(columns)
+        operations = []
+        for ad_number, old_score, expected_price, score in zip(columns['ad_number'], columns['deal_score'],
+                                                                expected_prices.tolist(), scores.tolist()):
+            if math.isnan(score):
+                if old_score is not None:
+                    operations.append(UpdateOne({'ad_number': ad_number},
+                                                {'$unset': {'deal_score': '', 'expected_price': ''}}))
+            elif old_score is None or abs(old_score - score) >= 0.001:
+                operations.append(UpdateOne({'ad_number': ad_number}, {'$set': {
+                    'deal_score': round(score, 4), 'expected_price': round(expected_price)}}))
+        if operations:
+            await self.db.car_collection.bulk_write(operations, ordered=False)
+            await self.bump_generation()
+        db_logger.info('Scored %s cars, updated %s', len(columns['ad_number']), len(operations))
+        return len(operations)
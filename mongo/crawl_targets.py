@@ -0,0 +1,70 @@
+import datetime
+
+from bson import ObjectId
+from pymongo import ReturnDocument
+
+from mongo.database import DataBase, db_logger
+from mongo.leases import LeaseRepository
+
+LEASE_ID = 'crawl_scheduler'
+
+
+class CrawlTargetRepository:
+    """Search urls the scheduler keeps fresh, with their priority and result size estimates"""
+
+    def __init__(self, db: DataBase):
+        self.db = db
+
+    async def save_target(self, search_url: str, priority: int = 1, estimated_ads: int = None) -> dict:
+        target = {
+            'search_url': search_url,
+            'priority': priority,
+            'createdAt': datetime.datetime.now(datetime.timezone.utc),
+        }
+        if estimated_ads is not None:
+            target['estimated_ads'] = estimated_ads
+        result = await self.db.crawl_target_collection.find_one_and_update(
+            {'search_url': search_url},
+            {'$set': {key: value for key, value in target.items() if key != 'createdAt'},
+             '$setOnInsert': {'createdAt': target['createdAt']}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        db_logger.debug('Saved crawl target %s', search_url)
+        return result
+
+    async def get_targets(self) -> list[dict]:
+        return await self.db.crawl_target_collection.find().to_list(length=None)
+
+    async def delete_target(self, target_id: str) -> bool:
+        if not ObjectId.is_valid(target_id):
+            return False
+        result = await self.db.crawl_target_collection.delete_one({'_id': ObjectId(target_id)})
+        return result.deleted_count > 0
+
+    async def record_crawl(self, target_id: ObjectId, started_at: datetime.datetime, stats: dict):
+        update = {'last_crawled_at': started_at, 'last_attempt_at': started_at, 'last_new_ads': stats.get('new_ads', 0)}
+        if stats.get('total_ads') is not None:
+            update['estimated_ads'] = stats['total_ads']
+        await self.db.crawl_target_collection.update_one(
+            {'_id': target_id}, {'$set': update, '$unset': {'failures': '', 'retry_after': '', 'last_error': ''}})
+
+    async def record_failure(self, target_id: ObjectId, started_at: datetime.datetime,
+                             retry_after: datetime.datetime, error: str):
+        """Counts a failed crawl, the scheduler does not retry the target before `retry_after`"""
+        await self.db.crawl_target_collection.update_one({'_id': target_id}, {
+            '$set': {'last_attempt_at': started_at, 'retry_after': retry_after, 'last_error': error},
+            '$inc': {'failures': 1}})
+
+    async def acquire_lease(self, owner: str, seconds: float) -> dict | None:
+        """Takes or renews the scheduler lease for `seconds`, returns the lease when `owner` holds it.
+
+        Only the holder crawls, so several schedulers (API workers, scheduler.py) never crawl the same
+        target twice or spend the request budget more than once.
+        """
+        return await LeaseRepository(self.db).acquire(LEASE_ID, owner, seconds)
+
+    async def save_budget(self, owner: str, tokens: float, saved_at: float):
+        """Stores the request budget with the lease, so the next holder continues from it"""
+        await self.db.meta_collection.update_one({'_id': LEASE_ID, 'owner': owner},
+                                                 {'$set': {'budget_tokens': tokens, 'budget_saved_at': saved_at}})
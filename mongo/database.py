@@ -1,7 +1,10 @@
+import asyncio
+import contextlib
 import logging
 import os
 
 from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorCollection
+from pymongo.read_preferences import read_pref_mode_from_name, make_read_preference
 
 formatter = logging.Formatter(fmt='%(asctime)s %(levelname)s %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
 
@@ -27,31 +30,96 @@ if not MONGODB_URL:
     else:
         MONGODB_URL = f"mongodb://{MONGO_HOST}:{MONGO_PORT}/{MONGO_DB}"
 
+CAR_TTL_SECONDS = int(os.getenv("CAR_TTL_SECONDS", 7 * 24 * 60 * 60))  # cars not seen by a crawl for this long expire
+
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", 100))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", 10))
+MONGO_MAX_IDLE_TIME_MS = int(os.getenv("MONGO_MAX_IDLE_TIME_MS", 5 * 60 * 1000))
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", 5000))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000))
+MONGO_SOCKET_TIMEOUT_MS = int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", 30000))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", 10000))
+# reads that tolerate replication lag (grouping, statistics) may go to secondaries
+MONGO_ANALYTICS_READ_PREFERENCE = os.getenv("MONGO_ANALYTICS_READ_PREFERENCE", "secondaryPreferred")
+
 
 class DataBase:
     def __init__(self, mongodb_url: str):
         self.car_collection: AsyncIOMotorCollection | None = None
+        # car collection for analytics reads, routed by MONGO_ANALYTICS_READ_PREFERENCE
+        self.analytics_collection: AsyncIOMotorCollection | None = None
+        self.meta_collection: AsyncIOMotorCollection | None = None
+        # meta collection read alongside analytics reads, same read preference
+        self.analytics_meta_collection: AsyncIOMotorCollection | None = None
+        self.rollup_collection: AsyncIOMotorCollection | None = None
+        self.saved_search_collection: AsyncIOMotorCollection | None = None
+        self.crawl_target_collection: AsyncIOMotorCollection | None = None
         self.database = None
         self.client: AsyncIOMotorClient | None = None
         self.mongodb_url = mongodb_url
 
     async def connect(self):
-        self.client = AsyncIOMotorClient(self.mongodb_url)
+        """Creates the client. Indexes are managed by `mongo.migrations`, not here"""
+        self.client = AsyncIOMotorClient(
+            self.mongodb_url,
+            maxPoolSize=MONGO_MAX_POOL_SIZE,
+            minPoolSize=MONGO_MIN_POOL_SIZE,
+            maxIdleTimeMS=MONGO_MAX_IDLE_TIME_MS,
+            connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+            serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+            socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS,
+            waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS,
+        )
         self.database = self.client.car_database
         self.car_collection: AsyncIOMotorCollection = self.database.get_collection("cars")
-        if self.car_collection is None:
-            await self.database.create_collection("cars", capped=True, size=1000)
-        await self.car_collection.create_index('updatedAt', expireAfterSeconds=7 * 24 * 60 * 60)
-        await self.car_collection.create_index([('ad_number', 1)], unique=True)
+        analytics_read_preference = make_read_preference(read_pref_mode_from_name(MONGO_ANALYTICS_READ_PREFERENCE),
+                                                         tag_sets=None)
+        self.analytics_collection = self.car_collection.with_options(read_preference=analytics_read_preference)
+        self.meta_collection: AsyncIOMotorCollection = self.database.get_collection("meta")
+        self.analytics_meta_collection = self.meta_collection.with_options(read_preference=analytics_read_preference)
+        self.rollup_collection: AsyncIOMotorCollection = self.database.get_collection("car_rollups")
+        self.saved_search_collection: AsyncIOMotorCollection = self.database.get_collection("saved_searches")
+        self.crawl_target_collection: AsyncIOMotorCollection = self.database.get_collection("crawl_targets")
+
+    def analytics_may_lag(self) -> bool:
+        """Whether analytics reads can be served by a secondary that trails the primary"""
+        return MONGO_ANALYTICS_READ_PREFERENCE != 'primary' and bool(self.client.secondaries)
+
+    @contextlib.asynccontextmanager
+    async def analytics_session(self):
+        """Causally consistent session for analytics reads when they may be served by a lagging secondary, else None.
+
+        A read in the session sees at least what earlier reads in it saw, on any member, so a generation
+        read first is never newer than the cars read after it.
+        """
+        if not self.analytics_may_lag():
+            yield None
+            return
+        async with await self.client.start_session(causal_consistency=True) as session:
+            yield session
+
+    async def warm_up(self):
+        """Opens `minPoolSize` connections up front, so the first requests do not pay for the handshakes"""
+        await self.client.admin.command('ping')
+        await asyncio.gather(*(self.client.admin.command('ping') for _ in range(MONGO_MIN_POOL_SIZE)))
+        db_logger.info('Connected to MongoDB, pool warmed up with %s connections', MONGO_MIN_POOL_SIZE)
 
     async def disconnect(self):
         self.client.close()
+        self.client = None
 
 
 db = DataBase(MONGODB_URL)
+_connect_lock = asyncio.Lock()
 
 
 async def get_database() -> DataBase:
+    """Connected database. The API connects at startup, scripts connect here on first use"""
     if db.client is None:
-        await db.connect()
+        async with _connect_lock:
+            if db.client is None:
+                from mongo.migrations import migrate
+
+                await db.connect()
+                await migrate(db)
     return db
@@ -0,0 +1,219 @@
+"""Streaming export of the car collection to Parquet or Arrow IPC files.
+
+    python -m mongo.export cars.parquet --search-url "https://www.polovniautomobili.com/auto-oglasi/pretraga?..."
+"""
+import argparse
+import asyncio
+import io
+from typing import AsyncIterator
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import metrics
+from mongo.database import DataBase, db_logger, get_database
+from mongo.search_query import specs_from_search, mongo_query_from_specs
+
+EXPORT_BATCH_SIZE = 10000
+EXPORT_FORMATS = {
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrows'),
+}
+
+_category = pa.dictionary(pa.int32(), pa.string())
+_timestamp = pa.timestamp('ms', tz='UTC')
+
+# fields written by CarParser and the scoring/duplicate stages, repeated strings are dictionary encoded
+CAR_EXPORT_SCHEMA = pa.schema([
+    ('ad_number', pa.int64()),
+    ('link', pa.string()),
+    ('img_src', pa.string()),
+    ('thumbnail', pa.string()),
+    ('make', _category),
+    ('model', _category),
+    ('condition', _category),
+    ('year', pa.int32()),
+    ('mileage', pa.int64()),
+    ('body_type', _category),
+    ('fuel_type', _category),
+    ('engine_capacity', pa.int32()),
+    ('engine_power', pa.int32()),
+    ('fixed_price', _category),
+    ('price', pa.int64()),
+    ('exchange', _category),
+    ('emission_class', _category),
+    ('drive', _category),
+    ('transmission', _category),
+    ('doors', _category),
+    ('seats', _category),
+    ('steering_side', _category),
+    ('climate_control', _category),
+    ('color', _category),
+    ('interior_material', _category),
+    ('interior_color', _category),
+    ('registered_until', _category),
+    ('origin', _category),
+    ('damage', _category),
+    ('import_country', _category),
+    ('sale_method', _category),
+    ('battery_range', pa.int32()),
+    ('safety', pa.list_(_category)),
+    ('options', pa.list_(_category)),
+    ('details', pa.list_(_category)),
+    ('description', pa.string()),
+    ('deal_score', pa.float64()),
+    ('expected_price', pa.int64()),
+    ('cluster_id', pa.int64()),
+    ('createdAt', _timestamp),
+    ('updatedAt', _timestamp),
+])
+_LIST_FIELDS = {field.name for field in CAR_EXPORT_SCHEMA if pa.types.is_list(field.type)}
+
+
+def _coerce(value, arrow_type: pa.DataType):
+    """`value` converted to a Python value of `arrow_type`, raises ValueError or TypeError when it cannot be"""
+    if pa.types.is_string(arrow_type) or pa.types.is_dictionary(arrow_type):
+        return str(value)
+    if pa.types.is_integer(arrow_type):
+        number = float(value)
+        if not number.is_integer():
+            raise ValueError(f"{value!r} is not a whole number")
+        return int(number)
+    if pa.types.is_floating(arrow_type):
+        return float(value)
+    if pa.types.is_list(arrow_type):
+        return [_coerce(item, arrow_type.value_type) for item in value]
+    raise TypeError(f"{type(value).__name__} values are not converted to {arrow_type}")
+
+
+def _column(name: str, values: list, arrow_type: pa.DataType, invalid_rows: set[int]) -> pa.Array:
+    """Arrow array of `values`. Values of the wrong type are coerced, those that cannot be are nulled
+    and their rows added to `invalid_rows`"""
+    try:
+        return pa.array(values, type=arrow_type)
+    except (pa.ArrowException, OverflowError):
+        pass  # documents not written by the scraper, fix them up value by value
+    fixed = []
+    for row, value in enumerate(values):
+        try:
+            pa.array([value], type=arrow_type)
+        except (pa.ArrowException, OverflowError):
+            try:
+                value = _coerce(value, arrow_type)
+                pa.array([value], type=arrow_type)
+                metrics.increment('export_values_coerced_total')
+            except (pa.ArrowException, OverflowError, ValueError, TypeError):
+                db_logger.debug('Export leaves out a car, %s of type %s', name, type(value).__name__)
+                invalid_rows.add(row)
+                value = None
+        fixed.append(value)
+    return pa.array(fixed, type=arrow_type)
+
+
+def _record_batch(columns: dict[str, list]) -> pa.RecordBatch:
+    """Record batch of CAR_EXPORT_SCHEMA, rows with values that do not fit the schema are left out and counted"""
+    invalid_rows = set()
+    arrays = [_column(field.name, columns[field.name], field.type, invalid_rows) for field in CAR_EXPORT_SCHEMA]
+    batch = pa.RecordBatch.from_arrays(arrays, schema=CAR_EXPORT_SCHEMA)
+    if invalid_rows:
+        metrics.increment('export_rows_skipped_total', len(invalid_rows))
+        batch = batch.filter(pa.array([row not in invalid_rows for row in range(batch.num_rows)]))
+    return batch
+
+
+async def iter_record_batches(db: DataBase, data_filter: dict = None,
+                              batch_size: int = EXPORT_BATCH_SIZE) -> AsyncIterator[pa.RecordBatch]:
+    """Record batches of at most `batch_size` cars; only one batch is held in memory at a time"""
+    names = CAR_EXPORT_SCHEMA.names
+    cursor = db.analytics_collection.find(data_filter or {}, {'_id': 0, **{name: 1 for name in names}},
+                                          batch_size=batch_size)
+    columns = {name: [] for name in names}
+    rows = 0
+    async for car in cursor:
+        for name in names:
+            value = car.get(name)
+            if name in _LIST_FIELDS and value:
+                value = [item for item in (value if isinstance(value, list) else [value]) if item is not None]
+            columns[name].append(value)
+        rows += 1
+        if rows == batch_size:
+            yield _record_batch(columns)
+            columns = {name: [] for name in names}
+            rows = 0
+    if rows:
+        yield _record_batch(columns)
+
+
+def _new_writer(sink, export_format: str):
+    if export_format == 'parquet':
+        return pq.ParquetWriter(sink, CAR_EXPORT_SCHEMA, compression='zstd')
+    return pa.ipc.new_stream(sink, CAR_EXPORT_SCHEMA)
+
+
+async def export_cars(db: DataBase, path: str, export_format: str = 'parquet', data_filter: dict = None,
+                      batch_size: int = EXPORT_BATCH_SIZE) -> int:
+    rows = 0
+    with _new_writer(path, export_format) as writer:
+        async for batch in iter_record_batches(db, data_filter, batch_size):
+            writer.write_batch(batch)
+            rows += batch.num_rows
+    db_logger.info('Exported %s cars to %s', rows, path)
+    return rows
+
+
+class _ChunkBuffer(io.RawIOBase):
+    """Write-only stream whose content is taken out in chunks, so an export can be sent while it is written"""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def take(self) -> bytes:
+        data, self._chunks = b''.join(self._chunks), []
+        return data
+
+
+async def stream_export(db: DataBase, export_format: str = 'parquet', data_filter: dict = None,
+                        batch_size: int = EXPORT_BATCH_SIZE) -> AsyncIterator[bytes]:
+    """Export as chunks of bytes, one chunk per record batch"""
+    buffer = _ChunkBuffer()
+    writer = _new_writer(buffer, export_format)
+    try:
+        async for batch in iter_record_batches(db, data_filter, batch_size):
+            writer.write_batch(batch)
+            if chunk := buffer.take():
+                yield chunk
+    finally:
+        writer.close()
+    if chunk := buffer.take():
+        yield chunk
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Export cars to a Parquet or Arrow IPC stream file")
+    parser.add_argument('output', help="Output file path")
+    parser.add_argument('--format', choices=EXPORT_FORMATS, default='parquet', dest='export_format')
+    parser.add_argument('--search-url', help="Only cars matching this polovni automobili search url")
+    parser.add_argument('--batch-size', type=int, default=EXPORT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    db = await get_database()
+    data_filter = mongo_query_from_specs(specs_from_search(args.search_url)) if args.search_url else {}
+    rows = await export_cars(db, args.output, args.export_format, data_filter, args.batch_size)
+    print(f"Exported {rows} cars to {args.output}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,39 @@
+import datetime
+import os
+import socket
+import uuid
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from mongo.database import DataBase
+
+
+def lease_owner() -> str:
+    """Name identifying one holder of leases, unique across hosts, processes and instances"""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class LeaseRepository:
+    """Time-limited leases in the meta collection, so only one of several processes does a job"""
+
+    def __init__(self, db: DataBase):
+        self.db = db
+
+    async def acquire(self, lease_id: str, owner: str, seconds: float) -> dict | None:
+        """Takes or renews lease `lease_id` for `seconds`, returns the lease document when `owner` holds it"""
+        now = datetime.datetime.now(datetime.timezone.utc)
+        try:
+            return await self.db.meta_collection.find_one_and_update(
+                {'_id': lease_id, '$or': [{'owner': owner}, {'expires_at': {'$lt': now}}]},
+                {'$set': {'owner': owner, 'expires_at': now + datetime.timedelta(seconds=seconds)}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:  # held by another owner
+            return None
+
+    async def release(self, lease_id: str, owner: str):
+        """Gives up the lease early, when `owner` still holds it"""
+        await self.db.meta_collection.update_one({'_id': lease_id, 'owner': owner},
+                                                 {'$unset': {'owner': '', 'expires_at': ''}})
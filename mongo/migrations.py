@@ -0,0 +1,140 @@
+"""One-time schema steps (indexes, backfills), applied in order and recorded in the meta collection.
+
+Run `python -m mongo.migrations` during deployment; API startup and scripts also apply pending
+migrations, which costs two reads (schema version, TTL index) once everything is applied. A lease
+on the schema document lets one process apply them while the others wait.
+"""
+import asyncio
+import os
+from typing import Awaitable, Callable
+
+from mongo.database import DataBase, db_logger, get_database, CAR_TTL_SECONDS
+from mongo.leases import LeaseRepository, lease_owner
+from mongo.rollups import RollupRepository
+
+SCHEMA_ID = 'schema'
+# renewed after every migration, a process that dies while migrating blocks the others this long at most
+MIGRATION_LOCK_SECONDS = float(os.getenv("MIGRATION_LOCK_SECONDS", 30 * 60))
+MIGRATION_WAIT_SECONDS = 1.0
+
+migrations: list[tuple[int, str, Callable[[DataBase], Awaitable]]] = []
+
+
+def migration(version: int):
+    def register(function: Callable[[DataBase], Awaitable]):
+        migrations.append((version, function.__name__, function))
+        migrations.sort(key=lambda item: item[0])
+        return function
+
+    return register
+
+
+@migration(1)
+async def create_car_indexes(db: DataBase):
+    await db.car_collection.create_index('updatedAt', expireAfterSeconds=CAR_TTL_SECONDS)
+    await db.car_collection.create_index([('ad_number', 1)], unique=True)
+
+
+@migration(2)
+async def build_car_rollups(db: DataBase):
+    await db.rollup_collection.create_index([('make', 1), ('model', 1), ('year', 1)])
+    await RollupRepository(db).rebuild()
+
+
+@migration(3)
+async def create_duplicate_indexes(db: DataBase):
+    await db.car_collection.create_index('lsh_bands')
+    await db.car_collection.create_index('cluster_id')
+
+
+@migration(4)
+async def create_text_index(db: DataBase):
+    # search_text is already lower case and diacritics folded, language 'none' disables stemming and stop words
+    await db.car_collection.create_index([('search_text', 'text')], default_language='none',
+                                         name='search_text_index')
+
+
+@migration(5)
+async def create_crawl_target_index(db: DataBase):
+    await db.crawl_target_collection.create_index('search_url', unique=True)
+
+
+@migration(6)
+async def recompute_duplicate_clusters(db: DataBase):
+    """Signatures from description and image only, clusters reassigned under the spec prefilter"""
+    from mongo.car_repo import CarRepository
+    from scraping.minhash import car_shingles, minhash_signature, lsh_bands
+
+    async for car in db.car_collection.find({}, {'ad_number': 1, 'img_src': 1, 'description': 1}):
+        signature = minhash_signature(car_shingles(car, car.get('description')))
+        await db.car_collection.update_one({'_id': car['_id']}, {'$set': {
+            'minhash': signature, 'lsh_bands': lsh_bands(signature), 'cluster_id': car['ad_number']}})
+    # oldest ads first: a car joins the cluster of an older ad, newer ads still carry their own ad number
+    repo = CarRepository(db)
+    async for car in db.car_collection.find({}).sort('ad_number', 1):
+        if (cluster_id := await repo.find_duplicate_cluster(car)) != car['ad_number']:
+            await db.car_collection.update_one({'_id': car['_id']}, {'$set': {'cluster_id': cluster_id}})
+    await repo.bump_generation()
+
+
+async def migrate(db: DataBase) -> int:
+    """Applies pending migrations and returns the resulting schema version.
+
+    Only the holder of the lease on the schema document migrates, concurrent callers (API workers,
+    scripts) wait until it is done instead of repeating the same migrations.
+    """
+    latest = migrations[-1][0] if migrations else 0
+    owner = lease_owner()
+    leases = LeaseRepository(db)
+    while True:
+        schema = await db.meta_collection.find_one({'_id': SCHEMA_ID}) or {}
+        version = schema.get('version', 0)
+        if version >= latest:
+            break
+        if not await leases.acquire(SCHEMA_ID, owner, MIGRATION_LOCK_SECONDS):
+            db_logger.info('Waiting for migrations applied by %s', schema.get('owner'))
+            await asyncio.sleep(MIGRATION_WAIT_SECONDS)
+            continue
+        try:
+            version = await _apply_pending(db, leases, owner)
+        finally:
+            await leases.release(SCHEMA_ID, owner)
+        break
+    await sync_car_ttl(db)
+    return version
+
+
+async def _apply_pending(db: DataBase, leases: LeaseRepository, owner: str) -> int:
+    # read again under the lease, the previous holder may have applied some
+    version = (await db.meta_collection.find_one({'_id': SCHEMA_ID}) or {}).get('version', 0)
+    for migration_version, name, function in migrations:
+        if migration_version <= version:
+            continue
+        db_logger.info('Applying migration %s: %s', migration_version, name)
+        await function(db)
+        version = migration_version
+        await db.meta_collection.update_one({'_id': SCHEMA_ID}, {'$set': {'version': version}}, upsert=True)
+        await leases.acquire(SCHEMA_ID, owner, MIGRATION_LOCK_SECONDS)
+    return version
+
+
+async def sync_car_ttl(db: DataBase):
+    """Brings the TTL index in line with CAR_TTL_SECONDS, which the snapshot and scheduler also rely on.
+
+    The index is only created by migration 1, so a changed setting is applied here with collMod.
+    """
+    for index in (await db.car_collection.index_information()).values():
+        if index.get('key') == [('updatedAt', 1)] and index.get('expireAfterSeconds') != CAR_TTL_SECONDS:
+            db_logger.info('Changing car TTL from %s to %s seconds', index.get('expireAfterSeconds'), CAR_TTL_SECONDS)
+            await db.database.command('collMod', db.car_collection.name,
+                                      index={'keyPattern': {'updatedAt': 1}, 'expireAfterSeconds': CAR_TTL_SECONDS})
+
+
+async def main():
+    db = await get_database()
+    version = await db.meta_collection.find_one({'_id': SCHEMA_ID})
+    print(f"Schema version: {version.get('version') if version else 0}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
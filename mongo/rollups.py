@@ -0,0 +1,138 @@
+import asyncio
+import os
+from collections import defaultdict
+
+from pymongo import ReplaceOne, UpdateOne
+
+from analytics.market_stats import car_buckets, stats_from_histograms, BUCKET_WIDTHS
+from mongo.database import DataBase, db_logger
+from mongo.leases import LeaseRepository, lease_owner
+
+ROLLUP_KEY_FIELDS = ('make', 'model', 'year')
+ROLLUP_SOURCE_FIELDS = (*ROLLUP_KEY_FIELDS, 'price', 'mileage', 'engine_power')
+# car queries that only touch these fields can be answered from the rollups
+ROLLUP_QUERY_FIELDS = {'make', 'model', 'year', '$or', '$and'}
+# cars removed by the TTL index are only dropped from the rollups by a rebuild
+ROLLUP_REBUILD_SECONDS = float(os.getenv("ROLLUP_REBUILD_SECONDS", 3600))
+REBUILD_LEASE_ID = 'rollup_rebuild'
+
+
+def _rollup_id(car: dict) -> str:
+    return '|'.join(str(car.get(field)) for field in ROLLUP_KEY_FIELDS)
+
+
+def _known_price(car: dict) -> int | float:
+    price = car.get('price')
+    return price if isinstance(price, (int, float)) and price > 0 else 0
+
+
+def _rollup_increments(car: dict, sign: int) -> dict[str, int | float]:
+    increments = {'count': sign, 'price_sum': sign * _known_price(car)}
+    for field, bucket in car_buckets(car).items():
+        increments[f'hist.{field}.{bucket}'] = sign
+    return increments
+
+
+class RollupRepository:
+    """Price and distribution histograms per make/model/year, maintained incrementally on car writes.
+
+    Documents removed by the TTL index never pass through `apply`, so `run` rebuilds the rollups
+    every ROLLUP_REBUILD_SECONDS, in one process at a time.
+    """
+
+    def __init__(self, db: DataBase):
+        self.db = db
+
+    async def apply(self, old_car: dict | None, new_car: dict | None):
+        """Moves a car from the rollup of its previous version to the rollup of the new one"""
+        await self.apply_many([(old_car, new_car)])
+
+    async def apply_many(self, changes: list[tuple[dict | None, dict | None]]):
+        """`apply` for a batch of (previous version, new version) pairs, in one bulk write"""
+        updates = defaultdict(lambda: defaultdict(int))
+        keys = {}
+        for old_car, new_car in changes:
+            for car, sign in ((new_car, 1), (old_car, -1)):
+                if car:
+                    rollup_id = _rollup_id(car)
+                    keys.setdefault(rollup_id, {field: car.get(field) for field in ROLLUP_KEY_FIELDS})
+                    for path, value in _rollup_increments(car, sign).items():
+                        updates[rollup_id][path] += value
+        operations = []
+        for rollup_id, increments in updates.items():
+            increments = {path: value for path, value in increments.items() if value}
+            if increments:
+                operations.append(UpdateOne({'_id': rollup_id}, {'$inc': increments, '$setOnInsert': keys[rollup_id]},
+                                            upsert=True))
+        if operations:
+            await self.db.rollup_collection.bulk_write(operations, ordered=False)
+
+    async def rebuild(self) -> int:
+        """Recomputes all rollups from the car collection, returns the number of rollups changed"""
+        rollups = {}
+        async for car in self.db.car_collection.find({}, {field: 1 for field in ROLLUP_SOURCE_FIELDS}):
+            rollup = rollups.setdefault(_rollup_id(car), {
+                **{field: car.get(field) for field in ROLLUP_KEY_FIELDS},
+                'count': 0, 'price_sum': 0, 'hist': defaultdict(lambda: defaultdict(int))})
+            rollup['count'] += 1
+            rollup['price_sum'] += _known_price(car)
+            for field, bucket in car_buckets(car).items():
+                rollup['hist'][field][str(bucket)] += 1
+        for rollup in rollups.values():
+            rollup['hist'] = {field: dict(buckets) for field, buckets in rollup['hist'].items()}
+        # only differing rollups are replaced in place, so statistics never see an empty rollup
+        # collection and an unchanged collection keeps its generation (and the ETags based on it)
+        stale_ids = []
+        async for stored in self.db.rollup_collection.find():
+            rollup_id = stored.pop('_id')
+            if rollup_id not in rollups:
+                stale_ids.append(rollup_id)
+            elif stored == rollups[rollup_id]:
+                del rollups[rollup_id]
+        operations = [ReplaceOne({'_id': rollup_id}, rollup, upsert=True) for rollup_id, rollup in rollups.items()]
+        if operations:
+            await self.db.rollup_collection.bulk_write(operations, ordered=False)
+        if stale_ids:
+            await self.db.rollup_collection.delete_many({'_id': {'$in': stale_ids}})
+        if operations or stale_ids:
+            # statistics served from the rollups changed without a car write, new generation for their ETags
+            await self.db.meta_collection.update_one({'_id': 'cars'}, {'$inc': {'generation': 1}}, upsert=True)
+        db_logger.info('Rebuilt rollups, %s replaced, %s removed', len(operations), len(stale_ids))
+        return len(operations) + len(stale_ids)
+
+    async def run(self):
+        """Rebuilds the rollups every ROLLUP_REBUILD_SECONDS, meant to run as a background task of the API.
+
+        Every worker runs it, a lease makes sure only one of them rebuilds per interval.
+        """
+        owner = lease_owner()
+        while True:
+            await asyncio.sleep(ROLLUP_REBUILD_SECONDS)
+            try:
+                # expires just before the next interval, so the holder can take it again
+                if await LeaseRepository(self.db).acquire(REBUILD_LEASE_ID, owner, ROLLUP_REBUILD_SECONDS * 0.9):
+                    await self.rebuild()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                db_logger.exception('Rollup rebuild failed. %s', e)
+
+    @staticmethod
+    def can_answer(data_filter: dict) -> bool:
+        return set(data_filter or {}) <= ROLLUP_QUERY_FIELDS
+
+    async def get_statistics(self, group_by: list[str], data_filter: dict, min_count: int = 1) -> list[dict]:
+        """Statistics per group, merged from the rollups matching `data_filter` (see `can_answer`)"""
+        merged = {}
+        query = {**(data_filter or {}), 'count': {'$gt': 0}}
+        async for rollup in self.db.rollup_collection.find(query):
+            key = tuple(rollup.get(field) for field in group_by)
+            group = merged.setdefault(key, {'count': 0, 'price_sum': 0,
+                                            'hist': {field: defaultdict(int) for field in BUCKET_WIDTHS}})
+            group['count'] += rollup['count']
+            group['price_sum'] += rollup.get('price_sum', 0)
+            for field, buckets in rollup.get('hist', {}).items():
+                for bucket, count in buckets.items():
+                    group['hist'][field][int(bucket)] += count
+        return [{**dict(zip(group_by, key)), **stats_from_histograms(group['count'], group['price_sum'], group['hist'])}
+                for key, group in merged.items() if group['count'] >= min_count]
@@ -0,0 +1,32 @@
+import datetime
+
+from bson import ObjectId
+
+from mongo.database import DataBase, db_logger
+
+
+class SavedSearchRepository:
+
+    def __init__(self, db: DataBase):
+        self.db = db
+
+    async def save_search(self, search: dict) -> dict:
+        search = {**search, 'createdAt': datetime.datetime.now(datetime.timezone.utc)}
+        result = await self.db.saved_search_collection.insert_one(search)
+        search['_id'] = result.inserted_id
+        db_logger.debug('Saved search %s', result.inserted_id)
+        return search
+
+    async def get_searches(self) -> list[dict]:
+        return await self.db.saved_search_collection.find().to_list(length=None)
+
+    async def get_search(self, search_id: str) -> dict | None:
+        if not ObjectId.is_valid(search_id):
+            return None
+        return await self.db.saved_search_collection.find_one({'_id': ObjectId(search_id)})
+
+    async def delete_search(self, search_id: str) -> bool:
+        if not ObjectId.is_valid(search_id):
+            return False
+        result = await self.db.saved_search_collection.delete_one({'_id': ObjectId(search_id)})
+        return result.deleted_count > 0
@@ -0,0 +1,122 @@
+import re
+from typing import Iterable
+from urllib.parse import urlparse, parse_qs
+
+from mongo.specifications import DecimalRangeParameter, SubSetParameter, OneOfParameter, SimpleParameter, MakeParameter, \
+    Specification, TextSearchParameter
+from scraping.translation import safety_features_translation, additional_options_translation, condition_translation, \
+    body_type_codes, fuel_type_codes, gearbox_codes, wheel_side_codes, ac_type_codes, condition_codes, \
+    emission_class_codes, interior_material_codes
+
+
+def _to_snake_case(param: str) -> str:
+    if '_' not in param:
+        return re.sub(r'(?<!^)(?=[A-Z])', '_', param).lower()
+    return param
+
+
+def specs_from_search(search_url: str | None, makes_to_include: dict = None, makes_to_exclude: dict = None,
+                      text: str = None) -> set[Specification]:
+    """Specifications of a polovni automobili search url, extra make filters and description text"""
+    parsed_url = urlparse(search_url)
+    if parsed_url.query:
+        query_params = dict((k, v if len(v) > 1 or k.endswith('[]') else v[0])
+                            for k, v in parse_qs(parsed_url.query).items())
+    else:
+        query_params = {}
+    query_params.update(
+        {'makes_to_include': dict(makes_to_include or {}),
+         'makes_to_exclude': dict(makes_to_exclude or {})})
+    specifications = uri_params_to_specs(query_params)
+    specifications.add(TextSearchParameter(text))
+    return specifications
+
+
+def uri_params_to_specs(query_params: dict) -> set[Specification] | None:
+    query_params = {_to_snake_case(param): value for param, value in query_params.items()}
+
+    price = DecimalRangeParameter('price', query_params.get('price_from'), query_params.get('price_to'))
+    year = DecimalRangeParameter('year', query_params.get('year_from'), query_params.get('year_to'))
+
+    power_kw = DecimalRangeParameter('engine_power', query_params.get('power_from'), query_params.get('power_to'))
+
+    engine_capacity = DecimalRangeParameter('engine_capacity', query_params.get('engine_volume_from'),
+                                            query_params.get('engine_volume_to'))
+    mileage = DecimalRangeParameter('mileage', query_params.get('mileage_from'), query_params.get('mileage_to'))
+
+    safety = [param for param in query_params if
+              param in safety_features_translation.values()]
+    safety = SubSetParameter('safety', safety)
+
+    options = [param for param in query_params if
+               param in additional_options_translation.values()]
+    options = SubSetParameter('options', options)
+
+    condition = [param for param in query_params if
+                 param in condition_translation.values()]
+    condition = SubSetParameter('details', condition)
+
+    body_types = [body_type_codes.get(int(chassis)) for chassis in query_params.get('chassis[]', [])]
+    body_types = OneOfParameter("body_type", body_types)
+
+    fuel_type = [fuel_type_codes.get(int(fuel)) for fuel in query_params.get('fuel[]', [])]
+    fuel_type = OneOfParameter("fuel_type", fuel_type)
+
+    gearbox = [gearbox_codes.get(int(gearbox)) for gearbox in query_params.get('gearbox[]', [])]
+    gearbox = OneOfParameter("transmission", gearbox)
+
+    wheel_side = (wheel_side_codes.get(int(query_params.get('wheel_side')))
+                  if query_params.get('wheel_side') else None)
+    wheel_side = SimpleParameter('steering_side', wheel_side)
+    car_1_make, car_1_models = query_params.get('brand'), query_params.get('model[]')
+    car_2_make, car_2_models = query_params.get('brand2'), query_params.get('model2[]')
+    query_params.get('makes_to_include').update({car_1_make: car_1_models, car_2_make: car_2_models})
+    make = MakeParameter(query_params.get('makes_to_include'), query_params.get('makes_to_exclude'))
+
+    ac_type = [ac_type_codes.get(int(ac_code)) for ac_code in query_params.get('air_condition[]', [])]
+    ac_type = OneOfParameter('climate_control', ac_type)
+
+    damage = [condition_codes.get(int(condition_code)) for condition_code in query_params.get('damaged[]', [])]
+    damage = OneOfParameter('damage', damage)
+
+    emission_class = (emission_class_codes.get(int(query_params.get('emission_class')))
+                      if query_params.get('emission_class') else None)
+    emission_class = SimpleParameter('emission_class', emission_class)
+
+    interior_material = [interior_material_codes.get(int(int_m_code)) for int_m_code in
+                         query_params.get('interior_material[]', [])]
+    interior_material = OneOfParameter('interior_material', interior_material)
+    # todo: implement additional parameters for door count
+    model_filter = {price, year, power_kw, engine_capacity, mileage, safety, options, condition, body_types, fuel_type,
+                    gearbox, wheel_side, make, ac_type, damage, emission_class, interior_material}
+    return model_filter
+
+
+def mongo_query_from_specs(specifications: Iterable[Specification]):
+    query = {}
+    for spec in specifications:
+        try:
+            spec_query = spec.to_query()
+        except ValueError:
+            continue
+        for key, value in spec_query.items():
+            if key in query:
+                if isinstance(query[key], dict) and isinstance(value, dict):
+                    query[key].update(value)
+                elif isinstance(query[key], list) and isinstance(value, list):
+                    query[key].extend(value)
+            else:
+                query[key] = value
+    return query
+
+
+def active_specs(specifications: Iterable[Specification]) -> list[Specification]:
+    """Specifications that constrain the result, the same ones `mongo_query_from_specs` turns into a query"""
+    active = []
+    for spec in specifications:
+        try:
+            spec.to_query()
+        except ValueError:
+            continue
+        active.append(spec)
+    return active
@@ -1,11 +1,17 @@
 import re
 from typing import Any
 
+from scraping.text import normalize_text
+
 
 class Specification:
     def to_query(self) -> dict[str, Any]:
         raise NotImplementedError("Subclasses must implement `to_query` method")
 
+    def matches(self, car: dict) -> bool:
+        """In-process equivalent of `to_query`, only meaningful when `to_query` does not raise"""
+        raise NotImplementedError("Subclasses must implement `matches` method")
+
 
 class DecimalRangeParameter(Specification):
     def __init__(self, param_name: str, val_from: int = None, val_to: int = None):
@@ -23,6 +29,13 @@ class DecimalRangeParameter(Specification):
             query[self.param_name]['$lte'] = int(self.val_to)
         return query
 
+    def matches(self, car: dict) -> bool:
+        value = car.get(self.param_name)
+        if value is None:
+            return False
+        return ((self.val_from is None or value >= int(self.val_from)) and
+                (self.val_to is None or value <= int(self.val_to)))
+
 
 class SimpleParameter(Specification):
     def __init__(self, param_name: str, value: Any):
@@ -35,6 +48,9 @@ class SimpleParameter(Specification):
         query = {self.param_name: self.value}
         return query
 
+    def matches(self, car: dict) -> bool:
+        return car.get(self.param_name) == self.value
+
 
 class OneOfParameter(Specification):
     def __init__(self, param_name: str, values: list):
@@ -47,6 +63,9 @@ class OneOfParameter(Specification):
         query = {self.param_name: {"$in": self.values}}
         return query
 
+    def matches(self, car: dict) -> bool:
+        return car.get(self.param_name) in self.values
+
 
 class SubSetParameter(Specification):
     def __init__(self, param_name: str, values: list):
@@ -59,6 +78,9 @@ class SubSetParameter(Specification):
         query = {self.param_name: {"$all": self.values}}
         return query
 
+    def matches(self, car: dict) -> bool:
+        return set(self.values) <= set(car.get(self.param_name) or [])
+
 
 class MakeParameter(Specification):
     def __init__(self, makes_to_include: dict[str, list[str]] = None, makes_to_exclude: dict[str, list[str]] = None):
@@ -119,3 +141,43 @@ class MakeParameter(Specification):
             query['$and'] = and_clauses
 
         return query
+
+    def matches(self, car: dict) -> bool:
+        make, model = car.get('make'), car.get('model')
+        included = [(self.normalize_string(make_name), [self.normalize_string(m) for m in models or []])
+                    for make_name, models in self.makes_to_include.items() if make_name]
+        if included and not any(make == make_name and (not models or model in models)
+                                for make_name, models in included):
+            return False
+        for make_name, models in self.makes_to_exclude.items():
+            if make == self.normalize_string(make_name):
+                return False
+            if models and model in [self.normalize_string(m) for m in models]:
+                return False
+        return True
+
+
+class TextSearchParameter(Specification):
+    """Full-text search in ad descriptions, backed by the text index on `search_text`.
+
+    Every word has to occur in the ad; quoted parts are matched as phrases.
+    """
+    _term_pattern = re.compile(r'"([^"]+)"|(\S+)')
+
+    def __init__(self, text: str | None):
+        self.text = text
+
+    def to_query(self) -> dict[str, Any]:
+        terms = self._terms()
+        if not terms:
+            raise ValueError
+        return {'$text': {'$search': ' '.join(f'"{term}"' for term in terms)}}
+
+    def _terms(self) -> list[str]:
+        """Words and quoted phrases, normalized like `search_text` so punctuation never has to match"""
+        terms = (phrase or word for phrase, word in self._term_pattern.findall(self.text or ''))
+        return [normalized for term in terms if (normalized := normalize_text(term))]
+
+    def matches(self, car: dict) -> bool:
+        search_text = f" {car.get('search_text') or ''} "
+        return all(f' {term} ' in search_text for term in self._terms())
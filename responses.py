@@ -0,0 +1,103 @@
+import gzip
+import hashlib
+import os
+from typing import Any, Iterable
+
+import brotli
+import orjson
+from fastapi import Response
+
+CAR_COLUMNS = ('id', 'link', 'img_src', 'thumbnail', 'make', 'model', 'year', 'price', 'engine_power',
+               'engine_capacity', 'deal_score', 'expected_price', 'duplicate_count')
+DICTIONARY_COLUMNS = ('make', 'model', 'year')
+MIN_COMPRESS_SIZE = 1024
+CACHE_CONTROL = os.getenv("API_CACHE_CONTROL", "public, max-age=0, must-revalidate")
+
+
+def _car_value(car: Any, field: str):
+    return car.get(field) if isinstance(car, dict) else getattr(car, field, None)
+
+
+def to_compact_groups(groups: Iterable[dict], columns: tuple[str, ...] = CAR_COLUMNS) -> dict[str, Any]:
+    """Columnar encoding of grouped cars.
+
+    Every group carries one array per car field instead of one object per car. Values of
+    DICTIONARY_COLUMNS are stored once in the top level `dictionaries` and referenced by index:
+    {"columns": [...], "dictionaries": {"make": [...], ...},
+     "groups": [{"make": ..., "count": 3, "cars": {"price": [...], "make": [0, 0, 1], ...}}]}
+    """
+    dictionaries = {field: [] for field in DICTIONARY_COLUMNS}
+    codes = {field: {} for field in DICTIONARY_COLUMNS}
+    compact_groups = []
+    for group in groups:
+        cars = [car for car in group['cars'] if car is not None]
+        car_columns = {}
+        for field in columns:
+            values = [_car_value(car, field) for car in cars]
+            if field in codes:
+                field_codes, field_dictionary = codes[field], dictionaries[field]
+                for i, value in enumerate(values):
+                    if value not in field_codes:
+                        field_codes[value] = len(field_dictionary)
+                        field_dictionary.append(value)
+                    values[i] = field_codes[value]
+            car_columns[field] = values
+        compact_groups.append({**{key: value for key, value in group.items() if key != 'cars'},
+                               'count': group.get('count', len(cars)), 'cars': car_columns})
+    return {'columns': list(columns), 'dictionaries': dictionaries, 'groups': compact_groups}
+
+
+def _accepted_encodings(accept_encoding: str | None) -> set[str]:
+    """Content codings of an Accept-Encoding header, without those refused with q=0"""
+    accepted = set()
+    for item in (accept_encoding or '').lower().split(','):
+        name, *params = (part.strip() for part in item.split(';'))
+        quality = next((param.partition('=')[2] for param in params if param.startswith('q=')), '1')
+        try:
+            if float(quality) > 0:
+                accepted.add(name)
+        except ValueError:
+            pass
+    return accepted
+
+
+def compressed_response(body: bytes, accept_encoding: str | None, media_type: str = 'application/json',
+                        headers: dict[str, str] = None) -> Response:
+    """Response with `body` encoded by the best encoding the client accepts (br, then gzip)"""
+    headers = {**(headers or {}), 'Vary': 'Accept-Encoding'}
+    accepted = _accepted_encodings(accept_encoding)
+    if len(body) >= MIN_COMPRESS_SIZE:
+        if 'br' in accepted:
+            body, headers['Content-Encoding'] = brotli.compress(body, quality=5), 'br'
+        elif 'gzip' in accepted:
+            body, headers['Content-Encoding'] = gzip.compress(body, compresslevel=6), 'gzip'
+    return Response(content=body, media_type=media_type, headers=headers)
+
+
+def json_bytes(content: Any) -> bytes:
+    """Compact UTF-8 JSON of plain dicts and lists, NumPy scalars and arrays included"""
+    return orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY)
+
+
+def etag_for(generation: Any, query_items: Iterable[tuple[str, str]]) -> str:
+    """Weak ETag of a response, derived from the data generation and the normalized query"""
+    normalized_query = '&'.join(f'{key}={value}' for key, value in sorted(query_items))
+    digest = hashlib.sha1(f'{generation}|{normalized_query}'.encode('utf-8')).hexdigest()
+    return f'W/"{digest}"'
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    # weak comparison, W/ prefixes are ignored
+    return etag.removeprefix('W/') in {tag.strip().removeprefix('W/') for tag in if_none_match.split(',')}
+
+
+def cache_headers(etag: str) -> dict[str, str]:
+    return {'ETag': etag, 'Cache-Control': CACHE_CONTROL}
+
+
+def not_modified_response(etag: str) -> Response:
+    return Response(status_code=304, headers={**cache_headers(etag), 'Vary': 'Accept-Encoding'})
@@ -0,0 +1,230 @@
+"""Freshness-driven recrawl of registered search urls.
+
+Every car is deleted by the TTL index CAR_TTL_SECONDS after its last `updatedAt`, and a crawl of a
+search url refreshes all its live ads. Each target is therefore due once per TTL window: its
+deadline is the last crawl plus the TTL minus a safety margin. Targets are crawled as late as the
+request budget allows (fewest listing requests), but early enough that the whole queue finishes
+before the deadlines when crawls run back to back at the budgeted rate.
+
+Failed crawls are retried with exponential backoff, and only the holder of a lease in MongoDB
+crawls, so any number of schedulers can run side by side.
+"""
+import asyncio
+import datetime
+import math
+import os
+import time
+from dataclasses import dataclass
+
+from mongo.crawl_targets import CrawlTargetRepository
+from mongo.database import DataBase, CAR_TTL_SECONDS, MONGODB_URL, get_database
+from mongo.leases import lease_owner
+from scraping.utilities import logger
+
+CRAWL_SCHEDULER_ENABLED = os.getenv("CRAWL_SCHEDULER", "").lower() in ("1", "true", "yes")
+CRAWL_REQUESTS_PER_HOUR = float(os.getenv("CRAWL_REQUESTS_PER_HOUR", 600))
+CRAWL_SAFETY_MARGIN_SECONDS = float(os.getenv("CRAWL_SAFETY_MARGIN_SECONDS", 24 * 60 * 60))
+CRAWL_TICK_SECONDS = float(os.getenv("CRAWL_TICK_SECONDS", 60))
+CRAWL_LEASE_SECONDS = float(os.getenv("CRAWL_LEASE_SECONDS", 300))
+# a failed target is retried after this, doubling per consecutive failure up to the maximum
+CRAWL_RETRY_SECONDS = float(os.getenv("CRAWL_RETRY_SECONDS", 300))
+CRAWL_MAX_RETRY_SECONDS = float(os.getenv("CRAWL_MAX_RETRY_SECONDS", 6 * 60 * 60))
+ADS_PER_PAGE = 25
+DEFAULT_ESTIMATED_ADS = 100
+
+
+@dataclass
+class PlannedCrawl:
+    target: dict
+    requests: int
+    deadline: float
+    latest_start: float
+
+    @property
+    def search_url(self) -> str:
+        return self.target['search_url']
+
+
+def _timestamp(value) -> float | None:
+    if not isinstance(value, datetime.datetime):
+        return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=datetime.timezone.utc)
+    return value.timestamp()
+
+
+def retry_delay(failures: int) -> float:
+    """Seconds before a target that failed `failures` times in a row is crawled again"""
+    return min(CRAWL_MAX_RETRY_SECONDS, CRAWL_RETRY_SECONDS * 2 ** max(0, failures - 1))
+
+
+def crawl_requests(target: dict) -> int:
+    """Listing pages for the estimated result size plus detail pages for the ads that were new last time"""
+    pages = max(1, math.ceil(target.get('estimated_ads', DEFAULT_ESTIMATED_ADS) / ADS_PER_PAGE))
+    return pages + target.get('last_new_ads', 0)
+
+
+def plan_crawls(targets: list[dict], now: float = None,
+                requests_per_hour: float = CRAWL_REQUESTS_PER_HOUR) -> list[PlannedCrawl]:
+    """Crawls ordered by their latest start time.
+
+    Latest starts are computed backwards from the last deadline: a crawl has to start early enough
+    to finish before its own deadline and before the latest start of the crawl behind it. Targets
+    backing off after a failure do not start before their `retry_after`.
+    """
+    now = time.time() if now is None else now
+    seconds_per_request = 3600 / requests_per_hour
+    planned = []
+    for target in targets:
+        last_crawled = _timestamp(target.get('last_crawled_at'))
+        deadline = now if last_crawled is None else last_crawled + CAR_TTL_SECONDS - CRAWL_SAFETY_MARGIN_SECONDS
+        planned.append(PlannedCrawl(target, crawl_requests(target), deadline, deadline))
+
+    planned.sort(key=lambda crawl: (crawl.deadline, -crawl.target.get('priority', 1)))
+    next_start = math.inf
+    for crawl in reversed(planned):
+        crawl.latest_start = min(crawl.deadline, next_start) - crawl.requests * seconds_per_request
+        next_start = crawl.latest_start
+    for crawl in planned:
+        if (retry_after := _timestamp(crawl.target.get('retry_after'))) is not None:
+            crawl.latest_start = max(crawl.latest_start, retry_after)
+    return sorted(planned, key=lambda crawl: (crawl.latest_start, -crawl.target.get('priority', 1)))
+
+
+class RequestBudget:
+    """Token bucket of requests, refilled continuously at `requests_per_hour`, holding at most one hour"""
+
+    def __init__(self, requests_per_hour: float = CRAWL_REQUESTS_PER_HOUR):
+        self.rate = requests_per_hour / 3600
+        self.capacity = requests_per_hour
+        self.tokens = requests_per_hour
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def seconds_until(self, requests: int) -> float:
+        self._refill()
+        needed = min(requests, self.capacity) - self.tokens
+        return max(0.0, needed / self.rate)
+
+    def spend(self, requests: int):
+        self._refill()
+        self.tokens -= requests
+
+    def save(self) -> tuple[float, float]:
+        """Tokens left and the wall clock time they were counted at"""
+        self._refill()
+        return self.tokens, time.time()
+
+    def restore(self, tokens: float, saved_at: float):
+        """Continues a budget saved by another scheduler"""
+        self.tokens = min(self.capacity, tokens)
+        self._updated = time.monotonic() - max(0.0, time.time() - saved_at)
+
+
+def _crawl_in_thread(search_url: str, stats: dict):
+    """Runs a crawl with its own event loop and client, so the blocking requests do not stall the API"""
+    from main import scrape_all_pages  # the scraping stack is only loaded once a crawl is due
+
+    async def crawl():
+        db = DataBase(MONGODB_URL)
+        await db.connect()
+        try:
+            await scrape_all_pages(search_url, db, stats=stats)
+        finally:
+            await db.disconnect()
+
+    asyncio.run(crawl())
+
+
+class CrawlScheduler:
+
+    def __init__(self, db: DataBase, requests_per_hour: float = CRAWL_REQUESTS_PER_HOUR):
+        self.db = db
+        self.targets = CrawlTargetRepository(db)
+        self.budget = RequestBudget(requests_per_hour)
+        self.requests_per_hour = requests_per_hour
+        self.owner = lease_owner()
+        self.is_leader = False
+
+    async def plan(self) -> list[PlannedCrawl]:
+        return plan_crawls(await self.targets.get_targets(), requests_per_hour=self.requests_per_hour)
+
+    async def acquire_lease(self) -> bool:
+        lease = await self.targets.acquire_lease(self.owner, CRAWL_LEASE_SECONDS)
+        if lease is not None and not self.is_leader:
+            if lease.get('budget_tokens') is not None:
+                self.budget.restore(lease['budget_tokens'], lease['budget_saved_at'])
+            logger.info("Crawl scheduler %s holds the lease", self.owner)
+        self.is_leader = lease is not None
+        return self.is_leader
+
+    async def _renew_lease(self):
+        while True:
+            await asyncio.sleep(CRAWL_LEASE_SECONDS / 3)
+            if not await self.acquire_lease():
+                logger.warning("Crawl scheduler %s lost the lease during a crawl", self.owner)
+
+    async def run_once(self) -> PlannedCrawl | None:
+        """Crawls the most urgent target if this scheduler holds the lease, the target is due and the
+        budget allows, returns the crawl made or attempted"""
+        if not await self.acquire_lease():
+            return None
+        plan = await self.plan()
+        if not plan or plan[0].latest_start > time.time():
+            return None
+        crawl = plan[0]
+        renewal = asyncio.create_task(self._renew_lease())
+        try:
+            return await self._crawl(crawl)
+        finally:
+            renewal.cancel()
+
+    async def _crawl(self, crawl: PlannedCrawl) -> PlannedCrawl:
+        if wait := self.budget.seconds_until(crawl.requests):
+            logger.info("Crawl of %s waits %.0fs for request budget", crawl.search_url, wait)
+            await asyncio.sleep(wait)
+        started_at = datetime.datetime.now(datetime.timezone.utc)
+        stats = {}
+        self.budget.spend(crawl.requests)
+        try:
+            await asyncio.to_thread(_crawl_in_thread, crawl.search_url, stats)
+        except Exception as e:
+            failures = crawl.target.get('failures', 0) + 1
+            retry_after = started_at + datetime.timedelta(seconds=retry_delay(failures))
+            await self.targets.record_failure(crawl.target['_id'], started_at, retry_after, repr(e))
+            logger.exception("Scheduled crawl of %s failed %s times, retrying after %s. %s", crawl.search_url,
+                             failures, retry_after, e)
+            return crawl
+        finally:
+            # settle the estimate against the requests actually made
+            self.budget.spend(stats.get('pages', 0) + stats.get('new_ads', 0) - crawl.requests)
+            await self.targets.save_budget(self.owner, *self.budget.save())
+        await self.targets.record_crawl(crawl.target['_id'], started_at, stats)
+        logger.info("Scheduled crawl of %s done: %s pages, %s new ads, %s total ads", crawl.search_url,
+                    stats.get('pages'), stats.get('new_ads'), stats.get('total_ads'))
+        return crawl
+
+    async def run(self):
+        """Long-lived loop, meant to run next to the API or as its own worker process"""
+        while True:
+            try:
+                if await self.run_once():
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception("Scheduled crawl failed. %s", e)
+            await asyncio.sleep(CRAWL_TICK_SECONDS)
+
+
+async def main():
+    db = await get_database()
+    await CrawlScheduler(db).run()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -5,6 +5,8 @@ from typing import Optional
 from bs4 import Tag
 from pydantic import BaseModel
 
+from scraping.minhash import car_shingles, minhash_signature, lsh_bands
+from scraping.text import normalize_text
 from scraping.translation import safety_features_translation, additional_options_translation, \
     condition_translation
 from scraping.utilities import safe_extract_section, safe_extract_text
@@ -46,8 +48,16 @@ class CarParser:
         condition_features = self._get_condition(classified_content)
         self.car_info['details'] = condition_features
 
+        description = None
         if description_section := classified_content.find('div', {'id': 'classifiedReplaceDescription'}):
-            basic_car_info['description'] = description_section.find('div', class_='description-wrapper').text.strip()
+            description = description_section.find('div', class_='description-wrapper').text.strip()
+        self.car_info['description'] = description
+        self.car_info['search_text'] = normalize_text(' '.join(
+            part for part in (self.car_info.get('make'), self.car_info.get('model'), description) if part))
+
+        signature = minhash_signature(car_shingles(self.car_info, description))
+        self.car_info['minhash'] = signature
+        self.car_info['lsh_bands'] = lsh_bands(signature)
 
         return self.car_info
 
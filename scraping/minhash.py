@@ -0,0 +1,72 @@
+import hashlib
+
+import numpy as np
+
+from scraping.text import tokenize
+
+NUM_PERMUTATIONS = 64
+LSH_BANDS = 16
+LSH_ROWS = NUM_PERMUTATIONS // LSH_BANDS
+DUPLICATE_THRESHOLD = 0.8
+SHINGLE_SIZE = 3
+MIN_DESCRIPTION_SHINGLES = 8
+# specs a re-posted ad keeps, candidate duplicates must agree on all of them
+DUPLICATE_SPEC_FIELDS = ('make', 'model', 'year', 'fuel_type', 'engine_capacity', 'engine_power', 'body_type',
+                         'transmission', 'color')
+
+_PRIME = (1 << 31) - 1
+# fixed seed: signatures are stored, so every process has to use the same permutations
+_random = np.random.default_rng(0x5EED)
+_A = _random.integers(1, _PRIME, NUM_PERMUTATIONS, dtype=np.uint64)
+_B = _random.integers(0, _PRIME, NUM_PERMUTATIONS, dtype=np.uint64)
+
+
+def description_shingles(description: str | None) -> set[str]:
+    words = tokenize(description)
+    return {' '.join(words[i:i + SHINGLE_SIZE]) for i in range(max(len(words) - SHINGLE_SIZE + 1, 0))}
+
+
+def car_shingles(car: dict, description: str | None) -> set[str]:
+    """Word shingles of the description plus the lead image.
+
+    Specs are left out on purpose: many distinct cars share a common configuration, so specs only
+    prefilter candidates (DUPLICATE_SPEC_FIELDS must be equal) and never add to the similarity.
+    """
+    shingles = description_shingles(description)
+    if car.get('img_src'):
+        image_url = car['img_src'].split(',')[0].split()[0]
+        shingles.add(f"image:{image_url.rsplit('/', 1)[-1]}")
+    return shingles
+
+
+def can_join_cluster(description: str | None) -> bool:
+    """Only ads with enough description text to tell them apart are matched against other ads"""
+    return len(description_shingles(description)) >= MIN_DESCRIPTION_SHINGLES
+
+
+def minhash_signature(shingles: set[str]) -> list[int]:
+    if not shingles:
+        return []
+    hashes = np.array([int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=4).digest(), 'little')
+                       for shingle in shingles], dtype=np.uint64) % np.uint64(_PRIME)
+    # all operands are below 2**31, so the products fit into uint64
+    permuted = (_A[:, None] * hashes[None, :] + _B[:, None]) % np.uint64(_PRIME)
+    return permuted.min(axis=1).tolist()
+
+
+def lsh_bands(signature: list[int]) -> list[str]:
+    """Band keys of a signature. Cars sharing any band key are candidate duplicates"""
+    if not signature:
+        return []
+    bands = []
+    for band in range(LSH_BANDS):
+        rows = repr(signature[band * LSH_ROWS:(band + 1) * LSH_ROWS]).encode()
+        bands.append(f"{band}:{hashlib.blake2b(rows, digest_size=8).hexdigest()}")
+    return bands
+
+
+def estimated_similarity(signature: list[int], other: list[int]) -> float:
+    """Estimated Jaccard similarity of the shingle sets behind two signatures"""
+    if not signature or len(signature) != len(other):
+        return 0.0
+    return float(np.mean(np.array(signature) == np.array(other)))
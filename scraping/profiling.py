@@ -0,0 +1,183 @@
+import asyncio
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+
+from scraping.utilities import logger
+
+PROFILE_MODE = os.getenv("SCRAPE_PROFILE", "").lower()  # "", "1"/"sampling", "cprofile"
+PROFILE_DIR = os.getenv("SCRAPE_PROFILE_DIR", "profiles")
+PROFILE_INTERVAL = float(os.getenv("SCRAPE_PROFILE_INTERVAL", 0.01))
+PROFILE_TOP = 25
+
+
+class StackSampler:
+    """Samples the stack of one thread, and of the threads named `thread_prefix`*, from a background thread.
+
+    Only the sampler thread does any work, and only once per `interval`, so the overhead on the
+    profiled threads is limited to the GIL hand-off. Collected stacks are kept in collapsed
+    ("folded") form, which flamegraph.pl, inferno and speedscope read directly.
+    """
+
+    def __init__(self, thread_id: int, interval: float = PROFILE_INTERVAL, thread_prefix: str = None):
+        self.thread_id = thread_id
+        self.thread_prefix = thread_prefix
+        self.interval = interval
+        self.stacks: Counter[str] = Counter()
+        self.sample_count = 0
+        self.tick_count = 0
+        self.duration = 0.0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def start(self):
+        self.duration = time.perf_counter()
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.duration = time.perf_counter() - self.duration
+
+    def _thread_ids(self) -> list[int]:
+        thread_ids = [self.thread_id]
+        if self.thread_prefix:
+            thread_ids.extend(thread.ident for thread in threading.enumerate()
+                              if thread.name.startswith(self.thread_prefix))
+        return thread_ids
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.tick_count += 1
+            frames = sys._current_frames()
+            for thread_id in self._thread_ids():
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                self.stacks[';'.join(reversed(stack))] += 1
+                self.sample_count += 1
+
+    def write_folded(self, path: Path):
+        with open(path, 'w') as folded:
+            for stack, count in self.stacks.most_common():
+                folded.write(f"{stack} {count}\n")
+
+    def summary(self, top: int = PROFILE_TOP) -> list[tuple[str, float, float]]:
+        """Top functions as (function, cumulative seconds, self seconds), estimated from sample counts.
+
+        Seconds are summed over the sampled threads, so they can add up to more than the wall time.
+        """
+        seconds_per_sample = self.duration / self.tick_count if self.tick_count else self.interval
+        cumulative, own = Counter(), Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(';')
+            for function in set(frames):
+                cumulative[function] += count
+            own[frames[-1]] += count
+        return [(function, count * seconds_per_sample, own[function] * seconds_per_sample)
+                for function, count in cumulative.most_common(top)]
+
+
+def _sampling_available() -> bool:
+    return hasattr(sys, '_current_frames')
+
+
+def _write_summary(path: Path, job_id: str, mode: str, elapsed: float, rows: list[tuple[str, float, float]]):
+    lines = [f"job: {job_id}", f"mode: {mode}", f"wall time: {elapsed:.2f}s", "",
+             f"{'cumulative':>12} {'self':>10}  function"]
+    lines.extend(f"{cum:>11.3f}s {own:>9.3f}s  {function}" for function, cum, own in rows)
+    path.write_text('\n'.join(lines) + '\n')
+
+
+def _cprofile_rows(profiler: cProfile.Profile, top: int = PROFILE_TOP) -> list[tuple[str, float, float]]:
+    stats = pstats.Stats(profiler)
+    rows = [(f"{name} ({filename}:{line})", cumtime, tottime)
+            for (filename, line, name), (_, _, tottime, cumtime, _) in stats.stats.items()]
+    return sorted(rows, key=lambda row: row[1], reverse=True)[:top]
+
+
+def profile_mode(mode: str | None = None) -> str:
+    """"sampling", "cprofile" or "" (off) for `mode`, which defaults to SCRAPE_PROFILE"""
+    mode = (PROFILE_MODE if mode is None else mode).lower()
+    if mode in ("", "0", "off", "false"):
+        return ""
+    if mode != "cprofile" and not _sampling_available():
+        logger.warning("Sampling profiler is not available on this interpreter, falling back to cProfile")
+        return "cprofile"
+    return "cprofile" if mode == "cprofile" else "sampling"
+
+
+def profiling_enabled(mode: str | None = None) -> bool:
+    """Whether `mode` (default SCRAPE_PROFILE) switches profiling on"""
+    return profile_mode(mode) != ""
+
+
+@contextmanager
+def profile_job(job_id: str, mode: str | None = None):
+    """Profiles the enclosed block of a scrape job when profiling is switched on.
+
+    `mode` defaults to the SCRAPE_PROFILE environment variable. The sampling profiler writes
+    `<job_id>.folded` (collapsed stacks for flamegraphs), the deterministic fallback writes
+    `<job_id>.prof` (pstats, readable by snakeviz/flameprof). Both write `<job_id>.txt` with the
+    top functions by cumulative time.
+
+    Both profilers observe the calling thread and everything else running on it: run the job on a
+    thread of its own to keep other work (e.g. API requests on the same event loop) out. The sampling
+    profiler also follows `asyncio.to_thread` work of the job, it gives the running event loop a
+    default executor whose threads it samples. cProfile cannot follow other threads.
+    """
+    mode = profile_mode(mode)
+    if not mode:
+        yield
+        return
+
+    output_dir = Path(PROFILE_DIR)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    started = time.perf_counter()
+    if mode == "sampling":
+        worker_prefix = f"profiled-{job_id}"
+        try:
+            asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(thread_name_prefix=worker_prefix))
+        except RuntimeError:  # no event loop, nothing runs in worker threads
+            pass
+        profiler = StackSampler(threading.get_ident(), thread_prefix=worker_prefix)
+        profiler.start()
+    else:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:  # only one deterministic profiler can be active at a time
+            logger.warning("Another profiler is already active, job %s runs without profiling", job_id)
+            yield
+            return
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        if mode == "sampling":
+            profiler.stop()
+            profile_path = output_dir / f"{job_id}.folded"
+            profiler.write_folded(profile_path)
+            rows = profiler.summary()
+        else:
+            profiler.disable()
+            profile_path = output_dir / f"{job_id}.prof"
+            profiler.dump_stats(profile_path)
+            rows = _cprofile_rows(profiler)
+        summary_path = output_dir / f"{job_id}.txt"
+        _write_summary(summary_path, job_id, mode, elapsed, rows)
+        logger.info("Profile for job %s written to %s, summary in %s", job_id, profile_path, summary_path)
+        for function, cumulative, _ in rows[:5]:
+            logger.info("[%s] %.3fs %s", job_id, cumulative, function)
@@ -0,0 +1,139 @@
+"""Destinations for scraped cars: MongoDB, JSON lines files, stdout or nothing (benchmarking)."""
+import json
+import os
+import sys
+from typing import TextIO
+
+from mongo.car_repo import CarRepository
+from mongo.database import DataBase
+from scraping.car_parser import CarAdvShortInfo
+from scraping.utilities import logger
+
+SINK_BATCH_SIZE = int(os.getenv("SCRAPE_SINK_BATCH_SIZE", 100))
+
+
+class CarSink:
+    """Buffers written cars and hands them to `_write_batch` in batches of `batch_size`.
+
+    Only MongoDB remembers cars between runs, the other sinks treat every ad they have not written
+    in this run as new and skip thumbnails.
+    """
+    stores_thumbnails = False
+
+    def __init__(self, batch_size: int = SINK_BATCH_SIZE):
+        self.batch_size = batch_size
+        self.written = 0
+        self._batch: list[dict] = []
+        self._seen: set[int] = set()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def known_cars(self, ad_numbers: list[int]) -> dict[int, dict]:
+        """Cars among `ad_numbers` that are already stored, by ad number"""
+        return {ad_number: {'ad_number': ad_number} for ad_number in ad_numbers if ad_number in self._seen}
+
+    async def write(self, car: dict):
+        self._seen.add(car['ad_number'])
+        self._batch.append(car)
+        if len(self._batch) >= self.batch_size:
+            await self.flush()
+
+    async def update_short_info(self, car_ads: list[CarAdvShortInfo]):
+        pass
+
+    async def set_thumbnails(self, thumbnails: dict[int, str]):
+        pass
+
+    async def flush(self):
+        batch, self._batch = self._batch, []
+        if batch:
+            await self._write_batch(batch)
+            self.written += len(batch)
+
+    async def close(self):
+        await self.flush()
+
+    async def _write_batch(self, cars: list[dict]):
+        raise NotImplementedError
+
+
+class MongoSink(CarSink):
+    stores_thumbnails = True
+
+    def __init__(self, db: DataBase, batch_size: int = SINK_BATCH_SIZE):
+        super().__init__(batch_size)
+        self.db = db
+        self.repo = CarRepository(db)
+
+    async def known_cars(self, ad_numbers: list[int]) -> dict[int, dict]:
+        return {**await super().known_cars(ad_numbers), **await self.repo.get_known_cars(ad_numbers)}
+
+    async def _write_batch(self, cars: list[dict]):
+        try:
+            await self.repo.save_cars(cars)
+        except Exception as e:
+            # one bad ad must not lose the batch, the cars are then saved one by one
+            logger.exception("Unhandled error saving a batch of %s ads. %s", len(cars), e)
+            for car in cars:
+                try:
+                    await self.repo.save_car(car)
+                except Exception as e:
+                    logger.exception("Unhandled error saving ad #%s. %s", car.get('ad_number'), e)
+
+    async def update_short_info(self, car_ads: list[CarAdvShortInfo]):
+        await self.repo.update_short_car_info(car_ads, self.db)
+
+    async def set_thumbnails(self, thumbnails: dict[int, str]):
+        await self.flush()  # thumbnails of new cars update the saved documents
+        await self.repo.set_thumbnails(thumbnails)
+
+    async def close(self):
+        await super().close()
+        await self.repo.update_deal_scores()
+
+
+class JsonLinesSink(CarSink):
+    """One JSON document per line, written and flushed per batch so the output can be consumed while scraping"""
+
+    def __init__(self, path: str = None, stream: TextIO = None, batch_size: int = SINK_BATCH_SIZE):
+        super().__init__(batch_size)
+        self._owns_stream = stream is None
+        self.stream = stream if stream is not None else open(path, 'a', encoding='utf-8')
+
+    async def _write_batch(self, cars: list[dict]):
+        self.stream.write(''.join(json.dumps({key: value for key, value in car.items() if key != '_id'},
+                                             ensure_ascii=False, default=str) + '\n' for car in cars))
+        self.stream.flush()
+
+    async def close(self):
+        await super().close()
+        if self._owns_stream:
+            self.stream.close()
+
+
+class NullSink(CarSink):
+    """Discards cars, for measuring fetch and parse throughput"""
+
+    async def _write_batch(self, cars: list[dict]):
+        pass
+
+
+SINKS = ('mongo', 'jsonl', 'stdout', 'null')
+
+
+def create_sink(kind: str, db: DataBase = None, path: str = None, batch_size: int = SINK_BATCH_SIZE) -> CarSink:
+    if kind == 'mongo':
+        return MongoSink(db, batch_size)
+    if kind == 'jsonl':
+        if not path:
+            raise ValueError("The jsonl sink needs an output path")
+        return JsonLinesSink(path, batch_size=batch_size)
+    if kind == 'stdout':
+        return JsonLinesSink(stream=sys.stdout, batch_size=batch_size)
+    if kind == 'null':
+        return NullSink(batch_size)
+    raise ValueError(f"Unknown sink {kind}. Valid sinks are: {', '.join(SINKS)}")
@@ -0,0 +1,25 @@
+import re
+import unicodedata
+
+# letters NFKD does not decompose into a base letter and a combining mark
+_SPECIAL_FOLDS = str.maketrans({'đ': 'dj', 'Đ': 'Dj', 'ß': 'ss', 'ø': 'o', 'Ø': 'O', 'ł': 'l', 'Ł': 'L'})
+_WORD_PATTERN = re.compile(r'\w+')
+
+
+def fold_diacritics(text: str) -> str:
+    """Serbian latin to plain ascii letters: č/ć -> c, š -> s, ž -> z, đ -> dj"""
+    decomposed = unicodedata.normalize('NFKD', text.translate(_SPECIAL_FOLDS))
+    return ''.join(char for char in decomposed if not unicodedata.combining(char))
+
+
+def normalize_text(text: str | None) -> str:
+    """Lower case, diacritics folded, punctuation and repeated whitespace removed"""
+    if not text:
+        return ''
+    return ' '.join(tokenize(text))
+
+
+def tokenize(text: str | None) -> list[str]:
+    if not text:
+        return []
+    return _WORD_PATTERN.findall(fold_diacritics(text).lower())
@@ -0,0 +1,135 @@
+import asyncio
+import hashlib
+import io
+import os
+import threading
+from pathlib import Path
+
+from scraping.utilities import default_request_headers, logger
+
+THUMBNAIL_DIR = os.getenv("THUMBNAIL_DIR", "thumbnails")
+THUMBNAIL_SIZE = tuple(int(side) for side in os.getenv("THUMBNAIL_SIZE", "320x240").split('x'))
+THUMBNAIL_CACHE_BYTES = int(os.getenv("THUMBNAIL_CACHE_MB", 512)) * 1024 * 1024
+THUMBNAIL_CONCURRENCY = int(os.getenv("THUMBNAIL_CONCURRENCY", 8))
+EVICTION_LOW_WATER = 0.9  # fraction of the cache size left after an eviction
+THUMBNAIL_FORMAT = "webp"
+THUMBNAIL_MEDIA_TYPE = "image/webp"
+
+
+def image_url_from_srcset(srcset: str | None) -> str | None:
+    """First candidate url of a `data-srcset` value ("url 1x, url 2x" or a bare url)"""
+    if not srcset:
+        return None
+    candidate = srcset.split(',')[0].split()
+    return candidate[0] if candidate else None
+
+
+def make_thumbnail(image_bytes: bytes, size: tuple[int, int] = THUMBNAIL_SIZE) -> bytes:
+    from PIL import Image  # only scraper processes make thumbnails, the API just serves the files
+
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        image = image.convert('RGB')
+        image.thumbnail(size)
+        output = io.BytesIO()
+        image.save(output, format=THUMBNAIL_FORMAT, quality=80)
+    return output.getvalue()
+
+
+class ThumbnailCache:
+    """Content-addressed thumbnail store on disk with size-bounded LRU eviction.
+
+    Files live at `<directory>/<digest[:2]>/<digest>.webp`, where digest is the sha256 of the
+    thumbnail itself, so identical images are stored once and a digest never changes meaning.
+    Recency is kept in file mtimes, touched by every `get`, and eviction reads them back from disk,
+    so reads of the API processes count for the evictions of the scraper processes.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self._total_bytes: int | None = None  # as of the last scan, plus the writes of this process since
+        self._lock = threading.Lock()
+
+    def _scan(self) -> list[tuple[float, int, Path]]:
+        """mtime, size and path of every stored thumbnail, least recently used first"""
+        files = []
+        for path in self.directory.glob(f"*/*.{THUMBNAIL_FORMAT}"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:  # evicted by another process since the glob
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        return sorted(files)
+
+    def path_for(self, digest: str) -> Path:
+        return self.directory / digest[:2] / f"{digest}.{THUMBNAIL_FORMAT}"
+
+    def get(self, digest: str) -> Path | None:
+        """Stored thumbnail, marked as recently used. Touches the file system, async code runs it in a thread"""
+        path = self.path_for(digest)
+        try:
+            os.utime(path)
+        except FileNotFoundError:  # never stored, or evicted by this or another process
+            return None
+        return path
+
+    def put(self, thumbnail: bytes) -> str:
+        digest = hashlib.sha256(thumbnail).hexdigest()
+        path = self.path_for(digest)
+        with self._lock:
+            if self._total_bytes is None:
+                self._total_bytes = sum(size for _, size, _ in self._scan())
+            try:
+                os.utime(path)  # already stored
+            except FileNotFoundError:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                tmp_path = path.with_suffix('.tmp')
+                tmp_path.write_bytes(thumbnail)
+                tmp_path.replace(path)
+                self._total_bytes += len(thumbnail)
+            if self._total_bytes > self.max_bytes:
+                self._evict(keep=path)
+        return digest
+
+    def _evict(self, keep: Path):
+        """Removes the least recently used thumbnails down to EVICTION_LOW_WATER of `max_bytes`.
+
+        Evicting below the limit spaces out the scans, which stat every stored file.
+        """
+        files = self._scan()
+        self._total_bytes = sum(size for _, size, _ in files)
+        for _, size, path in files:
+            if self._total_bytes <= self.max_bytes * EVICTION_LOW_WATER:
+                break
+            if path != keep:
+                path.unlink(missing_ok=True)
+                self._total_bytes -= size
+
+
+thumbnail_cache = ThumbnailCache(THUMBNAIL_DIR, THUMBNAIL_CACHE_BYTES)
+
+
+def fetch_thumbnail(image_url: str, cache: ThumbnailCache = thumbnail_cache) -> str | None:
+    import requests
+
+    try:
+        response = requests.get(image_url, headers=default_request_headers(), timeout=10)
+        response.raise_for_status()
+        return cache.put(make_thumbnail(response.content))
+    except Exception as e:
+        logger.warning("Failed to make thumbnail for %s. %s", image_url, e)
+        return None
+
+
+async def fetch_thumbnails(image_urls: dict[int, str], cache: ThumbnailCache = thumbnail_cache,
+                           concurrency: int = THUMBNAIL_CONCURRENCY) -> dict[int, str]:
+    """Fetches and stores thumbnails concurrently. Returns digests by ad number, failed images are left out"""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch(image_url: str):
+        async with semaphore:
+            return await asyncio.to_thread(fetch_thumbnail, image_url, cache)
+
+    ad_numbers = list(image_urls)
+    digests = await asyncio.gather(*(fetch(image_urls[ad_number]) for ad_number in ad_numbers))
+    return {ad_number: digest for ad_number, digest in zip(ad_numbers, digests) if digest}
@@ -1,10 +1,11 @@
 import logging
 import random
 import re
+from typing import TYPE_CHECKING
 from urllib.parse import urlparse
 
-import brotli
-from bs4 import Tag, BeautifulSoup
+if TYPE_CHECKING:
+    from bs4 import Tag
 
 logger = logging.getLogger("scraper")
 logger.setLevel(logging.INFO)
@@ -58,26 +59,30 @@ def default_request_headers():
     ])
 
 
-def get_soup_from_response(response):
+def get_html_from_response(response) -> bytes | str:
     if response.headers.get('Content-Encoding') == 'br':
+        import brotli
+
         try:
-            decompressed_data = brotli.decompress(response.content)
+            return brotli.decompress(response.content)
         except brotli.error:
-            decompressed_data = response.content
-        soup = BeautifulSoup(decompressed_data, 'html.parser')
-    else:
-        soup = BeautifulSoup(response.text, 'html.parser')
-    return soup
+            return response.content
+    return response.text
+
+
+def get_soup_from_response(response):
+    from bs4 import BeautifulSoup
+    return BeautifulSoup(get_html_from_response(response), 'html.parser')
 
 
-def safe_extract_text(section: Tag, label: str):
+def safe_extract_text(section: 'Tag', label: str):
     element = section.find(string=re.compile(rf'{re.escape(label)}\s*:?\s*'))
     if element:
         return element.find_next('div').text.strip()
     return None
 
 
-def safe_extract_section(section: Tag, label: str):
+def safe_extract_section(section: 'Tag', label: str):
     element = section.find(string=re.compile(rf'{label}\s*:?\s*'))
     if element:
         return element.find_next('div')
@@ -0,0 +1,26 @@
+import pytest
+
+from mongo.database import DataBase
+
+COLLECTIONS = {
+    'car_collection': 'cars',
+    'meta_collection': 'meta',
+    'rollup_collection': 'car_rollups',
+    'saved_search_collection': 'saved_searches',
+    'crawl_target_collection': 'crawl_targets',
+}
+
+
+@pytest.fixture
+def db() -> DataBase:
+    """DataBase backed by an in-memory mongomock client, analytics reads go to the same collection"""
+    mongomock_motor = pytest.importorskip('mongomock_motor')
+    database = DataBase('mongodb://test')
+    database.client = mongomock_motor.AsyncMongoMockClient()
+    database.client.secondaries = set()  # standalone server
+    database.database = database.client.car_database
+    for attribute, name in COLLECTIONS.items():
+        setattr(database, attribute, database.database.get_collection(name))
+    database.analytics_collection = database.car_collection
+    database.analytics_meta_collection = database.meta_collection
+    return database
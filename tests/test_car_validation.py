@@ -0,0 +1,54 @@
+import asyncio
+
+from bson import ObjectId
+
+import metrics
+from mongo.car_repo import CarRepository
+
+
+def document(**fields) -> dict:
+    return {'_id': ObjectId(), 'ad_number': 1, 'link': '/auto-oglasi/1/', 'img_src': None, 'make': 'Audi',
+            'model': 'A4', 'year': 2010, 'price': 5000, 'engine_power': 100, 'engine_capacity': 1968,
+            'description': 'not part of a group car', **fields}
+
+
+def counts() -> tuple[int, int]:
+    return metrics.counters['car_documents_invalid_total'], metrics.counters['car_documents_coerced_total']
+
+
+def test_scraped_documents_are_passed_through():
+    before = counts()
+    stored = document()
+    car = CarRepository.car_from_mongo(stored)
+
+    assert car['id'] == str(stored['_id']) and car['price'] == 5000
+    assert 'description' not in car and 'ad_number' not in car
+    assert counts() == before
+
+
+def test_documents_with_convertible_values_are_coerced_and_counted():
+    invalid, coerced = counts()
+    car = CarRepository.car_from_mongo(document(price='5000', year=2010.0))
+
+    assert (car['price'], car['year']) == (5000, 2010)
+    assert counts() == (invalid, coerced + 1)
+
+
+def test_invalid_documents_are_dropped_and_counted():
+    invalid, coerced = counts()
+    assert CarRepository.car_from_mongo(document(price='na upit')) is None
+    assert CarRepository.car_from_mongo(document(make=None)) is None
+    assert counts() == (invalid + 2, coerced)
+    assert f'car_documents_invalid_total {invalid + 2}' in metrics.render()
+
+
+def test_invalid_documents_are_left_out_of_groups(db):
+    async def group():
+        await db.car_collection.insert_many([document(ad_number=1), document(ad_number=2, price=None),
+                                             document(ad_number=3, price='6000')])
+        return await CarRepository(db).get_grouped_data(['make'], {})
+
+    invalid, _ = counts()
+    groups = asyncio.run(group())
+    assert [car['price'] for car in groups[0]['cars']] == [5000, 6000]
+    assert counts()[0] == invalid + 1
@@ -0,0 +1,19 @@
+import asyncio
+
+from mongo.car_repo import CarRepository
+
+
+def test_deal_scores_read_the_cars_just_written_not_a_lagging_secondary(db):
+    # a secondary that has not replicated any car yet
+    db.analytics_collection = db.database.get_collection('lagging_secondary')
+    cars = [{'ad_number': number, 'make': 'Skoda', 'model': 'Octavia', 'year': 2010 + number % 8,
+             'mileage': 200000 - number * 10000, 'engine_power': 110, 'engine_capacity': 1968,
+             'price': 6000 + number * 700 + (number % 3) * 300} for number in range(12)]
+
+    async def scenario():
+        await db.car_collection.insert_many(cars)
+        updated = await CarRepository(db).update_deal_scores()
+        scored = await db.car_collection.count_documents({'deal_score': {'$exists': True}})
+        return updated, scored
+
+    assert asyncio.run(scenario()) == (12, 12)
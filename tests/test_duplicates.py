@@ -0,0 +1,85 @@
+import asyncio
+import datetime
+
+from mongo.car_repo import CarRepository
+from scraping.minhash import car_shingles, minhash_signature, lsh_bands, estimated_similarity, can_join_cluster, \
+    DUPLICATE_THRESHOLD
+
+DESCRIPTION = ("Prodajem golfa u odlicnom stanju, redovno servisiran u ovlascenom servisu, "
+               "nove gume i akumulator, garancija na kilometrazu, registrovan do juna")
+
+
+def grey_diesel_golf(ad_number: int, image: str, description: str | None = None) -> dict:
+    car = {'ad_number': ad_number, 'make': 'Volkswagen', 'model': 'Golf 7', 'year': 2016, 'engine_power': 81,
+           'engine_capacity': 1598, 'fuel_type': 'Dizel', 'body_type': 'Hečbek', 'color': 'Siva',
+           'transmission': 'Manuelni 5 brzina', 'mileage': 182000 + ad_number,
+           'img_src': f'https://slike.polovniautomobili.com/{image}.jpg 1x', 'description': description}
+    signature = minhash_signature(car_shingles(car, description))
+    return {**car, 'minhash': signature, 'lsh_bands': lsh_bands(signature)}
+
+
+def clusters(db, *cars: dict) -> list[int]:
+    async def save_all():
+        repo = CarRepository(db)
+        for car in cars:
+            await repo.save_car(dict(car))
+        return [(await repo.get_car(car['ad_number']))['cluster_id'] for car in cars]
+
+    return asyncio.run(save_all())
+
+
+def test_same_configuration_without_description_is_not_similar():
+    first, second = grey_diesel_golf(1, 'a1'), grey_diesel_golf(2, 'b2')
+    assert estimated_similarity(first['minhash'], second['minhash']) < DUPLICATE_THRESHOLD
+
+
+def test_same_configuration_is_not_clustered(db):
+    assert clusters(db, grey_diesel_golf(1, 'a1'), grey_diesel_golf(2, 'b2')) == [1, 2]
+
+
+def test_one_line_description_does_not_join_cluster(db):
+    line = "Auto u odlicnom stanju"
+    assert not can_join_cluster(line)
+    assert clusters(db, grey_diesel_golf(1, 'a1', line), grey_diesel_golf(2, 'b2', line)) == [1, 2]
+
+
+def test_reposted_ad_joins_cluster(db):
+    assert clusters(db, grey_diesel_golf(1, 'a1', DESCRIPTION), grey_diesel_golf(2, 'a1', DESCRIPTION)) == [1, 1]
+
+
+def test_reposted_ad_joins_cluster_saved_in_the_same_batch(db):
+    async def save_batch():
+        repo = CarRepository(db)
+        await repo.save_car(grey_diesel_golf(1, 'a1', DESCRIPTION))
+        await repo.save_cars([grey_diesel_golf(2, 'a1', DESCRIPTION), grey_diesel_golf(3, 'b2'),
+                              grey_diesel_golf(4, 'a1', DESCRIPTION)])
+        return [(await repo.get_car(ad_number))['cluster_id'] for ad_number in (1, 2, 3, 4)]
+
+    assert asyncio.run(save_batch()) == [1, 1, 3, 1]
+
+
+def test_reposted_ad_with_different_specs_is_not_clustered(db):
+    repost = {**grey_diesel_golf(2, 'a1', DESCRIPTION), 'year': 2017}
+    assert clusters(db, grey_diesel_golf(1, 'a1', DESCRIPTION), repost) == [1, 2]
+
+
+def test_collapsed_groups_keep_the_newest_ad_without_carrying_whole_ads(db, monkeypatch):
+    relisted = [{**grey_diesel_golf(number, 'relisted', DESCRIPTION), 'price': 9000,
+                 'updatedAt': datetime.datetime(2024, 1, number, tzinfo=datetime.timezone.utc)} for number in (1, 2)]
+    pipelines = []
+    aggregate = type(db.analytics_collection).aggregate
+
+    def recording_aggregate(collection, pipeline, *args, **kwargs):
+        pipelines.append(pipeline)
+        return aggregate(collection, pipeline, *args, **kwargs)
+
+    monkeypatch.setattr(type(db.analytics_collection), 'aggregate', recording_aggregate)
+    assert clusters(db, *relisted) == [1, 1]
+
+    groups = asyncio.run(CarRepository(db).get_grouped_data(['make'], {}, collapse_duplicates=True))
+    assert [(group['count'], [car['duplicate_count'] for car in group['cars']]) for group in groups] == [(1, [2])]
+    assert groups[0]['cars'][0]['price'] == 9000
+    collapse_start = next(index for index, stage in enumerate(pipelines[0]) if '$sort' in stage)
+    projected = pipelines[0][collapse_start - 1]['$project']
+    assert {'cluster_id', 'updatedAt', 'ad_number'} <= set(projected)
+    assert not {'description', 'minhash', 'lsh_bands'} & set(projected)
@@ -0,0 +1,139 @@
+import asyncio
+import datetime
+
+import pytest
+
+from analytics.snapshot import car_snapshot, CarSnapshot
+from mongo.car_repo import CarRepository
+from mongo.database import get_database
+
+
+SEARCH_URL = 'https://www.polovniautomobili.com/auto-oglasi/pretraga'
+
+
+def car(ad_number: int, price: int = 5000) -> dict:
+    return {'ad_number': ad_number, 'link': f'/auto-oglasi/{ad_number}/', 'img_src': None, 'make': 'Audi',
+            'model': 'A4', 'year': 2010, 'price': price, 'mileage': 150000, 'engine_power': 100,
+            'engine_capacity': 1968, 'updatedAt': datetime.datetime.now(datetime.timezone.utc)}
+
+
+@pytest.fixture
+def client(db):
+    pytest.importorskip('httpx')
+    from fastapi.testclient import TestClient
+    import api
+
+    api.app.dependency_overrides[get_database] = lambda: db
+    yield TestClient(api.app)
+    api.app.dependency_overrides.clear()
+    car_snapshot.__dict__.update(CarSnapshot().__dict__)
+
+
+def save(db, *cars: dict):
+    async def save_all():
+        for new_car in cars:
+            await CarRepository(db).save_car(new_car)
+
+    asyncio.run(save_all())
+
+
+def test_snapshot_responses_are_tagged_with_the_snapshot_version(client, db):
+    save(db, car(1))
+    asyncio.run(car_snapshot.refresh(db, full=True))
+    first = client.get('/cars/grouped', params={'group_by': ['make']})
+    etag = first.headers['etag']
+
+    # written to MongoDB but not yet in the snapshot: same content, so the ETag must not change
+    save(db, car(2, price=7000))
+    stale = client.get('/cars/grouped', params={'group_by': ['make']}, headers={'If-None-Match': etag})
+    assert stale.status_code == 304
+
+    asyncio.run(car_snapshot.refresh(db))
+    fresh = client.get('/cars/grouped', params={'group_by': ['make']}, headers={'If-None-Match': etag})
+    assert fresh.status_code == 200
+    assert fresh.headers['etag'] != etag
+    assert fresh.json()[0]['count'] == 2
+
+
+def test_idle_snapshot_refreshes_keep_the_etag(client, db):
+    save(db, car(1), car(2))
+    asyncio.run(car_snapshot.refresh(db, full=True))
+    etag = client.get('/cars/grouped', params={'group_by': ['make']}).headers['etag']
+    for _ in range(3):
+        asyncio.run(car_snapshot.refresh(db))
+    assert client.get('/cars/grouped', params={'group_by': ['make']},
+                      headers={'If-None-Match': etag}).status_code == 304
+
+
+def test_mongo_responses_are_tagged_with_the_generation(client, db):
+    save(db, car(1))
+    etag = client.get('/cars/grouped', params={'group_by': ['make']}).headers['etag']
+    assert client.get('/cars/grouped', params={'group_by': ['make']},
+                      headers={'If-None-Match': etag}).status_code == 304
+    save(db, car(2))
+    assert client.get('/cars/grouped', params={'group_by': ['make']},
+                      headers={'If-None-Match': etag}).status_code == 200
+
+
+class RecordedSession:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+
+class SessionCollection:
+    """Collection that records the session of every call, mongomock does not support sessions"""
+
+    def __init__(self, collection, sessions: list):
+        self.name, self.read_preference = collection.name, collection.read_preference
+        self._collection, self._sessions = collection, sessions
+
+    def __getattr__(self, name):
+        method = getattr(self._collection, name)
+
+        def call(*args, session=None, **kwargs):
+            self._sessions.append(session)
+            return method(*args, **kwargs)
+
+        return call
+
+
+@pytest.fixture
+def replica_set(db, monkeypatch) -> list:
+    """Analytics reads may go to a secondary, returns the sessions they were made in"""
+    sessions = []
+
+    async def start_session(causal_consistency: bool = False):
+        assert causal_consistency
+        return RecordedSession()
+
+    async def command(command: dict, session=None, read_preference=None):
+        sessions.append(session)
+        return {'n': await db.car_collection.count_documents({})}
+
+    db.client.secondaries = {('secondary', 27017)}
+    monkeypatch.setattr(db.client, 'start_session', start_session)
+    monkeypatch.setattr(db.database, 'command', command)
+    db.analytics_collection = SessionCollection(db.car_collection, sessions)
+    db.analytics_meta_collection = SessionCollection(db.meta_collection, sessions)
+    return sessions
+
+
+def test_reads_from_secondaries_are_tagged_in_one_causally_consistent_session(client, db, replica_set):
+    save(db, car(1))
+    for path, params in (('/cars/grouped', {'group_by': ['make']}), ('/cars/makes', {}),
+                         ('/cars/statistics', {'search_url': f'{SEARCH_URL}?price_from=1000'})):
+        replica_set.clear()
+        response = client.get(path, params=params)
+        assert response.status_code == 200
+        # generation, size and data all read in the same session
+        assert len(replica_set) == 3 and isinstance(replica_set[0], RecordedSession)
+        assert all(session is replica_set[0] for session in replica_set)
+        assert client.get(path, params=params, headers={'If-None-Match': response.headers['etag']}).status_code == 304
+
+    etag = client.get('/cars/grouped', params={'group_by': ['make']}).headers['etag']
+    save(db, car(2))
+    assert client.get('/cars/grouped', params={'group_by': ['make']},
+                      headers={'If-None-Match': etag}).status_code == 200
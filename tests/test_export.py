@@ -0,0 +1,79 @@
+import asyncio
+import datetime
+
+import pytest
+
+import metrics
+
+pa = pytest.importorskip('pyarrow')
+pq = pytest.importorskip('pyarrow.parquet')
+from mongo.export import export_cars, stream_export, CAR_EXPORT_SCHEMA  # noqa: E402 (needs pyarrow)
+
+MODELS = {'Audi': ['A4', 'A6'], 'BMW': ['320', 'X5'], 'Škoda': ['Octavia']}
+
+
+def cars(count: int) -> list[dict]:
+    """`count` cars cycling through a few makes, models and options, so every batch repeats them"""
+    pairs = [(make, model) for make, models in MODELS.items() for model in models]
+    return [{'ad_number': number, 'make': pairs[number % len(pairs)][0], 'model': pairs[number % len(pairs)][1],
+             'year': 2000 + number % 20, 'price': 1000 * number, 'mileage': 100000 + number,
+             'fuel_type': ('Dizel', 'Benzin')[number % 2], 'safety': ['ABS', 'ESP'][:number % 3],
+             'description': f'oglas {number}', 'deal_score': number / 100,
+             'updatedAt': datetime.datetime(2024, 1, 1 + number % 28, tzinfo=datetime.timezone.utc)}
+            for number in range(count)]
+
+
+def insert(db, documents: list[dict]):
+    asyncio.run(db.car_collection.insert_many([dict(document) for document in documents]))
+
+
+def read_export(path, export_format: str) -> pa.Table:
+    if export_format == 'parquet':
+        return pq.read_table(path)
+    with pa.ipc.open_stream(path) as reader:
+        return reader.read_all()
+
+
+@pytest.mark.parametrize('export_format', ['parquet', 'arrow'])
+def test_export_round_trip_over_several_batches(db, tmp_path, export_format):
+    expected = cars(25)
+    insert(db, expected)
+    path = tmp_path / f'cars.{export_format}'
+
+    assert asyncio.run(export_cars(db, str(path), export_format, batch_size=10)) == 25
+    table = read_export(path, export_format)
+    assert table.num_rows == 25
+    for name in ('make', 'model', 'fuel_type'):
+        assert pa.types.is_dictionary(table.schema.field(name).type)
+    assert pa.types.is_dictionary(table.schema.field('safety').type.value_type)
+    rows = sorted(table.to_pylist(), key=lambda row: row['ad_number'])
+    for row, car in zip(rows, expected):
+        assert {field: row[field] for field in car} == car
+
+
+def test_streamed_export_is_the_exported_file(db, tmp_path):
+    insert(db, cars(25))
+    path = tmp_path / 'cars.arrows'
+    asyncio.run(export_cars(db, str(path), 'arrow', batch_size=10))
+
+    async def stream() -> bytes:
+        return b''.join([chunk async for chunk in stream_export(db, 'arrow', batch_size=10)])
+
+    assert read_export(pa.BufferReader(asyncio.run(stream())), 'arrow').equals(read_export(path, 'arrow'))
+
+
+def test_values_of_the_wrong_type_are_coerced_or_their_car_left_out(db, tmp_path):
+    good, coerced, broken = cars(3)
+    insert(db, [good, {**coerced, 'price': '5000', 'year': 2010.0, 'safety': 'ABS', 'make': 7},
+                {**broken, 'mileage': 'puno'}])
+    coerced_before = metrics.counters['export_values_coerced_total']
+    skipped_before = metrics.counters['export_rows_skipped_total']
+    path = tmp_path / 'cars.parquet'
+
+    assert asyncio.run(export_cars(db, str(path), batch_size=10)) == 2
+    rows = {row['ad_number']: row for row in read_export(path, 'parquet').to_pylist()}
+    assert set(rows) == {good['ad_number'], coerced['ad_number']}
+    assert (rows[1]['price'], rows[1]['year'], rows[1]['safety'], rows[1]['make']) == (5000, 2010, ['ABS'], '7')
+    assert metrics.counters['export_values_coerced_total'] - coerced_before == 2
+    assert metrics.counters['export_rows_skipped_total'] - skipped_before == 1
+    assert read_export(path, 'parquet').schema == CAR_EXPORT_SCHEMA
@@ -0,0 +1,56 @@
+import asyncio
+
+from mongo import migrations
+from mongo.database import CAR_TTL_SECONDS
+
+
+def test_changed_ttl_is_applied_to_existing_index(db, monkeypatch):
+    commands = []
+
+    async def command(*args, **kwargs):
+        commands.append((args, kwargs))
+
+    async def scenario():
+        await db.car_collection.create_index('updatedAt', expireAfterSeconds=CAR_TTL_SECONDS + 60)
+        monkeypatch.setattr(db.database, 'command', command)  # mongomock has no collMod
+        await migrations.sync_car_ttl(db)
+
+    asyncio.run(scenario())
+    assert commands == [(('collMod', 'cars'),
+                         {'index': {'keyPattern': {'updatedAt': 1}, 'expireAfterSeconds': CAR_TTL_SECONDS}})]
+
+
+def test_matching_ttl_is_left_alone(db, monkeypatch):
+    commands = []
+
+    async def command(*args, **kwargs):
+        commands.append((args, kwargs))
+
+    async def scenario():
+        await db.car_collection.create_index('updatedAt', expireAfterSeconds=CAR_TTL_SECONDS)
+        monkeypatch.setattr(db.database, 'command', command)
+        await migrations.sync_car_ttl(db)
+
+    asyncio.run(scenario())
+    assert commands == []
+
+
+def test_concurrent_callers_apply_each_migration_once(db, monkeypatch):
+    applied = []
+
+    def counted(version: int):
+        async def apply(_):
+            applied.append(version)
+            await asyncio.sleep(0.05)  # long enough for the other callers to find the lease taken
+        return version, f'migration_{version}', apply
+
+    monkeypatch.setattr(migrations, 'migrations', [counted(1), counted(2)])
+    monkeypatch.setattr(migrations, 'MIGRATION_WAIT_SECONDS', 0.01)
+
+    async def workers():
+        return await asyncio.gather(*(migrations.migrate(db) for _ in range(4)))
+
+    assert asyncio.run(workers()) == [2, 2, 2, 2]
+    assert applied == [1, 2]
+    schema = asyncio.run(db.meta_collection.find_one({'_id': migrations.SCHEMA_ID}))
+    assert schema == {'_id': migrations.SCHEMA_ID, 'version': 2}  # lease released
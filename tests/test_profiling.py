@@ -0,0 +1,77 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from mongo.database import get_database
+
+
+@pytest.fixture
+def scrape_calls(db, monkeypatch):
+    """Records which way /ads ran its job and on which thread, without scraping anything"""
+    pytest.importorskip('httpx')
+    main = pytest.importorskip('main')
+    from fastapi.testclient import TestClient
+    import api
+
+    calls = []
+
+    async def run_scrape_job(search_url, db_connection, start_page=1, job_id=None, profile=None, max_pages=None):
+        calls.append(('event loop', threading.get_ident(), max_pages))
+
+    def run_scrape_job_in_thread(search_url, start_page=1, job_id=None, profile=None, max_pages=None):
+        calls.append(('own thread', threading.get_ident(), max_pages))
+
+    monkeypatch.setattr(main, 'run_scrape_job', run_scrape_job)
+    monkeypatch.setattr(main, 'run_scrape_job_in_thread', run_scrape_job_in_thread)
+    api.app.dependency_overrides[get_database] = lambda: db
+    yield TestClient(api.app), calls
+    api.app.dependency_overrides.clear()
+
+
+def test_unknown_profile_is_rejected(scrape_calls):
+    client, calls = scrape_calls
+    response = client.post('/ads', json={'search_url': 'https://example.com', 'profile': 'perf'})
+    assert response.status_code == 422
+    assert calls == []
+
+
+def test_profiled_jobs_run_on_their_own_thread(scrape_calls):
+    client, calls = scrape_calls
+    for profile in ('off', 'sampling', 'cprofile'):
+        assert client.post('/ads', json={'search_url': 'https://example.com', 'profile': profile}).status_code == 200
+    (plain, loop_thread, _), *profiled = calls
+    assert plain == 'event loop'
+    assert [way for way, _, _ in profiled] == ['own thread', 'own thread']
+    assert all(thread != loop_thread for _, thread, _ in profiled)
+
+
+def test_jobs_stop_after_max_pages(scrape_calls):
+    client, calls = scrape_calls
+    for profile in ('off', 'sampling'):
+        client.post('/ads', json={'search_url': 'https://example.com', 'max_pages': 3, 'profile': profile})
+    assert [max_pages for _, _, max_pages in calls] == [3, 3]
+
+
+def _parse_in_worker_thread():
+    deadline = time.perf_counter() + 0.3
+    while time.perf_counter() < deadline:
+        sum(range(1000))
+
+
+def test_profiled_job_writes_stacks_of_its_worker_threads(tmp_path, monkeypatch):
+    main = pytest.importorskip('main')
+    from scraping import profiling
+
+    async def scrape_all_pages(car_list_url, db_connection=None, start_page=1, concurrency=1, **kwargs):
+        await asyncio.to_thread(_parse_in_worker_thread)  # as concurrent ad fetching and thumbnails do
+
+    monkeypatch.setattr(profiling, 'PROFILE_DIR', str(tmp_path))
+    monkeypatch.setattr(main, 'scrape_all_pages', scrape_all_pages)
+    asyncio.run(main.run_scrape_job('https://example.com', None, job_id='job', profile='sampling'))
+
+    folded = (tmp_path / 'job.folded').read_text()
+    summary = (tmp_path / 'job.txt').read_text()
+    assert '_parse_in_worker_thread' in folded
+    assert 'mode: sampling' in summary and 'cumulative' in summary.splitlines()[4]
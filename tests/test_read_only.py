@@ -0,0 +1,45 @@
+import asyncio
+
+import pytest
+
+
+@pytest.fixture
+def api_startup(monkeypatch):
+    """The API lifespan with MongoDB stubbed out, recording what it runs"""
+    import api
+
+    calls = []
+
+    async def record(name):
+        calls.append(name)
+
+    async def idle(*args):
+        await asyncio.Event().wait()
+
+    monkeypatch.setattr(api.database, 'connect', lambda: record('connect'))
+    monkeypatch.setattr(api.database, 'warm_up', lambda: record('warm_up'))
+    monkeypatch.setattr(api.database, 'disconnect', lambda: record('disconnect'))
+    monkeypatch.setattr(api, 'migrate', lambda db: record('migrate'))
+    monkeypatch.setattr(api.RollupRepository, 'run', lambda self: record('rollup rebuilds'))
+    monkeypatch.setattr(api.search_matcher, 'run', idle)
+
+    def start(read_only: bool) -> list[str]:
+        monkeypatch.setattr(api, 'API_READ_ONLY', read_only)
+        calls.clear()
+
+        async def lifespan():
+            async with api.lifespan(api.app):
+                await asyncio.sleep(0)
+
+        asyncio.run(lifespan())
+        return calls
+
+    return start
+
+
+def test_read_only_replica_does_not_write(api_startup):
+    assert api_startup(read_only=True) == ['connect', 'warm_up', 'disconnect']
+
+
+def test_full_api_migrates_and_rebuilds_rollups(api_startup):
+    assert api_startup(read_only=False) == ['connect', 'warm_up', 'migrate', 'rollup rebuilds', 'disconnect']
@@ -0,0 +1,74 @@
+import gzip
+
+import brotli
+import pytest
+
+from responses import to_compact_groups, compressed_response, json_bytes, CAR_COLUMNS, MIN_COMPRESS_SIZE
+
+
+def car(make: str, model: str, year: int, price: int) -> dict:
+    return {'id': f'{make}-{model}-{price}', 'link': f'/auto-oglasi/{price}/', 'img_src': None, 'thumbnail': None,
+            'make': make, 'model': model, 'year': year, 'price': price, 'engine_power': 100,
+            'engine_capacity': 1968, 'deal_score': 0.1, 'expected_price': price + 500, 'duplicate_count': None}
+
+
+GROUPS = [
+    {'make': 'Audi', 'count': 2, 'cars': [car('Audi', 'A4', 2010, 5000), car('Audi', 'A6', 2012, 9000)]},
+    {'make': 'BMW', 'count': 1, 'cars': [car('BMW', '320', 2010, 7000)]},
+]
+
+
+def from_compact(compact: dict) -> list[dict]:
+    """Groups as `to_compact_groups` received them, what a client does with the compact format"""
+    groups = []
+    for group in compact['groups']:
+        columns = {field: [compact['dictionaries'][field][code] for code in values]
+                   if field in compact['dictionaries'] else values for field, values in group['cars'].items()}
+        cars = [dict(zip(compact['columns'], row)) for row in zip(*(columns[field] for field in compact['columns']))]
+        groups.append({**{key: value for key, value in group.items() if key != 'cars'}, 'cars': cars})
+    return groups
+
+
+def test_compact_groups_decode_to_the_grouped_cars():
+    compact = to_compact_groups(GROUPS)
+    assert from_compact(compact) == GROUPS
+    assert compact['columns'] == list(CAR_COLUMNS)
+    # dictionaries are shared by all groups, every value is stored once
+    assert compact['dictionaries'] == {'make': ['Audi', 'BMW'], 'model': ['A4', 'A6', '320'], 'year': [2010, 2012]}
+    assert compact['groups'][1]['cars']['year'] == [0]
+
+
+def test_compact_groups_leave_out_dropped_cars():
+    compact = to_compact_groups([{'make': 'Audi', 'cars': [car('Audi', 'A4', 2010, 5000), None]}])
+    assert compact['groups'][0]['count'] == 1
+    assert compact['groups'][0]['cars']['price'] == [5000]
+
+
+BODY = json_bytes(GROUPS * 20)
+
+
+@pytest.mark.parametrize('accept_encoding, encoding', [
+    ('gzip, deflate, br', 'br'),
+    ('gzip', 'gzip'),
+    ('GZIP;q=0.5, identity', 'gzip'),
+    ('br;q=0, gzip', 'gzip'),
+    ('br;q=0, gzip;q=0', None),
+    ('deflate', None),
+    (None, None),
+])
+def test_body_is_compressed_with_the_best_accepted_encoding(accept_encoding, encoding):
+    assert len(BODY) >= MIN_COMPRESS_SIZE
+    response = compressed_response(BODY, accept_encoding)
+    assert response.headers.get('content-encoding') == encoding
+    assert response.headers['vary'] == 'Accept-Encoding'
+    decompress = {'br': brotli.decompress, 'gzip': gzip.decompress, None: bytes}[encoding]
+    assert decompress(response.body) == BODY
+
+
+def test_small_bodies_are_sent_as_they_are():
+    body = json_bytes(GROUPS[:1])
+    assert len(body) < MIN_COMPRESS_SIZE
+    response = compressed_response(body, 'br, gzip', headers={'ETag': 'W/"1"'})
+    assert 'content-encoding' not in response.headers
+    assert response.body == body
+    assert response.headers['etag'] == 'W/"1"'
@@ -0,0 +1,103 @@
+import asyncio
+
+from analytics.market_stats import grouped_stats_from_columns, STATISTICS_FIELDS
+from mongo.car_repo import CarRepository
+from mongo.leases import LeaseRepository
+from mongo.rollups import RollupRepository, REBUILD_LEASE_ID
+
+CARS = [
+    {'ad_number': 1, 'make': 'Audi', 'model': 'A4', 'year': 2010, 'price': 5000, 'mileage': 150000,
+     'engine_power': 100},
+    {'ad_number': 2, 'make': 'Audi', 'model': 'A4', 'year': 2010, 'price': 7000, 'mileage': 90000, 'engine_power': 110},
+    {'ad_number': 3, 'make': 'Audi', 'model': 'A4', 'year': 2010, 'price': None, 'mileage': 200000,
+     'engine_power': 100},
+    {'ad_number': 4, 'make': 'Audi', 'model': 'A6', 'year': 2012, 'price': 9000, 'mileage': 120000,
+     'engine_power': 140},
+]
+
+
+def statistics(db, rollups: RollupRepository):
+    async def both():
+        columns = await CarRepository(db).get_columns(('make', 'model', *STATISTICS_FIELDS), {})
+        exact = grouped_stats_from_columns(columns, ['make', 'model'])
+        return exact, await rollups.get_statistics(['make', 'model'], {})
+
+    exact, rolled_up = asyncio.run(both())
+    return _by_make_and_model(exact), _by_make_and_model(rolled_up)
+
+
+def _by_make_and_model(groups: list[dict]) -> dict[tuple, dict]:
+    return {(group['make'], group['model']): group for group in groups}
+
+
+def test_mean_price_leaves_out_cars_without_price(db):
+    rollups = RollupRepository(db)
+
+    async def save():
+        for car in CARS:
+            await db.car_collection.insert_one(dict(car))
+            await rollups.apply(None, car)
+
+    asyncio.run(save())
+    exact, rolled_up = statistics(db, rollups)
+    assert rolled_up[('Audi', 'A4')]['price']['mean'] == exact[('Audi', 'A4')]['price']['mean'] == 6000
+    assert rolled_up[('Audi', 'A4')]['count'] == exact[('Audi', 'A4')]['count'] == 3
+
+
+def test_batch_saves_move_cars_between_rollups(db):
+    rollups = RollupRepository(db)
+
+    async def save_batches():
+        repo = CarRepository(db)
+        await repo.save_cars([dict(car) for car in CARS[:3]])
+        # a changed price, a car moving to another model and a new car, in one batch
+        await repo.save_cars([{**CARS[0], 'price': 6000}, {**CARS[1], 'model': 'A6'}, dict(CARS[3])])
+
+    asyncio.run(save_batches())
+    exact, rolled_up = statistics(db, rollups)
+    for key, count, mean_price in ((('Audi', 'A4'), 2, 6000), (('Audi', 'A6'), 2, 8000)):
+        assert rolled_up[key]['count'] == exact[key]['count'] == count
+        assert rolled_up[key]['price']['mean'] == exact[key]['price']['mean'] == mean_price
+
+
+def test_rebuild_drops_cars_removed_without_apply(db):
+    rollups = RollupRepository(db)
+
+    async def save_and_expire():
+        for car in CARS:
+            await db.car_collection.insert_one(dict(car))
+        await rollups.rebuild()
+        # what the TTL index does: documents disappear without passing through apply
+        await db.car_collection.delete_many({'model': 'A6'})
+        await db.car_collection.delete_one({'ad_number': 1})
+        await rollups.rebuild()
+
+    asyncio.run(save_and_expire())
+    exact, rolled_up = statistics(db, rollups)
+    assert set(rolled_up) == set(exact) == {('Audi', 'A4')}
+    assert rolled_up[('Audi', 'A4')]['count'] == 2
+    assert rolled_up[('Audi', 'A4')]['price']['mean'] == 7000
+
+
+def test_rebuild_of_unchanged_rollups_keeps_the_generation(db):
+    rollups = RollupRepository(db)
+
+    async def rebuild_twice():
+        for car in CARS:
+            await db.car_collection.insert_one(dict(car))
+        first = await rollups.rebuild()
+        generation = await CarRepository(db).get_generation()
+        second = await rollups.rebuild()
+        return first, second, generation, await CarRepository(db).get_generation()
+
+    first, second, generation_before, generation_after = asyncio.run(rebuild_twice())
+    assert (first, second) == (2, 0)
+    assert generation_after == generation_before
+
+
+def test_only_one_process_rebuilds_per_interval(db):
+    async def two_workers():
+        leases = LeaseRepository(db)
+        return [await leases.acquire(REBUILD_LEASE_ID, owner, 60) is not None for owner in ('worker 1', 'worker 2')]
+
+    assert asyncio.run(two_workers()) == [True, False]
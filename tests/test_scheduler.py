@@ -0,0 +1,111 @@
+import asyncio
+import datetime
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import scheduler
+from mongo.crawl_targets import CrawlTargetRepository
+from scheduler import CrawlScheduler
+
+
+def _fake_crawl(failing_urls: set, crawled: list):
+    def crawl(search_url: str, stats: dict):
+        crawled.append(search_url)
+        if search_url in failing_urls:
+            raise ConnectionError("listing page unavailable")
+        stats.update(pages=1, new_ads=0, total_ads=10)
+    return crawl
+
+
+def test_failed_target_backs_off_and_does_not_block_others(db, monkeypatch):
+    crawled = []
+    monkeypatch.setattr(scheduler, '_crawl_in_thread', _fake_crawl({'broken'}, crawled))
+
+    async def scenario():
+        repo = CrawlTargetRepository(db)
+        await repo.save_target('broken', priority=2)
+        await repo.save_target('healthy', priority=1)
+        crawl_scheduler = CrawlScheduler(db)
+        assert (await crawl_scheduler.run_once()).search_url == 'broken'
+        assert (await crawl_scheduler.run_once()).search_url == 'healthy'
+        assert await crawl_scheduler.run_once() is None  # broken waits for its retry, healthy is fresh
+        return {target['search_url']: target for target in await repo.get_targets()}
+
+    targets = asyncio.run(scenario())
+    assert crawled == ['broken', 'healthy']
+    assert targets['broken']['failures'] == 1 and 'retry_after' in targets['broken']
+    assert 'last_crawled_at' not in targets['broken']
+    assert 'failures' not in targets['healthy'] and 'last_crawled_at' in targets['healthy']
+
+
+def test_only_the_lease_holder_crawls(db, monkeypatch):
+    crawled = []
+    monkeypatch.setattr(scheduler, '_crawl_in_thread', _fake_crawl(set(), crawled))
+
+    async def scenario():
+        await CrawlTargetRepository(db).save_target('first')
+        await CrawlTargetRepository(db).save_target('second')
+        leader, follower = CrawlScheduler(db), CrawlScheduler(db)
+        assert await leader.run_once() is not None
+        assert await follower.run_once() is None
+        # the leader stops renewing, the follower takes over with the budget left by the leader
+        await db.meta_collection.update_one({'_id': 'crawl_scheduler'},
+                                            {'$set': {'expires_at': datetime.datetime(2000, 1, 1)}})
+        assert await follower.acquire_lease() is True
+        return leader.budget.tokens, follower.budget.tokens
+
+    leader_tokens, follower_tokens = asyncio.run(scenario())
+    assert crawled == ['first']
+    assert follower_tokens == pytest.approx(leader_tokens, abs=0.1)
+
+
+def test_retry_delay_doubles_up_to_the_maximum():
+    assert scheduler.retry_delay(1) == scheduler.CRAWL_RETRY_SECONDS
+    assert scheduler.retry_delay(3) == 4 * scheduler.CRAWL_RETRY_SECONDS
+    assert scheduler.retry_delay(100) == scheduler.CRAWL_MAX_RETRY_SECONDS
+
+
+@pytest.fixture
+def failing_listing():
+    """Listing host answering /forbidden with 403 and /busy with 429, counting the requests per path"""
+    requests_made = {}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = self.path.split('?')[0]
+            requests_made[path] = requests_made.get(path, 0) + 1
+            self.send_error(403 if path == '/forbidden' else 429)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}", requests_made
+    server.shutdown()
+    server.server_close()
+
+
+def test_http_errors_on_the_listing_fail_the_crawl(db, monkeypatch, failing_listing):
+    main = pytest.importorskip('main')
+    from scraping.sinks import NullSink
+
+    base_url, requests_made = failing_listing
+    monkeypatch.setattr(main.time, 'sleep', lambda seconds: None)
+    monkeypatch.setattr(scheduler, '_crawl_in_thread', lambda search_url, stats: asyncio.run(
+        main.scrape_all_pages(search_url, stats=stats, sink=NullSink())))
+
+    async def scenario():
+        repo = CrawlTargetRepository(db)
+        await repo.save_target(f"{base_url}/forbidden", priority=2)
+        await repo.save_target(f"{base_url}/busy", priority=1)
+        crawl_scheduler = CrawlScheduler(db)
+        await crawl_scheduler.run_once()
+        await crawl_scheduler.run_once()
+        return await repo.get_targets()
+
+    targets = asyncio.run(scenario())
+    assert all(target['failures'] == 1 and 'last_crawled_at' not in target for target in targets)
+    assert requests_made == {'/forbidden': 1, '/busy': 1 + main.SCRAPE_RETRIES}
@@ -0,0 +1,68 @@
+import asyncio
+import datetime
+
+from analytics.search_matcher import SearchMatcher
+
+
+def _car(ad_number: int, price: int) -> dict:
+    return {'ad_number': ad_number, 'make': 'Audi', 'model': 'A4', 'year': 2015, 'price': price,
+            'fuel_type': 'Dizel', 'updatedAt': datetime.datetime.now(datetime.timezone.utc)}
+
+
+def test_cars_saved_by_other_processes_reach_searches_stored_by_other_workers(db):
+    matcher = SearchMatcher()
+
+    async def scenario():
+        await db.car_collection.insert_one(_car(1, 9000))
+        # saved on another worker, inserted directly as the scraper of another process would
+        search = await db.saved_search_collection.insert_one({'makes_to_include': {'audi': []}})
+        await matcher.reload_searches(db)
+        queue = matcher.subscribe(str(search.inserted_id))
+        assert await matcher.poll(db) == 0  # already stored cars are not announced
+        await db.car_collection.insert_one(_car(2, 12000))
+        assert await matcher.poll(db) == 1
+        assert await matcher.poll(db) == 0  # same car read again
+        await db.car_collection.update_one({'ad_number': 1}, {'$set': {
+            'price': 8500, 'updatedAt': datetime.datetime.now(datetime.timezone.utc)}})
+        assert await matcher.poll(db) == 1
+        return [queue.get_nowait()['ad_number'] for _ in range(queue.qsize())]
+
+    assert asyncio.run(scenario()) == [2, 1]
+
+
+def test_deleted_searches_are_dropped_on_reload(db):
+    matcher = SearchMatcher()
+
+    async def scenario():
+        search = await db.saved_search_collection.insert_one({'makes_to_include': {'audi': []}})
+        await matcher.reload_searches(db)
+        assert len(matcher.index) == 1
+        await db.saved_search_collection.delete_one({'_id': search.inserted_id})
+        await matcher.reload_searches(db)
+        return len(matcher.index)
+
+    assert asyncio.run(scenario()) == 0
+
+
+def test_searches_on_fields_outside_the_event_are_matched(db):
+    matcher = SearchMatcher()
+    searches = {
+        'gearbox': {'search_url': 'https://www.polovniautomobili.com/auto-oglasi/pretraga?gearbox[]=10795'},
+        'text': {'text': 'prvi vlasnik'},
+        'safety': {'search_url': 'https://www.polovniautomobili.com/auto-oglasi/pretraga?abs=1'},
+        'other gearbox': {'search_url': 'https://www.polovniautomobili.com/auto-oglasi/pretraga?gearbox[]=3211'},
+    }
+
+    async def scenario():
+        search_ids = {}
+        for name, search in searches.items():
+            search_ids[str((await db.saved_search_collection.insert_one(search)).inserted_id)] = name
+        await matcher.reload_searches(db)
+        queues = {name: matcher.subscribe(search_id) for search_id, name in search_ids.items()}
+        await matcher.poll(db)
+        await db.car_collection.insert_one({**_car(3, 15000), 'transmission': 'Automatski / poluautomatski',
+                                            'safety': ['airbag', 'abs'], 'search_text': 'prvi vlasnik servisna knjiga'})
+        await matcher.poll(db)
+        return {name for name, queue in queues.items() if not queue.empty()}
+
+    assert asyncio.run(scenario()) == {'gearbox', 'text', 'safety'}
@@ -0,0 +1,61 @@
+import pytest
+
+from mongo.search_query import specs_from_search, mongo_query_from_specs, active_specs
+from mongo.specifications import TextSearchParameter
+from scraping.text import fold_diacritics, normalize_text, tokenize
+
+CAR_TEXT = normalize_text("Klima, šiber krov, xenon. Kožna sedišta, đak vozio do škole!")
+
+
+def test_serbian_diacritics_are_folded_to_ascii():
+    assert fold_diacritics("Čačak Ćuprija Šabac Žabalj Đakovo đak") == "Cacak Cuprija Sabac Zabalj Djakovo djak"
+
+
+def test_text_is_normalized_to_lower_case_words():
+    assert normalize_text("  Klima,  ŠIBER-krov!\n") == "klima siber krov"
+    assert tokenize("Kožna sedišta, 2x airbag") == ["kozna", "sedista", "2x", "airbag"]
+    assert normalize_text(None) == normalize_text("...") == ""
+
+
+@pytest.mark.parametrize('text, search', [
+    ('Klima "ŠIBER krov"', '"klima" "siber krov"'),
+    ('xenon, "kožna sedišta"!', '"xenon" "kozna sedista"'),
+    ('"nove gume', '"nove" "gume"'),  # unterminated quote, plain words
+    ('šiber-krov', '"siber krov"'),
+])
+def test_words_and_phrases_become_quoted_text_search_terms(text, search):
+    assert TextSearchParameter(text).to_query() == {'$text': {'$search': search}}
+
+
+@pytest.mark.parametrize('text', [None, '', '   ', '"" !'])
+def test_text_without_words_does_not_filter(text):
+    assert active_specs([TextSearchParameter(text)]) == []
+
+
+@pytest.mark.parametrize('text, matches', [
+    ('klima xenon', True),
+    ('XENON klima', True),  # words in any order
+    ('"šiber krov"', True),
+    ('"krov šiber"', False),  # phrases in order
+    ('"kožna sedišta", đak!', True),
+    ('klima navigacija', False),
+    ('dja', False),  # whole words only
+])
+def test_matching_stored_cars_agrees_with_the_text_search(text, matches):
+    assert TextSearchParameter(text).matches({'search_text': CAR_TEXT}) is matches
+
+
+def test_text_search_is_combined_with_make_filters():
+    specifications = specs_from_search(None, {'audi': ['a4'], 'bmw': []}, {'fiat': []}, 'klima "šiber krov"')
+
+    assert mongo_query_from_specs(specifications) == {
+        '$or': [{'$and': [{'make': 'Audi'}, {'model': {'$in': ['A4']}}]}, {'make': 'Bmw'}],
+        '$and': [{'make': {'$ne': 'Fiat'}}],
+        '$text': {'$search': '"klima" "siber krov"'},
+    }
+    cars = [{'make': 'Audi', 'model': 'A4', 'search_text': CAR_TEXT},
+            {'make': 'Bmw', 'model': 'X5', 'search_text': 'klima'},
+            {'make': 'Audi', 'model': 'A6', 'search_text': CAR_TEXT},
+            {'make': 'Fiat', 'model': 'Punto', 'search_text': CAR_TEXT}]
+    assert [all(spec.matches(car) for spec in active_specs(specifications)) for car in cars] == \
+           [True, False, False, False]
@@ -0,0 +1,121 @@
+import asyncio
+import hashlib
+import io
+import math
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from scraping.thumbnails import ThumbnailCache, fetch_thumbnails, THUMBNAIL_MEDIA_TYPE, EVICTION_LOW_WATER
+
+Image = pytest.importorskip('PIL.Image')
+pytest.importorskip('requests')
+
+
+def _jpeg(color: tuple[int, int, int]) -> bytes:
+    output = io.BytesIO()
+    Image.new('RGB', (800, 600), color).save(output, format='JPEG')
+    return output.getvalue()
+
+
+def _make_old(cache: ThumbnailCache, *digests: str):
+    """Last used an hour ago, in this order, so recency does not depend on the file system's mtime resolution"""
+    for age, digest in enumerate(reversed(digests)):
+        os.utime(cache.path_for(digest), (time.time() - 3600 - age, time.time() - 3600 - age))
+
+
+@pytest.fixture
+def image_server():
+    """Local stand-in for the listing image host, serves /red.jpg, /copy-of-red.jpg and /blue.jpg"""
+    images = {'/red.jpg': _jpeg((200, 0, 0)), '/copy-of-red.jpg': _jpeg((200, 0, 0)), '/blue.jpg': _jpeg((0, 0, 200))}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path not in images:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/jpeg')
+            self.send_header('Content-Length', str(len(images[self.path])))
+            self.end_headers()
+            self.wfile.write(images[self.path])
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_thumbnails_are_content_addressed(image_server, tmp_path):
+    cache = ThumbnailCache(str(tmp_path), max_bytes=10 * 1024 * 1024)
+    digests = asyncio.run(fetch_thumbnails({1: f"{image_server}/red.jpg", 2: f"{image_server}/copy-of-red.jpg",
+                                            3: f"{image_server}/blue.jpg", 4: f"{image_server}/missing.jpg"}, cache))
+
+    assert set(digests) == {1, 2, 3}  # failed images are left out
+    assert digests[1] == digests[2] != digests[3]
+    stored = cache.get(digests[1])
+    assert stored == cache.path_for(digests[1])
+    assert hashlib.sha256(stored.read_bytes()).hexdigest() == digests[1]
+    assert len(list(tmp_path.glob('*/*.webp'))) == 2
+
+
+def test_least_recently_used_thumbnail_is_evicted(image_server, tmp_path):
+    cache = ThumbnailCache(str(tmp_path), max_bytes=10 * 1024 * 1024)
+    red, blue = (asyncio.run(fetch_thumbnails({1: f"{image_server}/{name}.jpg"}, cache))[1] for name in ('red', 'blue'))
+    _make_old(cache, red, blue)
+    cache.get(red)  # blue is now the least recently used
+    newest = b'not really an image, but stored all the same'
+    cache.max_bytes = math.ceil((cache.path_for(red).stat().st_size + len(newest)) / EVICTION_LOW_WATER)
+    cache.put(newest)
+
+    assert cache.get(blue) is None
+    assert cache.get(red) is not None
+    assert not cache.path_for(blue).exists()
+
+
+def test_reads_of_another_process_count_for_eviction(tmp_path):
+    scraper = ThumbnailCache(str(tmp_path), max_bytes=1024)
+    api = ThumbnailCache(str(tmp_path), max_bytes=1024)
+    first, second = scraper.put(b'first' * 80), scraper.put(b'second' * 80)
+    _make_old(scraper, first, second)
+    assert api.get(first) is not None  # only the API process knows first was used after second
+
+    scraper.put(b'third' * 80)
+    assert api.get(second) is None
+    assert api.get(first) is not None
+
+
+def test_thumbnail_removed_by_another_process_is_a_miss(tmp_path):
+    cache = ThumbnailCache(str(tmp_path), max_bytes=1024)
+    digest = cache.put(b'thumbnail')
+    cache.path_for(digest).unlink()
+
+    assert cache.get(digest) is None
+    assert cache.put(b'thumbnail') == digest
+    assert cache.get(digest) is not None
+
+
+def test_thumbnail_endpoint_serves_immutable_webp(image_server, tmp_path, monkeypatch):
+    pytest.importorskip('httpx')
+    from fastapi.testclient import TestClient
+    import api
+
+    cache = ThumbnailCache(str(tmp_path), max_bytes=10 * 1024 * 1024)
+    monkeypatch.setattr(api, 'thumbnail_cache', cache)
+    digest = asyncio.run(fetch_thumbnails({1: f"{image_server}/red.jpg"}, cache))[1]
+    client = TestClient(api.app)
+
+    response = client.get(f"/thumbnails/{digest}")
+    assert response.status_code == 200
+    assert response.headers['content-type'] == THUMBNAIL_MEDIA_TYPE
+    assert response.headers['cache-control'] == "public, max-age=31536000, immutable"
+    assert response.content == cache.path_for(digest).read_bytes()
+    assert client.get(f"/thumbnails/{'0' * 64}").status_code == 404
+    assert client.get("/thumbnails/not-a-digest").status_code == 404